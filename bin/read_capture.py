@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import os
+import sys
+
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.capture import CaptureReader, RecordKind
+from interceptor.metrics import BridgeMetrics
+
+KIND_NAMES = {
+    RecordKind.DATA: 'data',
+    RecordKind.OPEN: 'open',
+    RecordKind.CLOSE: 'close',
+    }
+
+DIRECTION_NAMES = {
+    BridgeMetrics.ONE_DIRECTION: 'client->upstream',
+    BridgeMetrics.OTHER_DIRECTION: 'upstream->client',
+    }
+
+
+def print_record(record,show_bytes):
+    line = (
+        '%(time)s conn=%(connection_id)i %(kind)s' %
+        { 'time': datetime.datetime.fromtimestamp(
+                record.time_seconds).isoformat(),
+          'connection_id': record.connection_id,
+          'kind': KIND_NAMES.get(record.kind,str(record.kind))})
+    if record.kind == RecordKind.DATA:
+        line += (
+            ' %(direction)s %(length)i bytes' %
+            { 'direction': DIRECTION_NAMES.get(
+                    record.direction,str(record.direction)),
+              'length': record.original_length})
+        if len(record.data) < record.original_length:
+            line += ' (%i captured)' % len(record.data)
+        if show_bytes > 0:
+            line += ' ' + repr(record.data[:show_bytes])
+    print line
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        'Print the records of a capture file written by a bridge')
+    parser.add_argument('capture_path',help='Capture file to read.')
+    parser.add_argument(
+        '--skip',type=int,default=0,
+        help='Number of oldest records to skip.')
+    parser.add_argument(
+        '--count',type=int,default=None,
+        help='Most records to print.  Defaults to all of them.')
+    parser.add_argument(
+        '--connection',type=int,default=None,
+        help='Only print records of the connection with this id.')
+    parser.add_argument(
+        '--show-bytes',type=int,default=32,
+        help='Bytes of each data record to print.')
+    args = parser.parse_args()
+
+    try:
+        reader = CaptureReader(args.capture_path)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    num_printed = 0
+    for record in reader.records(args.skip):
+        if (args.count is not None) and (num_printed >= args.count):
+            break
+        if (args.connection is not None) and (
+            record.connection_id != args.connection):
+            continue
+        print_record(record,args.show_bytes)
+        num_printed += 1
+    reader.close()
+
+
+if __name__ == '__main__':
+    run()
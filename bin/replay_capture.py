@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.capture_replay import CaptureReplay
+from interceptor.event_loop import EventLoop
+from interceptor.util import HostPortPair
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        'Replay what clients sent in a capture file against a target')
+    parser.add_argument('capture_path',help='Capture file to replay.')
+    parser.add_argument(
+        '--target-host',default='127.0.0.1',
+        help='Host to replay against.  Defaults to localhost.')
+    parser.add_argument(
+        '--target-port',type=int,required=True,
+        help='Port to replay against.')
+    parser.add_argument(
+        '--speed',type=float,default=1.,
+        help=('How many times faster than recorded to replay.  ' +
+              'Defaults to 1, the recorded timing.'))
+    parser.add_argument(
+        '--as-fast-as-possible',action='store_true',
+        help='Ignore recorded timing; send as fast as the target reads.')
+    parser.add_argument(
+        '--copies',type=int,default=1,
+        help='Number of replays of the capture to run at once.')
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    if args.copies < 1:
+        parser.error('--copies must be at least 1')
+    speed = args.speed
+    if args.as_fast_as_possible:
+        speed = None
+
+    target_host_port_pair = HostPortPair(args.target_host,args.target_port)
+    loop = EventLoop()
+    try:
+        replays = [
+            CaptureReplay(args.capture_path,target_host_port_pair,speed,loop)
+            for i in range(0,args.copies)]
+    except ValueError as ex:
+        parser.error(str(ex))
+    loop.start()
+    for replay in replays:
+        replay.start()
+    for replay in replays:
+        # wait with a timeout so that ctrl-c still interrupts.
+        while not replay.wait(1):
+            pass
+    print json.dumps(
+        [replay.snapshot() for replay in replays],indent=2)
+
+
+if __name__ == '__main__':
+    run()
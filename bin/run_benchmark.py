@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.benchmark import benchmark_cases, run_benchmarks
+from interceptor.benchmark import DEFAULT_LATENCY_SAMPLES
+from interceptor.benchmark import DEFAULT_TIMEOUT_SECONDS
+from interceptor.engine import EngineType
+from interceptor.plan import PlanType
+
+PLAN_TYPE_FIELD = 'type'
+PLAN_ADDITIONAL_ARGS_FIELD = 'additional_args'
+
+DEFAULT_PLANS = json.dumps([
+        {PLAN_TYPE_FIELD: PlanType.PASS_THROUGH_PLAN,
+         PLAN_ADDITIONAL_ARGS_FIELD: {}},
+        {PLAN_TYPE_FIELD: PlanType.CONSTANT_DELAY_PLAN,
+         PLAN_ADDITIONAL_ARGS_FIELD: {'delay_seconds': .001}},
+        {PLAN_TYPE_FIELD: PlanType.RANDOM_DELAY_PLAN,
+         PLAN_ADDITIONAL_ARGS_FIELD: {
+                'lower_delay_seconds': 0,
+                'upper_delay_seconds': .002,
+                'pipelined': True}},
+        ])
+
+
+def plans_arg(arg_line):
+    '''
+    @param {string} arg_line --- json list of plans, each of the same
+    form as the plan field of run_interceptor.py's --bridges.
+
+    @returns {list} --- (plan_type,plan_additional_args) tuples.
+    '''
+    try:
+        plan_list = json.loads(arg_line)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+    plans = []
+    for plan_params in plan_list:
+        plan_type = plan_params.get(PLAN_TYPE_FIELD,None)
+        if plan_type is None:
+            raise argparse.ArgumentTypeError(
+                'Must specify type field for each plan')
+        plans.append(
+            (plan_type,plan_params.get(PLAN_ADDITIONAL_ARGS_FIELD,{})))
+    return plans
+
+
+def int_list_arg(arg_line):
+    try:
+        return [int(value) for value in arg_line.split(',')]
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def engine_list_arg(arg_line):
+    engine_types = arg_line.split(',')
+    for engine_type in engine_types:
+        if engine_type not in (EngineType.THREADED,EngineType.EVENT_LOOP):
+            raise argparse.ArgumentTypeError(
+                'Unknown engine type ' + engine_type)
+    return engine_types
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        'Measure throughput, added latency, cpu and threads of bridges')
+    parser.add_argument(
+        '--output',required=True,
+        help='File to write json results to.')
+    parser.add_argument(
+        '--plans',type=plans_arg,default=plans_arg(DEFAULT_PLANS),
+        help=('json list of plans to benchmark, each of the form ' +
+              '{type: <string>, additional_args: {...}}'))
+    parser.add_argument(
+        '--engines',type=engine_list_arg,
+        default=[EngineType.THREADED,EngineType.EVENT_LOOP],
+        help='Comma separated engine types.')
+    parser.add_argument(
+        '--payload-sizes',type=int_list_arg,
+        default=[1024 * 1024,16 * 1024 * 1024],
+        help='Comma separated bytes each connection sends.')
+    parser.add_argument(
+        '--connections',type=int_list_arg,default=[1,8],
+        help='Comma separated numbers of concurrent connections.')
+    parser.add_argument(
+        '--chunk-sizes',type=int_list_arg,default=[1024,64 * 1024],
+        help='Comma separated sizes of clients\' writes.')
+    parser.add_argument(
+        '--latency-samples',type=int,default=DEFAULT_LATENCY_SAMPLES,
+        help='Round trips to time for latency.')
+    parser.add_argument(
+        '--timeout',type=float,default=DEFAULT_TIMEOUT_SECONDS,
+        help='Seconds to wait for each case\'s payload to arrive.')
+    args = parser.parse_args()
+
+    cases = benchmark_cases(
+        args.plans,args.engines,args.payload_sizes,args.connections,
+        args.chunk_sizes)
+
+    def print_progress(result):
+        print (
+            '%(plan_type)s %(engine_type)s payload=%(payload_bytes)i ' +
+            'connections=%(num_connections)i chunk=%(chunk_bytes)i: ' +
+            '%(throughput_mb_per_second).1f MB/s, ' +
+            'cpu %(cpu_seconds).2fs, threads %(threads)i') % result
+        sys.stdout.flush()
+
+    results = run_benchmarks(
+        cases,args.latency_samples,args.timeout,print_progress)
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=2)
+
+
+if __name__ == '__main__':
+    run()
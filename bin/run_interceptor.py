@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 import argparse
-import json
 import os
+import resource
 import sys
 import time
 
@@ -10,113 +10,49 @@ FILE_DIR = os.path.dirname( os.path.abspath(__file__))
 sys.path.append(os.path.join(FILE_DIR,'..',))
 
 from interceptor.util import HostPortPair
-from interceptor.plan import plan_from_args
-from interceptor.bridge import Bridge
-
-INTERPOSING_HOST_FIELD = 'interposing_host'
-INTERPOSING_PORT_FIELD = 'interposing_port'
-
-TO_CONNECT_TO_HOST_FIELD = 'to_connect_to_host'
-TO_CONNECT_TO_PORT_FIELD = 'to_connect_to_port'
-
-PLAN_FIELD = 'plan'
-PLAN_TYPE_FIELD = 'type'
-PLAN_ADDITIONAL_ARGS_FIELD = 'additional_args'
+from interceptor.config import bridge_descriptions_from_json
+from interceptor.config import bridge_descriptions_from_file
+from interceptor.config import check_distinct_ports
+from interceptor.control import BridgeSet, ControlServer, ControlError
+from interceptor.engine import EngineType, engine_from_type
+from interceptor.engine import set_default_engine
+from interceptor.metrics import StatsServer
+from interceptor.supervisor import Supervisor
 
 class BridgeArguments(object):
     def __init__(self,arg_line):
         '''
-        @param {string} arg_line --- Should be a json string of a
-        list.  Each element has the following form:
-            {
-                interposing_host: <string>,
-                interposing_port: <int>,
-
-                to_connect_to_host: <string>,
-                to_connect_to_port: <int>,
-
-                plan: {
-                  type: <string>,
-                  additional_args: {
-                  ... // specific to plan type
-                  }
-                }
-            }
+        @param {string} arg_line --- See
+        config.bridge_descriptions_from_json.
         '''
-        self.bridge_list = []
-
+        self.bridge_descriptions = bridge_descriptions_from_json(arg_line)
+
+
+def start_bridges(bridge_descriptions):
+    '''
+    @returns {BridgeSet} --- Running bridge_descriptions, with ids in
+    the order they are listed.
+
+    @throws ControlError if a bridge cannot listen.
+    '''
+    bridge_set = BridgeSet()
+    for bridge_description in bridge_descriptions:
+        bridge_set.add(bridge_description)
+    return bridge_set
+
+
+def raise_open_file_limit():
+    '''
+    Every bridge holds a listening socket, and every connection two
+    more, so large topologies need more than the usual soft limit of
+    1024 open files.  Raise it as far as we are allowed.
+    '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
         try:
-            arg_list = json.loads(arg_line)
-        except ValueError as ex:
-            raise argparse.ArgumentTypeError(str(ex))
-        
-        for bridge_description in arg_list:
-            interposing_host = bridge_description.get(
-                INTERPOSING_HOST_FIELD,None)
-            interposing_port = bridge_description.get(
-                INTERPOSING_PORT_FIELD,None)
-
-            to_connect_to_host = bridge_description.get(
-                TO_CONNECT_TO_HOST_FIELD,None)
-            to_connect_to_port = bridge_description.get(
-                TO_CONNECT_TO_PORT_FIELD,None)
-            
-            plan_params = bridge_description.get(PLAN_FIELD,None)
-            
-            if interposing_host is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify interposing_host field for ' +
-                    'bridge description')
-            if interposing_port is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify interposing_port field for ' +
-                    'bridge description')
-            if to_connect_to_host is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify to_connect_to_host field for ' +
-                    'bridge description')
-            if to_connect_to_port is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify to_connect_to_port field for ' +
-                    'bridge description')
-            if plan_params is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify plan field for ' +
-                    'bridge description')
-            interposing_port = int(interposing_port)
-            conecting_port = int(to_connect_to_port)
-            
-            interposition_host_port_pair = HostPortPair(
-                interposing_host,interposing_port)
-            to_connect_to_host_port_pair = HostPortPair(
-                to_connect_to_host,to_connect_to_port)
-
-
-            # decode plan
-            plan_type = plan_params.get(PLAN_TYPE_FIELD,None)
-            plan_additional_args = plan_params.get(
-                PLAN_ADDITIONAL_ARGS_FIELD,None)
-            if plan_type is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify plan_type field for ' +
-                    'bridge description')
-            if plan_additional_args is None:
-                raise argparse.ArgumentTypeError(
-                    'Must specify plan_additional_args field for ' +
-                    'bridge description')
-
-            plan_one_side = plan_from_args(plan_type,plan_additional_args)
-            plan_other_side = plan_from_args(plan_type,plan_additional_args)
-
-            bridge = Bridge(
-                interposition_host_port_pair,plan_one_side,
-                to_connect_to_host_port_pair,plan_other_side)
-            self.bridge_list.append(bridge)
-            
-            
-    def start_bridges(self):
-        for bridge in self.bridge_list:
-            bridge.non_blocking_connection_setup()
+            resource.setrlimit(resource.RLIMIT_NOFILE,(hard,hard))
+        except (ValueError,resource.error):
+            pass
 
 def bridges_help():
     return '''
@@ -129,6 +65,23 @@ has the following form:
         to_connect_to_host: <string>,
         to_connect_to_port: <int>,
 
+        /* optional, accept many concurrent clients */
+        multi_connection: <bool>,
+
+        /* optional, most bytes to read from a socket at once */
+        recv_buffer_size: <int>,
+
+        /* optional, upstream connections to keep open ahead of time */
+        upstream_pool_size: <int>,
+
+        /* optional, record traffic to a capture file at this path.
+           Read it with read_capture.py.  With --workers, each worker
+           writes its own file, suffixed .worker<index> */
+        capture_path: <string>,
+
+        /* optional, most bytes the capture file holds */
+        capture_ring_bytes: <int>,
+
         plan: {
           type: <string>,
           additional_args: {
@@ -143,11 +96,80 @@ def run():
     parser = argparse.ArgumentParser(
         'Run a shim between processes that intercepts messages')
     parser.add_argument('--bridges',type=BridgeArguments,help=bridges_help())
+    parser.add_argument(
+        '--config',type=bridge_descriptions_from_file,default=None,
+        help=('Path of a json file of bridges to run as well as any ' +
+              'given by --bridges.  Besides a list like --bridges, ' +
+              'may declare templates and ranges of ports; see ' +
+              'config.bridge_descriptions_from_file.'))
+    parser.add_argument(
+        '--engine',choices=[EngineType.THREADED,EngineType.EVENT_LOOP],
+        default=EngineType.THREADED,
+        help=('threaded uses a thread per direction of each ' +
+              'connection.  event_loop forwards every connection ' +
+              'of every bridge from a single thread.'))
+    parser.add_argument(
+        '--stats-port',type=int,default=None,
+        help=('If specified, serve json metrics for every bridge ' +
+              'at http://<stats-host>:<stats-port>/stats'))
+    parser.add_argument(
+        '--stats-host',default='127.0.0.1',
+        help='Host to serve metrics on.  Defaults to localhost.')
+    parser.add_argument(
+        '--workers',type=int,default=1,
+        help=('Number of processes to forward from.  If more than ' +
+              '1, multi connection bridges accept in every worker ' +
+              'and other bridges are spread across workers.  ' +
+              'Workers that die are restarted.'))
+    parser.add_argument(
+        '--control-socket',default=None,
+        help=('If specified, take commands to list, add, and remove ' +
+              'bridges and to swap their plans, without dropping ' +
+              'connections, on a unix socket at this path.  One json ' +
+              'command per line; see interceptor/control.py.  Not ' +
+              'supported with --workers.'))
     args = parser.parse_args()
     
-    bridge_arguments = args.bridges
-
-    bridge_arguments.start_bridges()
+    bridge_descriptions = []
+    if args.bridges is not None:
+        bridge_descriptions.extend(args.bridges.bridge_descriptions)
+    if args.config is not None:
+        bridge_descriptions.extend(args.config)
+    try:
+        check_distinct_ports(bridge_descriptions)
+    except argparse.ArgumentTypeError as ex:
+        parser.error(str(ex))
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if (args.workers > 1) and (args.control_socket is not None):
+        # each worker would need its own copy of every change.
+        parser.error('--control-socket is not supported with --workers')
+
+    raise_open_file_limit()
+    if args.workers > 1:
+        supervisor = Supervisor(
+            bridge_descriptions,args.workers,args.engine)
+        supervisor.start()
+        snapshot_function = supervisor.snapshot
+    else:
+        set_default_engine(engine_from_type(args.engine))
+        try:
+            bridge_set = start_bridges(bridge_descriptions)
+        except ControlError as ex:
+            parser.error(str(ex))
+        snapshot_function = bridge_set.snapshot
+        if args.control_socket is not None:
+            control_server = ControlServer(args.control_socket,bridge_set)
+            control_server.start()
+
+    if args.stats_port is not None:
+        stats_server = StatsServer(
+            HostPortPair(args.stats_host,args.stats_port),
+            snapshot_function)
+        stats_server.start()
+
+    if args.workers > 1:
+        supervisor.run_forever()
     while True:
         time.sleep(1)
     
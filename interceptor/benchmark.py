@@ -0,0 +1,476 @@
+'''
+Measures how fast bridges forward data with different plans and
+engines.
+
+Bridges run in the calling process.  Clients and the servers that
+bridges connect to run in a separate load generator process, so that
+the cpu time and thread counts reported belong to the interceptor
+alone.
+'''
+import functools
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+from interceptor.bridge import MultiConnectionBridge
+from interceptor.clock import monotonic
+from interceptor.engine import engine_from_type
+from interceptor.plan import plan_from_args
+from interceptor.util import HostPortPair
+
+HOST = '127.0.0.1'
+LATENCY_MESSAGE_BYTES = 64
+DEFAULT_LATENCY_SAMPLES = 200
+DEFAULT_TIMEOUT_SECONDS = 60
+
+
+class BenchmarkCase(object):
+    def __init__(self,plan_type,plan_additional_args,engine_type,
+                 payload_bytes,num_connections,chunk_bytes):
+        '''
+        @param {PlanType} plan_type, {dict} plan_additional_args ---
+        Passed to plan_from_args to make each direction's plan.
+
+        @param {EngineType} engine_type
+
+        @param {int} payload_bytes --- Each connection sends this
+        much data.
+
+        @param {int} num_connections --- Number of connections sending
+        at once.
+
+        @param {int} chunk_bytes --- Clients send in pieces this big.
+        '''
+        self.plan_type = plan_type
+        self.plan_additional_args = plan_additional_args
+        self.engine_type = engine_type
+        self.payload_bytes = payload_bytes
+        self.num_connections = num_connections
+        self.chunk_bytes = chunk_bytes
+
+    def to_dict(self):
+        return {
+            'plan_type': self.plan_type,
+            'plan_additional_args': self.plan_additional_args,
+            'engine_type': self.engine_type,
+            'payload_bytes': self.payload_bytes,
+            'num_connections': self.num_connections,
+            'chunk_bytes': self.chunk_bytes,
+            }
+
+
+def benchmark_cases(plans,engine_types,payload_sizes,connection_counts,
+                    chunk_sizes):
+    '''
+    @param {list} plans --- Each element is a (plan_type,
+    plan_additional_args) tuple.
+
+    @returns {list} --- A BenchmarkCase for every combination of
+    arguments.
+    '''
+    cases = []
+    for plan_type, plan_additional_args in plans:
+        for engine_type in engine_types:
+            for payload_bytes in payload_sizes:
+                for num_connections in connection_counts:
+                    for chunk_bytes in chunk_sizes:
+                        cases.append(
+                            BenchmarkCase(
+                                plan_type,plan_additional_args,
+                                engine_type,payload_bytes,
+                                num_connections,chunk_bytes))
+    return cases
+
+
+def run_benchmarks(cases,latency_samples=DEFAULT_LATENCY_SAMPLES,
+                   timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                   progress_callback=None):
+    '''
+    @param {list} cases --- BenchmarkCases to run, in order.
+
+    @param {function or None} progress_callback --- Called with each
+    case's result dict as soon as the case finishes.
+
+    @returns {dict} --- Ready to be written as json.  Has a
+    'metadata' field describing the machine and a 'results' field
+    with one dict per case.
+    '''
+    # start the load generator before any bridges exist, so that it
+    # doesn't inherit their threads and sockets.
+    load_generator = _LoadGenerator()
+    start_time = time.time()
+    results = []
+    try:
+        for case in cases:
+            result = run_case(
+                load_generator,case,latency_samples,timeout_seconds)
+            results.append(result)
+            if progress_callback is not None:
+                progress_callback(result)
+    finally:
+        load_generator.stop()
+
+    return {
+        'metadata': {
+            'python_version': sys.version,
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'start_time': start_time,
+            },
+        'results': results,
+        }
+
+
+def run_case(load_generator,case,latency_samples,timeout_seconds):
+    '''
+    @returns {dict} --- case's parameters, plus:
+        throughput_mb_per_second: <float>
+        bytes_delivered: <int>
+        timed_out: <bool>
+        added_latency_p50_ms: <float or None>
+        added_latency_p99_ms: <float or None>
+        cpu_seconds: <float> --- user and system time used by this
+            process while the case ran.
+        threads: <int> --- most threads this process had running
+            while the case ran, beyond those it had before.
+    '''
+    threads_before = _settled_thread_count()
+    sampler = _ThreadCountSampler()
+    sampler.start()
+
+    sink_port, echo_port = load_generator.start_servers()
+
+    engine = engine_from_type(case.engine_type)
+    plan_factory = functools.partial(
+        plan_from_args,case.plan_type,case.plan_additional_args)
+    throughput_bridge = _start_bridge(plan_factory,sink_port,engine)
+    latency_bridge = _start_bridge(plan_factory,echo_port,engine)
+    try:
+        cpu_before = sum(os.times()[0:2])
+        load_results = load_generator.run_load(
+            throughput_bridge.to_listen_on_host_port_pair.port,
+            latency_bridge.to_listen_on_host_port_pair.port,
+            echo_port,case.payload_bytes,case.num_connections,
+            case.chunk_bytes,latency_samples,timeout_seconds)
+        cpu_seconds = sum(os.times()[0:2]) - cpu_before
+        sampler.stop()
+    finally:
+        # so that this case's connections don't keep forwarding, and
+        # using cpu, during later cases.
+        for bridge in (throughput_bridge,latency_bridge):
+            bridge.close(close_connections=True)
+
+    result = case.to_dict()
+    result.update(load_results)
+    result['cpu_seconds'] = cpu_seconds
+    # the sampler's own thread doesn't count.
+    result['threads'] = sampler.max_threads - 1 - threads_before
+    return result
+
+
+def _start_bridge(plan_factory,to_connect_to_port,engine):
+    bridge = MultiConnectionBridge(
+        HostPortPair(HOST,_free_port()),plan_factory,
+        HostPortPair(HOST,to_connect_to_port),plan_factory,
+        engine=engine)
+    # listen before returning so clients can connect right away.
+    bridge.listen(bridge.listen_backlog)
+    bridge.non_blocking_connection_setup()
+    return bridge
+
+
+def _settled_thread_count(max_wait_seconds=2):
+    '''
+    Threads forwarding for an earlier case's connections may still be
+    exiting.  Wait for the thread count to stop changing before using
+    it as a baseline.
+    '''
+    deadline = monotonic() + max_wait_seconds
+    count = threading.active_count()
+    while monotonic() < deadline:
+        time.sleep(.1)
+        new_count = threading.active_count()
+        if new_count == count:
+            break
+        count = new_count
+    return count
+
+
+def _free_port():
+    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    s.bind((HOST,0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _percentile(sorted_values,fraction):
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class _ThreadCountSampler(object):
+    def __init__(self,interval_seconds=.01):
+        self.interval_seconds = interval_seconds
+        self.max_threads = 0
+        self.stopped = threading.Event()
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.max_threads = max(self.max_threads,threading.active_count())
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.max_threads = max(
+                self.max_threads,threading.active_count())
+            time.sleep(self.interval_seconds)
+
+
+class _LoadGenerator(object):
+    '''
+    Parent side of the load generator process.
+    '''
+    def __init__(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_load_generator_main,args=(child_connection,))
+        self.process.daemon = True
+        self.process.start()
+
+    def start_servers(self):
+        '''
+        @returns {tuple} --- (sink_port,echo_port) of fresh servers.
+        '''
+        self.connection.send(('start_servers',{}))
+        return self.connection.recv()
+
+    def run_load(self,throughput_port,latency_port,echo_port,
+                 payload_bytes,num_connections,chunk_bytes,
+                 latency_samples,timeout_seconds):
+        self.connection.send(
+            ('run_load',
+             {'throughput_port': throughput_port,
+              'latency_port': latency_port,
+              'echo_port': echo_port,
+              'payload_bytes': payload_bytes,
+              'num_connections': num_connections,
+              'chunk_bytes': chunk_bytes,
+              'latency_samples': latency_samples,
+              'timeout_seconds': timeout_seconds}))
+        return self.connection.recv()
+
+    def stop(self):
+        self.connection.send(None)
+        self.process.join()
+
+
+def _load_generator_main(connection):
+    servers = None
+    while True:
+        command = connection.recv()
+        if command is None:
+            return
+        name, args = command
+        if name == 'start_servers':
+            servers = (_SinkServer(),_EchoServer())
+            connection.send((servers[0].port,servers[1].port))
+        elif name == 'run_load':
+            connection.send(_run_load(servers[0],**args))
+
+
+def _run_load(sink_server,throughput_port,latency_port,echo_port,
+              payload_bytes,num_connections,chunk_bytes,
+              latency_samples,timeout_seconds):
+    '''
+    Runs in the load generator process.
+    '''
+    baseline_round_trips = _measure_round_trips(echo_port,latency_samples)
+    bridge_round_trips = _measure_round_trips(latency_port,latency_samples)
+
+    added_latency_p50_ms = None
+    added_latency_p99_ms = None
+    if baseline_round_trips and bridge_round_trips:
+        baseline = _percentile(baseline_round_trips,.5)
+        added = [rtt - baseline for rtt in bridge_round_trips]
+        added_latency_p50_ms = _percentile(added,.5) * 1000
+        added_latency_p99_ms = _percentile(added,.99) * 1000
+
+    expected_bytes = payload_bytes * num_connections
+    chunk = 'x' * chunk_bytes
+    sockets = []
+    for i in range(0,num_connections):
+        s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        s.connect((HOST,throughput_port))
+        sockets.append(s)
+
+    senders = []
+    for s in sockets:
+        t = threading.Thread(
+            target=_send_payload,args=(s,chunk,payload_bytes))
+        t.setDaemon(True)
+        t.start()
+        senders.append(t)
+
+    timed_out = not sink_server.wait_for_bytes(
+        expected_bytes,timeout_seconds)
+    for s in sockets:
+        try:
+            s.close()
+        except socket.error:
+            pass
+
+    bytes_delivered, elapsed_seconds = sink_server.take_measurement()
+    throughput_mb_per_second = 0.
+    if elapsed_seconds > 0:
+        throughput_mb_per_second = bytes_delivered / elapsed_seconds / 1e6
+
+    return {
+        'throughput_mb_per_second': throughput_mb_per_second,
+        'bytes_delivered': bytes_delivered,
+        'timed_out': timed_out,
+        'added_latency_p50_ms': added_latency_p50_ms,
+        'added_latency_p99_ms': added_latency_p99_ms,
+        }
+
+
+def _send_payload(s,chunk,payload_bytes):
+    remaining = payload_bytes
+    try:
+        while remaining > 0:
+            if remaining < len(chunk):
+                chunk = chunk[:remaining]
+            s.sendall(chunk)
+            remaining -= len(chunk)
+    except socket.error:
+        # plans that fail connections cut payloads short.
+        pass
+
+
+def _measure_round_trips(port,num_samples):
+    '''
+    @returns {list} --- Sorted round trip times, in seconds, of
+    messages echoed back through port.  Empty if the connection
+    failed.
+    '''
+    message = 'x' * LATENCY_MESSAGE_BYTES
+    round_trips = []
+    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    s.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    s.settimeout(DEFAULT_TIMEOUT_SECONDS)
+    try:
+        s.connect((HOST,port))
+        # the first round trip also waits for the bridge to connect
+        # upstream; don't count it.
+        for i in range(0,num_samples + 1):
+            start = monotonic()
+            s.sendall(message)
+            received = 0
+            while received < len(message):
+                data = s.recv(len(message) - received)
+                if len(data) == 0:
+                    raise socket.error('Connection closed')
+                received += len(data)
+            if i != 0:
+                round_trips.append(monotonic() - start)
+    except socket.error:
+        pass
+    finally:
+        s.close()
+    round_trips.sort()
+    return round_trips
+
+
+class _Server(object):
+    def __init__(self):
+        self.listening_socket = socket.socket(
+            socket.AF_INET,socket.SOCK_STREAM)
+        self.listening_socket.bind((HOST,0))
+        self.listening_socket.listen(128)
+        self.port = self.listening_socket.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.setDaemon(True)
+        t.start()
+
+    def _accept(self):
+        while True:
+            s, addr = self.listening_socket.accept()
+            t = threading.Thread(target=self._serve,args=(s,))
+            t.setDaemon(True)
+            t.start()
+
+    def _serve(self,s):
+        try:
+            self.serve(s)
+        except socket.error:
+            pass
+        finally:
+            s.close()
+
+
+class _EchoServer(_Server):
+    def serve(self,s):
+        while True:
+            data = s.recv(65536)
+            if len(data) == 0:
+                return
+            s.sendall(data)
+
+
+class _SinkServer(_Server):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.bytes_received = 0
+        self.first_byte_time = None
+        self.last_byte_time = None
+        super(_SinkServer,self).__init__()
+
+    def serve(self,s):
+        buf = bytearray(1024 * 1024)
+        while True:
+            num_read = s.recv_into(buf)
+            if num_read == 0:
+                return
+            now = monotonic()
+            with self.condition:
+                if self.first_byte_time is None:
+                    self.first_byte_time = now
+                self.last_byte_time = now
+                self.bytes_received += num_read
+                self.condition.notify_all()
+
+    def wait_for_bytes(self,num_bytes,timeout_seconds):
+        '''
+        @returns {bool} --- True if received num_bytes before
+        timeout_seconds passed.
+        '''
+        deadline = monotonic() + timeout_seconds
+        with self.condition:
+            while self.bytes_received < num_bytes:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def take_measurement(self):
+        '''
+        @returns {tuple} --- (bytes received, seconds between first
+        and last byte)
+        '''
+        with self.condition:
+            if self.first_byte_time is None:
+                return 0, 0.
+            return (
+                self.bytes_received,
+                self.last_byte_time - self.first_byte_time)
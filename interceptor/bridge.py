@@ -1,226 +1,1280 @@
+import collections
+import errno
+import fcntl
 import socket
 import threading
-import select
 import os
 import time
 import struct
+import termios
+
+from interceptor.capture import RecordKind
+from interceptor.engine import get_default_engine
+from interceptor.event_loop import EventLoop
+from interceptor.metrics import BridgeMetrics
+from interceptor.pool import UpstreamConnectionPool
+from interceptor.util import Backoff, HostPortPair, wait_readable
+from interceptor import splice
+
+DEFAULT_LISTEN_BACKLOG = 128
+DEFAULT_RECV_BUFFER_SIZE = 64 * 1024
+# a pair stops reading once the socket it sends to has not yet taken
+# this many reads' worth of what its plan sent.
+MAX_HELD_READS = 4
+
+# when a socket becomes readable, read from it at most this many
+# times before going back to select, so that one busy connection
+# cannot starve the others on an event loop.
+MAX_READS_PER_READABLE = 16
+
+# python 2's socket module does not define it.  15 on linux.
+_SO_REUSEPORT = getattr(socket,'SO_REUSEPORT',15)
 
 class Bridge(object):
 
     def __init__(self,to_listen_on_host_port_pair,
                  one_direction_plan,
                  to_connect_to_host_port_pair,
-                 other_direction_plan):
+                 other_direction_plan,
+                 engine=None,
+                 recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE,
+                 upstream_pool_size=0,
+                 reuse_port=False,
+                 capture=None,
+                 plan_factories=None):
         '''
         @param {HostPortPair} to_listen_on_host_port_pair ---
 
         @param {HostPortPair} to_connect_to_host_port_pair --- When
         get a connection, forward traffic to
+
+        @param {Engine or None} engine --- Reads from this bridge's
+        sockets.  If None, use the default engine when a connection
+        starts.
+
+        @param {int} recv_buffer_size --- Most bytes to read from a
+        socket at once.  Each direction of each connection
+        preallocates a buffer this big.
+
+        @param {int} upstream_pool_size --- If positive, keep this many
+        connections to to_connect_to_host_port_pair open ahead of
+        time, starting once we listen, so that accepted clients are
+        paired without waiting for a handshake.
+
+        @param {bool} reuse_port --- If True, set SO_REUSEPORT before
+        binding, so that bridges in several processes can listen on
+        the same port, and the kernel spreads clients across them.
+
+        @param {CaptureWriter or None} capture --- If not None, record
+        every chunk read from either side of every connection, and
+        when connections open and close.  Capturing needs the bytes in
+        python, so turns off splicing for this bridge.
+
+        @param {tuple or None} plan_factories --- If not None,
+        (one_direction_plan_factory, other_direction_plan_factory),
+        each taking no arguments and returning a new Plan, and
+        one_direction_plan and other_direction_plan should be None.
+        The plans are then made when the first client connects, so a
+        bridge that never gets a client never makes them.
         '''
         self.to_listen_on_host_port_pair = to_listen_on_host_port_pair
         self.to_connect_to_host_port_pair = to_connect_to_host_port_pair
         self.one_direction_plan = one_direction_plan
         self.other_direction_plan = other_direction_plan
-        
-        self.to_listen_on_socket = None
-        self.to_connect_to_socket = None
-        self.to_listen_on_socket_signal_pipe = None
-        self.to_connect_to_socket_signal_pipe = None
-        
-        # we want to guarantee that we bring a set of connections down
-        # just once for a pair of to_listen_on_socket and
-        # to_connect_to_socket.
-        self.last_connection_lock = threading.RLock()
-        self.last_connection_phase_number = 0
+        self.plan_factories = plan_factories
+        self.engine = engine
+        self.recv_buffer_size = recv_buffer_size
+        self.reuse_port = reuse_port
+        self.capture = capture
+        self.metrics = BridgeMetrics()
+        self.upstream_pool = None
+        if upstream_pool_size > 0:
+            self.upstream_pool = UpstreamConnectionPool(
+                to_connect_to_host_port_pair,upstream_pool_size)
+
+        # the connection that we are currently forwarding for.  None
+        # if we have not yet accepted a connection.
+        self.connection = None
 
         self.connection_setup_times = 0
         self.bound_socket = None
-        
+        self.bound_socket_lock = threading.Lock()
+        # set by close.  A closed bridge accepts no more clients.
+        self.closed = False
+        # passed to listen.
+        self.listen_backlog = 1
+        # ConnectionListeners, told as connections start and stop.
+        self.connection_listeners = []
+
+        # calls to connection_setup that non_blocking_connection_setup
+        # asked for but that setup_thread has not started yet.
+        self.setup_condition = threading.Condition()
+        self.setups_requested = 0
+        self.setup_thread = None
+        # True once the shared accept loop watches bound_socket for
+        # our first client.  From then on, bound_socket is only closed
+        # from that loop, so it never sees the fd reused.
+        self.uses_accept_loop = False
+
     def non_blocking_connection_setup(self):
         '''
-        Calls connection_setup in separate thread.
+        Calls connection_setup in a separate thread.  The same thread
+        is reused for every call, one after another, so bringing a
+        connection back up does not start a new thread.
+
+        The thread is only started once the first client is waiting to
+        be accepted.  Until then, one loop shared by every bridge
+        watches for clients, so bridges that are idle cost no threads.
         '''
-        t = threading.Thread(target = self.connection_setup)
-        t.setDaemon(True)
-        t.start()
-        
-        
+        with self.setup_condition:
+            self.setups_requested += 1
+            self.setup_condition.notify()
+            if (self.setup_thread is not None) or self.uses_accept_loop:
+                return
+            self.uses_accept_loop = True
+        try:
+            self.listen(self.listen_backlog)
+        except socket.error:
+            # let the setup thread report it, as if we had no loop.
+            with self.setup_condition:
+                self.uses_accept_loop = False
+            self._start_setup_thread()
+            return
+        _get_accept_loop().call_soon_threadsafe(self._await_first_client)
+
+    def _await_first_client(self):
+        '''
+        Runs on the accept loop.
+        '''
+        with self.bound_socket_lock:
+            if self.closed:
+                return
+            _get_accept_loop().add_reader(
+                self.bound_socket,self._on_first_client)
+
+    def _on_first_client(self):
+        '''
+        Runs on the accept loop.
+        '''
+        _get_accept_loop().remove_reader(self.bound_socket)
+        self._start_setup_thread()
+
+    def _start_setup_thread(self):
+        with self.setup_condition:
+            if self.setup_thread is not None:
+                return
+            self.setup_thread = threading.Thread(target=self._setup_loop)
+            self.setup_thread.setDaemon(True)
+            self.setup_thread.start()
+
+    def _setup_loop(self):
+        while True:
+            with self.setup_condition:
+                while self.setups_requested == 0:
+                    self.setup_condition.wait()
+                self.setups_requested -= 1
+            try:
+                self.connection_setup()
+            except socket.error:
+                if self.closed:
+                    # close woke us from accept.
+                    return
+                raise
+
+    def close(self,close_connections=False):
+        '''
+        Stop listening and accepting clients.  Safe to call from any
+        thread, and more than once.
+
+        @param {bool} close_connections --- If True, also bring down
+        every connection being forwarded, on the engine's thread if it
+        has one.  Otherwise they keep forwarding until they go down on
+        their own.
+        '''
+        with self.bound_socket_lock:
+            self.closed = True
+            bound_socket = self.bound_socket
+        if bound_socket is not None:
+            try:
+                # wakes threads blocked in accept; close does not.
+                bound_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            with self.setup_condition:
+                uses_accept_loop = self.uses_accept_loop
+            if uses_accept_loop:
+                _get_accept_loop().call_soon_threadsafe(
+                    _close_watched_socket,bound_socket)
+            else:
+                bound_socket.close()
+        if self.upstream_pool is not None:
+            self.upstream_pool.close()
+        if close_connections:
+            for connection in self.current_connections():
+                self.engine.close_connection(connection)
+
+    def swap_plans(self,one_direction_plan_factory,
+                   other_direction_plan_factory):
+        '''
+        Forward with new plans from now on, including on the
+        connections being forwarded right now, without interrupting
+        them.  Data the old plans hold is still sent, before anything
+        the new plans forward.  Safe to call from any thread.
+
+        @param {function} one_direction_plan_factory,
+        other_direction_plan_factory --- Take no arguments and return
+        a new Plan.
+        '''
+        with self.bound_socket_lock:
+            if (self.plan_factories is not None) and (
+                self.one_direction_plan is None):
+                # no client yet: stay lazy.
+                self.plan_factories = (
+                    one_direction_plan_factory,other_direction_plan_factory)
+                return
+        one_direction_plan = one_direction_plan_factory()
+        other_direction_plan = other_direction_plan_factory()
+        with self.bound_socket_lock:
+            self.one_direction_plan = one_direction_plan
+            self.other_direction_plan = other_direction_plan
+            connection = self.connection
+        if connection is not None:
+            connection.swap_plans(one_direction_plan,other_direction_plan)
+
     def connection_setup(self):
         '''
         Listen for a connection.  When receive connection, try to
         connect to other side.  Blocking.
         '''
-        # print '\nInterceptor connection setup\n'
+        to_listen_on_socket = self.accept_client()
+        to_connect_to_socket = self.connect_upstream()
+        with self.bound_socket_lock:
+            if self.one_direction_plan is None:
+                one_direction_plan_factory, other_direction_plan_factory = (
+                    self.plan_factories)
+                self.one_direction_plan = one_direction_plan_factory()
+                self.other_direction_plan = other_direction_plan_factory()
+            # swap_plans may have replaced the plans while we waited.
+            one_direction_plan = self.one_direction_plan
+            other_direction_plan = self.other_direction_plan
+        self.connection = self.start_connection(
+            to_listen_on_socket,to_connect_to_socket,
+            one_direction_plan,other_direction_plan)
+
+    def add_connection_listener(self,listener):
+        '''
+        @param {ConnectionListener} listener --- Told about each
+        connection that starts or is brought down from now on.  Add
+        before listening to hear about every connection.
+        '''
+        self.connection_listeners.append(listener)
+
+    def listen(self,backlog):
+        '''
+        Bind and listen on to_listen_on_host_port_pair, if we haven't
+        already.  Safe to call multiple times.
+        '''
+        with self.bound_socket_lock:
+            if self.closed:
+                raise socket.error(errno.EBADF,'Bridge is closed')
+            if self.connection_setup_times == 0:
+                self.connection_setup_times += 1
+                self.bound_socket = socket.socket(
+                    socket.AF_INET, socket.SOCK_STREAM)
+                self.bound_socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuse_port:
+                    self.bound_socket.setsockopt(
+                        socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+                self.bound_socket.bind(
+                    self.to_listen_on_host_port_pair.host_port_tuple())
+                if self.upstream_pool is not None:
+                    self.upstream_pool.start()
+            self.bound_socket.listen(backlog)
+
+    def listening_host_port_pair(self):
+        '''
+        Only call after listen.
+
+        @returns {HostPortPair} --- What we are bound to.  Has the port
+        the kernel picked if to_listen_on_host_port_pair's port is 0.
+        '''
+        host, port = self.bound_socket.getsockname()[:2]
+        return HostPortPair(host,port)
         
-        pipe = os.pipe()
-        read_pipe_listen_on = pipe[0]
-        self.to_listen_on_socket_signal_pipe = pipe[1]
-
-        pipe = os.pipe()
-        read_pipe_connect_to = pipe[0]
-        self.to_connect_to_socket_signal_pipe = pipe[1]
-
-        if self.connection_setup_times == 0:
-            self.connection_setup_times += 1
-            self.bound_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.bound_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.bound_socket.bind(self.to_listen_on_host_port_pair.host_port_tuple())
-
-        # print 'Interceptor listening ' + str(self)
-        self.bound_socket.listen(1)
-        self.to_listen_on_socket, addr = self.bound_socket.accept()
-
-        # print 'Interceptor accepted ' + str(self)
-
-        l_onoff = 1
-        l_linger = 0
-        self.to_listen_on_socket.setsockopt(
-            socket.SOL_SOCKET, socket.SO_LINGER,
-            struct.pack('ii', l_onoff, l_linger))
-
-        self.to_listen_on_socket.setsockopt(
-            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                
-        # print (
-        #     '\nInterceptor trying to connect to ' +
-        #     str(self.to_connect_to_host_port_pair.host_port_tuple()) +
-        #     ' '  + str(self))
-            
-        while True:
+    def accept_client(self):
+        '''
+        Blocks until a client connects to the interposing port.
+
+        @returns {socket} --- Accepted, configured client socket.
+        '''
+        self.listen(self.listen_backlog)
+        to_listen_on_socket, addr = self.bound_socket.accept()
+        _configure_forwarding_socket(to_listen_on_socket)
+        return to_listen_on_socket
+
+    def connect_upstream(self):
+        '''
+        Blocks until we can connect to to_connect_to_host_port_pair.
+        Takes a connection from the upstream pool if it has one ready.
+
+        @returns {socket} --- Connected, configured upstream socket.
+        '''
+        to_connect_to_socket = None
+        if self.upstream_pool is not None:
+            to_connect_to_socket = self.upstream_pool.get()
+
+        backoff = Backoff()
+        while to_connect_to_socket is None:
+            to_connect_to_socket = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM)
             try:
-                self.to_connect_to_socket = socket.socket(
-                    socket.AF_INET, socket.SOCK_STREAM)
-                self.to_connect_to_socket.connect(
+                to_connect_to_socket.connect(
                     self.to_connect_to_host_port_pair.host_port_tuple())
-                break
             except Exception as inst:
-                time.sleep(.5)
-            
-        # print (
-        #     '\nInterceptor connected ' +
-        #     str(self.to_connect_to_host_port_pair.host_port_tuple()) +
-        #     ' '  + str(self))
-        
-        self.to_connect_to_socket.setsockopt(
-            socket.SOL_SOCKET, socket.SO_LINGER,
-            struct.pack('ii', l_onoff, l_linger))
+                to_connect_to_socket.close()
+                to_connect_to_socket = None
+                time.sleep(backoff.next_delay())
 
-        self.to_connect_to_socket.setsockopt(
-            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        
-        with self.last_connection_lock:
-            self.last_connection_phase_number = (
-                self.last_connection_phase_number + 1)
+        _configure_forwarding_socket(to_connect_to_socket)
+        return to_connect_to_socket
+
+    def start_connection(self,to_listen_on_socket,to_connect_to_socket,
+                         one_direction_plan,other_direction_plan):
+        '''
+        Start forwarding messages between both sides.
+
+        @returns {_BridgeConnection}
+        '''
+        if self.engine is None:
+            self.engine = get_default_engine()
+        self.metrics.connection_accepted()
+        connection = _BridgeConnection(
+            self,to_listen_on_socket,to_connect_to_socket,
+            one_direction_plan,other_direction_plan)
+        connection.start()
+        for listener in self.connection_listeners:
+            listener.connection_started(connection)
+        return connection
         
-            # now start forwarding messages between both sides
-            pair_one = _SendReceiveSocketPair(
-                self.to_listen_on_socket,read_pipe_listen_on,
-                self.to_connect_to_socket,
-                self.one_direction_plan,self,
-                self.last_connection_phase_number)
+    def connection_closed(self,connection):
+        '''
+        Called exactly once for each connection, after it has been
+        brought down.  A single-connection bridge brings the
+        connection back up by listening for a new client.
+        '''
+        if not self.closed:
+            self.non_blocking_connection_setup()
+
+    def current_plans(self):
+        '''
+        @returns {list} --- Plans of the connections being forwarded
+        right now.  Empty if the plans have not been made yet.
+        '''
+        if self.one_direction_plan is None:
+            return []
+        return [self.one_direction_plan,self.other_direction_plan]
+
+    def current_connections(self):
+        '''
+        @returns {list} --- _BridgeConnections being forwarded right
+        now.
+        '''
+        connection = self.connection
+        if (connection is None) or connection.closed:
+            return []
+        return [connection]
+
+    def drained(self):
+        '''
+        @returns {bool} --- True if no connection being forwarded right
+        now holds data: none is waiting in the kernel to be read, and
+        every plan has sent everything it will send on its own.
+        '''
+        for connection in self.current_connections():
+            if not connection.drained():
+                return False
+        return True
+
+
+class ConnectionListener(object):
+    '''
+    Told by a bridge as its connections start and stop.  Called from
+    the bridge's threads, so should return quickly.
+    '''
+    def connection_started(self,connection):
+        '''
+        @param {_BridgeConnection} connection --- Connected on both
+        sides and forwarding.
+        '''
+
+    def connection_closed(self,connection,error):
+        '''
+        Called once for each connection, after it has been brought
+        down.
+
+        @param {Exception or None} error --- What brought it down, if
+        not a side closing it or the bridge being closed.
+        '''
+
+
+class MultiConnectionBridge(Bridge):
+    '''
+    Accepts any number of concurrent clients on the interposing port.
+    Each accepted client gets its own upstream connection and its own
+    pair of plans.  When one connection fails, only that connection
+    is torn down; the others keep forwarding.
+    '''
+    def __init__(self,to_listen_on_host_port_pair,
+                 one_direction_plan_factory,
+                 to_connect_to_host_port_pair,
+                 other_direction_plan_factory,
+                 listen_backlog=DEFAULT_LISTEN_BACKLOG,
+                 engine=None,
+                 recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE,
+                 upstream_pool_size=0,
+                 reuse_port=False,
+                 capture=None):
+        '''
+        @param {function} one_direction_plan_factory,
+        other_direction_plan_factory --- Take no arguments and return
+        a new Plan.  Called once per accepted connection.
+
+        @param {int} listen_backlog --- Passed to listen.
+
+        @param {Engine or None} engine, {int} recv_buffer_size, {int}
+        upstream_pool_size, {bool} reuse_port, {CaptureWriter or None}
+        capture --- See Bridge.
+        '''
+        super(MultiConnectionBridge,self).__init__(
+            to_listen_on_host_port_pair,None,
+            to_connect_to_host_port_pair,None,engine,recv_buffer_size,
+            upstream_pool_size,reuse_port,capture)
+        self.one_direction_plan_factory = one_direction_plan_factory
+        self.other_direction_plan_factory = other_direction_plan_factory
+        self.listen_backlog = listen_backlog
+
+        # all connections that are currently forwarding.
+        self.connections_lock = threading.Lock()
+        self.connections = set()
 
-            pair_one.start()
-            pair_two = _SendReceiveSocketPair(
-                self.to_connect_to_socket,read_pipe_connect_to,
-                self.to_listen_on_socket,
+    def connection_setup(self):
+        '''
+        Accept clients forever.  Connecting to the other side happens
+        in a separate thread for each client so that a slow upstream
+        never holds up accepting.  Blocking.
+        '''
+        self.listen(self.listen_backlog)
+        while True:
+            try:
+                to_listen_on_socket, addr = self.bound_socket.accept()
+            except socket.error:
+                if self.closed:
+                    return
+                raise
+            _configure_forwarding_socket(to_listen_on_socket)
+            t = threading.Thread(
+                target=self._connect_and_start,
+                args=(to_listen_on_socket,))
+            t.setDaemon(True)
+            t.start()
+
+    def _connect_and_start(self,to_listen_on_socket):
+        to_connect_to_socket = self.connect_upstream()
+        with self.connections_lock:
+            connection = self.start_connection(
+                to_listen_on_socket,to_connect_to_socket,
+                self.one_direction_plan_factory(),
+                self.other_direction_plan_factory())
+            self.connections.add(connection)
+
+    def swap_plans(self,one_direction_plan_factory,
+                   other_direction_plan_factory):
+        '''
+        New connections get plans from the new factories.  Each
+        connection being forwarded right now gets a new plan from each,
+        as in Bridge.swap_plans.
+        '''
+        with self.connections_lock:
+            self.one_direction_plan_factory = one_direction_plan_factory
+            self.other_direction_plan_factory = other_direction_plan_factory
+            connections = list(self.connections)
+        for connection in connections:
+            connection.swap_plans(
+                one_direction_plan_factory(),other_direction_plan_factory())
+
+    def current_connections(self):
+        with self.connections_lock:
+            return list(self.connections)
+
+    def connection_closed(self,connection):
+        with self.connections_lock:
+            self.connections.discard(connection)
+
+    def current_plans(self):
+        plans = []
+        with self.connections_lock:
+            for connection in self.connections:
+                plans.append(connection.one_direction_plan)
+                plans.append(connection.other_direction_plan)
+        return plans
+
+
+class _BridgeConnection(object):
+    '''
+    A single accepted client, its upstream connection, and the two
+    _SendReceiveSocketPairs forwarding between them.
+    '''
+    def __init__(self,bridge,to_listen_on_socket,to_connect_to_socket,
+                 one_direction_plan,other_direction_plan):
+        self.bridge = bridge
+        self.to_listen_on_socket = to_listen_on_socket
+        self.to_connect_to_socket = to_connect_to_socket
+        self.one_direction_plan = one_direction_plan
+        self.other_direction_plan = other_direction_plan
+
+        # we want to guarantee that we bring a connection down just
+        # once, even though both of its pairs may notice it failing.
+        self.lock = threading.RLock()
+        self.closed = False
+
+        self.capture_id = None
+        if bridge.capture is not None:
+            self.capture_id = bridge.capture.new_connection_id()
+
+        self.pairs = (
+            _SendReceiveSocketPair(
+                self.to_listen_on_socket,self.to_connect_to_socket,
+                self.one_direction_plan,self,
+                BridgeMetrics.ONE_DIRECTION),
+            _SendReceiveSocketPair(
+                self.to_connect_to_socket,self.to_listen_on_socket,
                 self.other_direction_plan,self,
-                self.last_connection_phase_number)
-            pair_two.start()
+                BridgeMetrics.OTHER_DIRECTION))
+        # pairs that have not yet released their resources.  Sockets
+        # are closed once the connection is down and this reaches 0,
+        # so no thread is ever using a closed (and maybe reused) fd.
+        self.live_pairs = len(self.pairs)
+
+    def start(self):
+        if self.capture_id is not None:
+            self.bridge.capture.write(
+                self.capture_id,BridgeMetrics.ONE_DIRECTION,
+                RecordKind.OPEN)
+        for pair in self.pairs:
+            self.bridge.engine.start_pair(pair)
 
-        
     def bring_down_connection(self):
         '''
         Should only be called after both connections have already been
         made and started.  And should only be called once.
         '''
-        self.one_direction_plan.notify_closed()
-        self.other_direction_plan.notify_closed()
+        for pair in self.pairs:
+            pair.notify_plans_closed()
 
-        try:
-            self.to_listen_on_socket.close()
-        except:
-            print 'Exception closing to listen on socket'
-        
-        try:
-            os.write(self.to_listen_on_socket_signal_pipe,'x')
-            os.close(self.to_listen_on_socket_signal_pipe)
-        except Exception as inst:
-            print 'Exception closing pipe 1'
-            print inst
-        
-        try:
-            self.to_connect_to_socket.close()
-        except Exception as inst:
-            print 'Exception closing to connect to socket'
-            pass
+        # wakes any pair blocked in poll on these sockets: they
+        # become readable, and reads return nothing.  Unlike SHUT_WR
+        # or SHUT_RDWR, sends nothing to the other sides, so they
+        # still see a reset when the sockets are closed.
+        for sock in (self.to_listen_on_socket,self.to_connect_to_socket):
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except socket.error:
+                # already reset by the other side.
+                pass
 
-        try:
-            os.write(self.to_connect_to_socket_signal_pipe,'x')
-            os.close(self.to_connect_to_socket_signal_pipe)
-        except:
-            print 'Exception closing pipe 2'
-            print inst
-        
+        for pair in self.pairs:
+            self.bridge.engine.stop_pair(pair)
+        self._close_sockets_if_released()
+
+    def pair_released(self):
+        '''
+        Called once by each pair when nothing will read from its
+        socket again.
+        '''
+        with self.lock:
+            self.live_pairs -= 1
+            self._close_sockets_if_released()
 
-    def down_up_connection(self,phase_number):
+    def _close_sockets_if_released(self):
+        '''
+        Must hold lock.
         '''
-        Bring connection down and then bring it up again.
+        if (not self.closed) or (self.live_pairs != 0):
+            return
+        for sock in (self.to_listen_on_socket,self.to_connect_to_socket):
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def swap_plans(self,one_direction_plan,other_direction_plan):
         '''
-        with self.last_connection_lock:
-            if phase_number != self.last_connection_phase_number:
+        Forward with new plans without interrupting the connection.
+        See _SendReceiveSocketPair.swap_plan.
+        '''
+        with self.lock:
+            if self.closed:
                 return
+            self.one_direction_plan = one_direction_plan
+            self.other_direction_plan = other_direction_plan
+            self.pairs[0].swap_plan(one_direction_plan)
+            self.pairs[1].swap_plan(other_direction_plan)
+
+    def drained(self):
+        '''
+        @returns {bool} --- See Bridge.drained.
+        '''
+        for pair in self.pairs:
+            if not pair.drained():
+                return False
+        return True
 
-            self.last_connection_phase_number += 1
+    def down_up_connection(self,error=None):
+        '''
+        Bring connection down and tell the bridge, which may bring a
+        new one up.  Only the first call for a connection has any
+        effect.
 
+        @param {Exception or None} error --- What brought the
+        connection down, if anything went wrong.
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+
+            self.bridge.metrics.connection_brought_down()
+            if self.capture_id is not None:
+                self.bridge.capture.write(
+                    self.capture_id,BridgeMetrics.ONE_DIRECTION,
+                    RecordKind.CLOSE)
             self.bring_down_connection()
-            self.non_blocking_connection_setup()
-        
+        for listener in self.bridge.connection_listeners:
+            listener.connection_closed(self,error)
+        self.bridge.connection_closed(self)
+
+
+_accept_loop = None
+_accept_loop_lock = threading.Lock()
+
+def _get_accept_loop():
+    '''
+    @returns {EventLoop} --- Shared by every bridge to watch for first
+    clients.  Started the first time it is needed.
+    '''
+    global _accept_loop
+    with _accept_loop_lock:
+        if _accept_loop is None:
+            _accept_loop = EventLoop()
+            _accept_loop.start()
+        return _accept_loop
+
+
+def _close_watched_socket(sock):
+    '''
+    Runs on the accept loop.
+    '''
+    _get_accept_loop().remove_reader(sock)
+    sock.close()
+
+
+def _configure_forwarding_socket(sock):
+    l_onoff = 1
+    l_linger = 0
+    sock.setsockopt(
+        socket.SOL_SOCKET, socket.SO_LINGER,
+        struct.pack('ii', l_onoff, l_linger))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # neither reading nor writing may block an event loop or the
+    # delay scheduler: pairs read until EAGAIN, and outlets hold what
+    # the socket cannot take.  Splice too, which ignores
+    # SPLICE_F_NONBLOCK on the socket end.
+    sock.setblocking(False)
+
+
+class _SocketOutlet(object):
+    '''
+    Handed to a pair's plan in place of the socket it sends to.
+    Sending never blocks: whatever the socket cannot take right away
+    is held, in order, and written from the engine's write loop as the
+    socket drains.  That includes bytes spliced into the pair's pipe.
+    So a receiver that stops reading holds up only its own
+    connection, never an event loop or the delay scheduler.  The pair
+    stops reading while too much is held.
+    '''
+    def __init__(self,pair,engine,max_held_bytes):
+        '''
+        @param {_SendReceiveSocketPair} pair --- Sends to
+        pair.socket_to_send_to.  Resumed when held bytes drop below
+        max_held_bytes, and brought down if a held write fails.
+
+        @param {Engine} engine --- Its write loop waits for the socket
+        to be writable.  Only asked for once something is held.
+        '''
+        self.pair = pair
+        self.sock = pair.socket_to_send_to
+        self.engine = engine
+        self.max_held_bytes = max_held_bytes
+
+        # sendall can be called from the pair's thread, the delay
+        # scheduler's, and the loop's.
+        self.lock = threading.Lock()
+        # what the socket has not taken yet, in order: strings, or ints
+        # counting bytes waiting in pipe_read_fd.
+        self.held = collections.deque()
+        self.pipe_read_fd = None
+        self.held_bytes = 0
+        # True from when something is first held until all of it has
+        # been written.  While True, the loop is, or is about to be,
+        # waiting for the socket to be writable.
+        self.writing = False
+        self.closed = False
+        # called on the loop once nothing is held.  See call_when_sent.
+        self.sent_callback = None
+
+    def sendall(self,data):
+        '''
+        @throws socket.error if the socket has failed, or the outlet is
+        closed.
+        '''
+        with self.lock:
+            if self.closed:
+                raise socket.error(errno.EPIPE,'Connection is closed')
+            if not self.writing:
+                num_sent = self._send(data)
+                if num_sent == len(data):
+                    return
+                data = data[num_sent:]
+            self.held.append(data)
+            self.held_bytes += len(data)
+            start_writing = not self.writing
+            self.writing = True
+        if start_writing:
+            self.engine.write_loop().call_soon_threadsafe(
+                self._start_writing)
+
+    def send_from_pipe(self,pipe_read_fd,num_bytes):
+        '''
+        Like sendall, for num_bytes waiting in a pipe.  The pipe must
+        stay open, and nothing else may read from it, until they have
+        been sent or the outlet is closed.
+
+        @throws OSError if the socket has failed, or the outlet is
+        closed.
+        '''
+        with self.lock:
+            if self.closed:
+                raise OSError(errno.EPIPE,'Connection is closed')
+            self.pipe_read_fd = pipe_read_fd
+            if not self.writing:
+                num_bytes -= self._splice(num_bytes)
+                if num_bytes == 0:
+                    return
+            self.held.append(num_bytes)
+            self.held_bytes += num_bytes
+            start_writing = not self.writing
+            self.writing = True
+        if start_writing:
+            self.engine.write_loop().call_soon_threadsafe(
+                self._start_writing)
+
+    def accepting_data(self):
+        return self.held_bytes < self.max_held_bytes
+
+    def empty(self):
+        '''
+        @returns {bool} --- True if the socket has taken everything
+        sent so far.
+        '''
+        return not self.writing
+
+    def call_when_sent(self,callback):
+        '''
+        Call callback, on the loop, once the socket has taken
+        everything sent so far.  Not called if the outlet is closed
+        first.
+        '''
+        with self.lock:
+            if self.writing:
+                self.sent_callback = callback
+                return
+        self.engine.write_loop().call_soon_threadsafe(callback)
+
+    def close_after(self,seconds):
+        '''
+        Bring the pair's connection down, as if its plan's recv had
+        returned seconds, for plans that decide to outside of recv.
+        The pair reads nothing more, and the socket still gets
+        everything sent before.  Safe to call from any thread.
+        '''
+        self.pair.closing = True
+        self.engine.write_loop().call_soon_threadsafe(
+            self._close_after,seconds)
+
+    def close(self,released_callback):
+        '''
+        Drop whatever is held, and stop writing.
+
+        @param {function} released_callback --- Called once the loop
+        will no longer touch the socket.
+        '''
+        with self.lock:
+            self.closed = True
+            self.held.clear()
+            self.held_bytes = 0
+            self.sent_callback = None
+            writing = self.writing
+            self.writing = False
+        if not writing:
+            released_callback()
+            return
+        loop = self.engine.write_loop()
+        if loop.in_loop_thread():
+            self._stop_writing(released_callback)
+        else:
+            loop.call_soon_threadsafe(self._stop_writing,released_callback)
+
+    def _send(self,data):
+        '''
+        Must hold lock.
+
+        @returns {int} --- Number of bytes of data the socket took
+        without blocking.
+        '''
+        try:
+            return self.sock.send(data)
+        except socket.error as inst:
+            if inst.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def _splice(self,num_bytes):
+        '''
+        Must hold lock.
+
+        @returns {int} --- Number of the num_bytes waiting in
+        pipe_read_fd that the socket took without blocking.
+        '''
+        to_fd = self.sock.fileno()
+        num_sent = 0
+        while num_sent < num_bytes:
+            try:
+                num_moved = splice.splice(
+                    self.pipe_read_fd,to_fd,num_bytes - num_sent,
+                    splice.SPLICE_F_MOVE | splice.SPLICE_F_NONBLOCK)
+            except OSError as inst:
+                if inst.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    break
+                raise
+            if num_moved == 0:
+                break
+            num_sent += num_moved
+        return num_sent
+
+    def _close_after(self,seconds):
+        '''
+        Runs on the loop.
+        '''
+        self.engine.write_loop().call_later(
+            seconds,self.call_when_sent,
+            self.pair.connection.down_up_connection)
+
+    def _start_writing(self):
+        '''
+        Runs on the loop.
+        '''
+        with self.lock:
+            if not self.writing:
+                # closed meanwhile.
+                return
+        self.engine.write_loop().add_writer(self.sock,self._on_writable)
+
+    def _stop_writing(self,released_callback):
+        '''
+        Runs on the loop.
+        '''
+        self.engine.write_loop().remove_writer(self.sock)
+        released_callback()
+
+    def _on_writable(self):
+        '''
+        Runs on the loop.
+        '''
+        error = None
+        done = False
+        sent_callback = None
+        with self.lock:
+            if not self.writing:
+                return
+            was_accepting = self.accepting_data()
+            try:
+                while self.held:
+                    data = self.held[0]
+                    if isinstance(data,int):
+                        num_sent = self._splice(data)
+                        self.held_bytes -= num_sent
+                        if num_sent < data:
+                            self.held[0] = data - num_sent
+                            break
+                        self.held.popleft()
+                        continue
+
+                    # one write instead of many small ones.
+                    num_strings = 1
+                    while ((num_strings < len(self.held)) and
+                           (not isinstance(self.held[num_strings],int))):
+                        num_strings += 1
+                    if num_strings > 1:
+                        data = ''.join(
+                            self.held.popleft()
+                            for i in range(0,num_strings))
+                        self.held.appendleft(data)
+                    num_sent = self._send(data)
+                    self.held_bytes -= num_sent
+                    if num_sent < len(data):
+                        self.held[0] = data[num_sent:]
+                        break
+                    self.held.popleft()
+            except (socket.error,OSError) as inst:
+                error = inst
+                # nothing more will go out.
+                self.held.clear()
+                self.held_bytes = 0
+            if (error is None) and (not self.held):
+                self.writing = False
+                done = True
+                sent_callback = self.sent_callback
+                self.sent_callback = None
+            resume = (not was_accepting) and self.accepting_data()
+
+        if error is not None:
+            # close removes us too, but we should not keep waking up
+            # until it does.
+            self.engine.write_loop().remove_writer(self.sock)
+            self.pair.print_exception(error)
+            self.pair.connection.down_up_connection(error)
+            return
+        if done:
+            # a sendall since will add us back.
+            self.engine.write_loop().remove_writer(self.sock)
+        if resume:
+            self.pair.resume()
+        if sent_callback is not None:
+            sent_callback()
+    
         
 class _SendReceiveSocketPair(object):
-    def __init__(self,socket_to_listen_on,
-                 close_on_selector_pipe,
-                 socket_to_send_to,plan,bridge,
-                 connection_phase_number):
+    def __init__(self,socket_to_listen_on,socket_to_send_to,plan,
+                 connection,direction_index):
+        '''
+        @param {int} direction_index --- BridgeMetrics.ONE_DIRECTION
+        or BridgeMetrics.OTHER_DIRECTION.
+        '''
         self.socket_to_listen_on = socket_to_listen_on
-        self.close_on_selector_pipe = close_on_selector_pipe
         self.socket_to_send_to = socket_to_send_to
         self.plan = plan
-        self.bridge = bridge
-        self.connection_phase_number = connection_phase_number
-        
-    def start(self):
-        t = threading.Thread(target=self.run)
-        t.setDaemon(True)
-        t.start()
+        self.connection = connection
+        self.buffer_size = connection.bridge.recv_buffer_size
+        self.direction_index = direction_index
+        self.metrics = connection.bridge.metrics.new_direction(
+            direction_index)
+        self.capture = connection.bridge.capture
+
+        # plans that never look at the bytes they forward let us move
+        # them in the kernel, through this pipe, instead of copying
+        # them through python.  Made when first needed.
+        self.splice_pipe = None
+        self.can_splice = (
+            (self.capture is None) and splice.splice_available())
+
+        # reused for every read in this direction.  Allocated when
+        # first needed.
+        self.recv_buffer = None
+        self.recv_buffer_view = None
+
+        # what the plan sends to.
+        self.outlet = _SocketOutlet(
+            self,connection.bridge.engine,MAX_HELD_READS * self.buffer_size)
+        # set once the connection is to be brought down, eg., as soon
+        # as the outlet is empty.  We read nothing more meanwhile.
+        self.closing = False
+
+        # set when the plan may be accepting data again, or when the
+        # connection is brought down.  Used by ThreadedEngine.
+        self.resume_event = threading.Event()
+        plan.set_resume_callback(self.resume)
+        self.released = False
+
+        # plan to switch to once plan is idle.  See swap_plan.
+        self.next_plan = None
+        # bytes the previous plan held when we switched from it, to
+        # hand to plan before anything else.
+        self.carryover = ''
+        # True while handle_readable may hold bytes it has read but
+        # not yet handed to the plan.  See drained.
+        self.reading = False
         
     def run(self):
+        '''
+        Forward in the calling thread until the connection is brought
+        down.  Used by ThreadedEngine.
+        '''
         try:
             while True:
-                (input_ready,_,_) = select.select(
-                    [self.socket_to_listen_on,self.close_on_selector_pipe],
-                    [],[])
+                if not self.accepting_data():
+                    self.wait_for_plan()
+                    if self.connection.closed:
+                        break
+                    continue
                 
-                if self.close_on_selector_pipe in input_ready:
-                    self.bridge.down_up_connection(self.connection_phase_number)
+                wait_readable(self.socket_to_listen_on)
+                # bring_down_connection makes the socket readable to
+                # wake us.
+                if self.connection.closed:
                     break
 
-                if self.socket_to_listen_on in input_ready:
-                    recv_data = self.socket_to_listen_on.recv(1024)
-                    if len(recv_data) == 0:
-                        self.bridge.down_up_connection(self.connection_phase_number)
-                        break
-
-                    recv_return = self.plan.recv(recv_data,self.socket_to_send_to)
-                    if recv_return is not None:
-                        time.sleep(recv_return)
-                        self.bridge.down_up_connection(self.connection_phase_number)
-                        break
+                seconds_before_close = self.handle_readable()
+                if seconds_before_close is not None:
+                    time.sleep(seconds_before_close)
+                    self.connection.down_up_connection()
+                    break
                     
         except Exception as inst:
-            # can happen if someone closes the selctor pipe before we
-            # go into select.
-            print (
-                '[DEBUG] Got an exception for ' + str(self.connection_phase_number) +
-                ' ' + str(inst) + ' on bridge ' + str(self.bridge) + ' for socket ' +
-                str(self.socket_to_send_to))
+            if not self.connection.closed:
+                self.print_exception(inst)
+                # like the event loop engine, don't leave the
+                # connection forwarding in just one direction.
+                self.connection.down_up_connection(inst)
+        finally:
+            self.release_resources()
+
+    def wait_for_plan(self):
+        '''
+        Block until the plan accepts data again or the connection is
+        brought down.  Data piles up in the kernel's socket buffers
+        meanwhile, and then the sender blocks.
+        '''
+        self.resume_event.clear()
+        # the plan may have resumed before we cleared the event.
+        if self.accepting_data() or self.connection.closed:
+            return
+        self.resume_event.wait()
+
+    def accepting_data(self):
+        '''
+        @returns {bool} --- False if we should stop reading until
+        resumed.
+        '''
+        if self.closing or (not self.outlet.accepting_data()):
+            return False
+        next_plan = self.next_plan
+        if next_plan is None:
+            return self.plan.accepting_data()
+        if not self.plan.idle():
+            # the new plan gets nothing until the old one has sent
+            # everything it holds, so bytes stay in order.
+            return False
+        return next_plan.accepting_data()
+
+    def swap_plan(self,plan):
+        '''
+        Forward with plan instead of the current one, from the next
+        read once the current one is idle.  Safe to call from any
+        thread.  Never blocks forwarding.
+        '''
+        plan.set_resume_callback(self.resume)
+        with self.connection.lock:
+            self.next_plan = plan
+        # a pair waiting on the old plan should check again.
+        self.resume()
+
+    def notify_plans_closed(self):
+        with self.connection.lock:
+            plans = [self.plan,self.next_plan]
+        for plan in plans:
+            if plan is not None:
+                plan.notify_closed()
+
+    def _switch_plan_if_ready(self):
+        '''
+        Called before reading.
+        '''
+        if self.next_plan is None:
+            return
+        with self.connection.lock:
+            if (self.next_plan is None) or (not self.plan.idle()):
+                return
+            self.carryover += self.plan.take_unsent()
+            self.plan = self.next_plan
+            self.next_plan = None
+
+    def drained(self):
+        '''
+        @returns {bool} --- True if nothing waits to be read from
+        socket_to_listen_on, and the plan holds nothing it will still
+        send.
+        '''
+        with self.connection.lock:
+            if self.connection.closed:
+                return True
+            try:
+                unread = struct.unpack('i',fcntl.ioctl(
+                        self.socket_to_listen_on.fileno(),termios.FIONREAD,
+                        struct.pack('i',0)))[0]
+            except (IOError,socket.error):
+                # the other side reset the socket.
+                unread = 0
+            # checked in the order bytes move, so bytes moving on
+            # while we check are still seen somewhere.
+            return ((unread == 0) and (not self.reading) and
+                    (self.next_plan is None) and (not self.carryover) and
+                    self.plan.idle() and self.outlet.empty())
+
+    def resume(self):
+        '''
+        Called by the plan, from any thread, when it accepts data
+        again.
+        '''
+        self.connection.bridge.engine.resume_pair(self)
+        
+    def release_resources(self):
+        '''
+        Called by the engine once nothing will read on this pair
+        again.  Only the first call has any effect.
+        '''
+        with self.connection.lock:
+            if self.released:
+                return
+            self.released = True
+        self.connection.bridge.metrics.retire_direction(self.metrics)
+        # the outlet may be splicing from the pipe until closed.
+        self.outlet.close(self.connection.pair_released)
+        self._close_splice_pipe()
+
+    def _close_splice_pipe(self):
+        if self.splice_pipe is not None:
+            for fd in self.splice_pipe:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self.splice_pipe = None
+
+    def handle_readable(self):
+        '''
+        Called when socket_to_listen_on is readable.  Keeps reading
+        from it and handing each read to the plan until the socket has
+        no more data, the plan stops accepting data, or
+        MAX_READS_PER_READABLE reads.
+
+        @returns {float or None} --- If None, keep forwarding.  If
+        float, wait for this number of seconds and then bring the
+        connection down.
+        '''
+        self.reading = True
+        try:
+            seconds_before_close = self._read_readable()
+        finally:
+            self.reading = False
+        if (seconds_before_close == 0) and (not self.outlet.empty()):
+            # let the socket take what was already sent, as a blocking
+            # sendall would have, before closing it.
+            self.closing = True
+            self.outlet.call_when_sent(self.connection.down_up_connection)
+            return None
+        return seconds_before_close
+
+    def _read_readable(self):
+        self._switch_plan_if_ready()
+        # spliced bytes go straight to the socket, so only once the
+        # outlet holds nothing to send ahead of them.
+        if (self.can_splice and (not self.plan.needs_payload) and
+            (not self.carryover) and self.outlet.empty()):
+            if self.splice_pipe is None:
+                self.splice_pipe = os.pipe()
+            try:
+                return self._splice_readable()
+            except OSError as inst:
+                if inst.errno not in (errno.EINVAL,errno.ENOSYS):
+                    raise
+                # this kind of socket can't be spliced; copy instead.
+                # nothing was moved, so no data is lost.
+                self.can_splice = False
+                self._close_splice_pipe()
+        return self._copy_readable()
+
+    def _splice_readable(self):
+        read_pipe, write_pipe = self.splice_pipe
+        from_fd = self.socket_to_listen_on.fileno()
+        for i in range(0,MAX_READS_PER_READABLE):
+            try:
+                num_read = splice.splice(
+                    from_fd,write_pipe,self.buffer_size,
+                    splice.SPLICE_F_MOVE | splice.SPLICE_F_NONBLOCK)
+            except OSError as inst:
+                if inst.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return None
+                raise
+
+            if num_read == 0:
+                return 0
+            self.metrics.bytes += num_read
+            self.metrics.chunks += 1
+
+            # sends what the socket can take now; the outlet holds the
+            # rest in the pipe, and we copy until it has sent it.
+            self.outlet.send_from_pipe(read_pipe,num_read)
+            if (num_read < self.buffer_size) or (not self.outlet.empty()):
+                return None
+        return None
+
+    def _copy_readable(self):
+        if self.recv_buffer is None:
+            self.recv_buffer = bytearray(self.buffer_size)
+            self.recv_buffer_view = memoryview(self.recv_buffer)
+        
+        buffer_size = self.buffer_size
+        for i in range(0,MAX_READS_PER_READABLE):
+            try:
+                num_read = self.socket_to_listen_on.recv_into(
+                    self.recv_buffer_view,buffer_size)
+            except socket.error as inst:
+                if inst.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return None
+                raise
+            
+            if num_read == 0:
+                return 0
+            self.metrics.bytes += num_read
+            self.metrics.chunks += 1
+
+            # plans may hold on to what they receive, so they get a
+            # copy rather than a view into our reused buffer.
+            recv_data = self.recv_buffer_view[:num_read].tobytes()
+            if self.capture is not None:
+                # carryover was captured when it was first read.
+                self.capture.write(
+                    self.connection.capture_id,self.direction_index,
+                    RecordKind.DATA,recv_data)
+            if self.carryover:
+                recv_data = self.carryover + recv_data
+                self.carryover = ''
+            recv_return = self.plan.recv(recv_data,self.outlet)
+            if recv_return is not None:
+                return recv_return
+            if not self.accepting_data():
+                return None
+
+            if num_read < buffer_size:
+                # a short read means the socket is already drained;
+                # don't pay for a recv just to get EAGAIN.
+                return None
+        return None
 
+    def print_exception(self,inst):
+        self.metrics.exceptions += 1
+        print (
+            '[DEBUG] Got an exception on bridge ' +
+            str(self.connection.bridge) + ' ' + str(inst) +
+            ' for socket ' + str(self.socket_to_send_to))
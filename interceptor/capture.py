@@ -0,0 +1,223 @@
+'''
+Capturing what bridges read into a memory-mapped ring file.
+
+A capture file is a header followed by a fixed-size ring of records.
+Once the ring is full, each new record overwrites the oldest ones, so
+a capture never grows past the size it was created with.
+
+    header: magic 'ICAP', version (uint16), header size (uint16),
+            ring size (uint64), write offset (uint64),
+            oldest offset (uint64), number of records (uint64)
+    record: time (float64, seconds since the epoch),
+            connection id (uint32), original length (uint32),
+            captured length (uint32), direction (uint8), kind (uint8),
+            2 bytes of padding, then captured length bytes of data
+
+all little-endian.  Offsets count bytes ever written to the ring; a
+record at offset o starts o % ring size bytes into the ring, and may
+wrap around its end.
+'''
+import mmap
+import struct
+import threading
+import time
+
+MAGIC = 'ICAP'
+VERSION = 1
+DEFAULT_RING_BYTES = 64 * 1024 * 1024
+
+_HEADER = struct.Struct('<4sHHQQQQ')
+_HEADER_SIZE = 64
+_RECORD = struct.Struct('<dIIIBB2x')
+
+class RecordKind(object):
+    # bytes read from one side of a connection
+    DATA = 0
+    # a connection was accepted and connected upstream
+    OPEN = 1
+    # a connection was brought down
+    CLOSE = 2
+
+
+class CaptureRecord(object):
+    def __init__(self,time_seconds,connection_id,direction,kind,
+                 original_length,data):
+        '''
+        @param {int} direction --- BridgeMetrics.ONE_DIRECTION (read
+        from the client) or BridgeMetrics.OTHER_DIRECTION (read from
+        upstream).
+
+        @param {int} original_length --- Bytes read.  data is shorter
+        if the record did not fit in the ring.
+        '''
+        self.time_seconds = time_seconds
+        self.connection_id = connection_id
+        self.direction = direction
+        self.kind = kind
+        self.original_length = original_length
+        self.data = data
+
+
+class CaptureWriter(object):
+    '''
+    Appends records to a capture file.  Safe to share between all the
+    connections of any number of bridges.
+
+    Appending copies into a shared mapping of the file: it makes no
+    system calls, and the kernel writes dirty pages back in large
+    batches on its own.
+    '''
+    def __init__(self,path,ring_bytes=DEFAULT_RING_BYTES):
+        '''
+        @param {string} path --- Overwritten if it exists.
+
+        @param {int} ring_bytes --- Size of the ring.  The file is
+        created this big (plus a header) up front.
+        '''
+        if ring_bytes <= _RECORD.size:
+            raise ValueError('ring_bytes must hold at least one record')
+        self.path = path
+        self.ring_bytes = ring_bytes
+        self.lock = threading.Lock()
+        with open(path,'w+b') as f:
+            f.truncate(_HEADER_SIZE + ring_bytes)
+            self.map = mmap.mmap(f.fileno(),_HEADER_SIZE + ring_bytes)
+
+        self.write_offset = 0
+        self.oldest_offset = 0
+        self.num_records = 0
+        self.next_connection_id = 0
+        self._write_header()
+
+    def new_connection_id(self):
+        '''
+        @returns {int} --- Distinct for each connection captured to
+        this file.
+        '''
+        with self.lock:
+            self.next_connection_id += 1
+            return self.next_connection_id
+
+    def write(self,connection_id,direction,kind,data=''):
+        '''
+        @param {string} data --- Must be a str.
+        '''
+        time_seconds = time.time()
+        original_length = len(data)
+        # a record can be at most the whole ring.
+        data = data[:self.ring_bytes - _RECORD.size]
+        record_bytes = _RECORD.size + len(data)
+        record_header = _RECORD.pack(
+            time_seconds,connection_id,original_length,len(data),
+            direction,kind)
+
+        with self.lock:
+            # make room by dropping the oldest records.
+            while (self.write_offset + record_bytes - self.oldest_offset >
+                   self.ring_bytes):
+                oldest_header = _read_ring(
+                    self.map,self.ring_bytes,self.oldest_offset,
+                    _RECORD.size)
+                captured_length = _RECORD.unpack(oldest_header)[3]
+                self.oldest_offset += _RECORD.size + captured_length
+                self.num_records -= 1
+
+            self._write_ring(self.write_offset,record_header)
+            self._write_ring(self.write_offset + _RECORD.size,data)
+            self.write_offset += record_bytes
+            self.num_records += 1
+            self._write_header()
+
+    def flush(self):
+        '''
+        Block until everything written so far is on disk.
+        '''
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+
+    def _write_header(self):
+        _HEADER.pack_into(
+            self.map,0,MAGIC,VERSION,_HEADER_SIZE,self.ring_bytes,
+            self.write_offset,self.oldest_offset,self.num_records)
+
+    def _write_ring(self,offset,data):
+        position = offset % self.ring_bytes
+        first_length = min(len(data),self.ring_bytes - position)
+        start = _HEADER_SIZE + position
+        self.map[start:start + first_length] = data[:first_length]
+        if first_length < len(data):
+            rest = data[first_length:]
+            self.map[_HEADER_SIZE:_HEADER_SIZE + len(rest)] = rest
+
+
+class CaptureReader(object):
+    '''
+    Reads records from a capture file without loading it into memory:
+    the file is mapped, and only the pages of records actually read
+    are paged in.
+
+    Meant for captures that are no longer being written.  If a writer
+    is still appending, records read may be overwritten mid-read.
+    '''
+    def __init__(self,path):
+        '''
+        @throws ValueError if path is not a capture file.
+        '''
+        with open(path,'rb') as f:
+            self.map = mmap.mmap(
+                f.fileno(),0,access=mmap.ACCESS_READ)
+        if len(self.map) < _HEADER_SIZE:
+            raise ValueError(path + ' is not a capture file')
+        (magic,version,header_size,self.ring_bytes,self.write_offset,
+         self.oldest_offset,self.num_records) = _HEADER.unpack_from(
+            self.map,0)
+        if (magic != MAGIC) or (version != VERSION) or (
+            header_size != _HEADER_SIZE):
+            raise ValueError(path + ' is not a version 1 capture file')
+
+    def records(self,skip=0,skip_data=False):
+        '''
+        Generates CaptureRecords, oldest first.
+
+        @param {int} skip --- Number of records to skip.  Skipped
+        records' data is never read.
+
+        @param {bool} skip_data --- If True, yielded records' data is
+        None.  Lets callers scan headers of large captures cheaply.
+        '''
+        offset = self.oldest_offset
+        index = 0
+        while offset < self.write_offset:
+            (time_seconds,connection_id,original_length,captured_length,
+             direction,kind) = _RECORD.unpack(
+                _read_ring(self.map,self.ring_bytes,offset,_RECORD.size))
+            data_offset = offset + _RECORD.size
+            offset = data_offset + captured_length
+            if index >= skip:
+                data = None
+                if not skip_data:
+                    data = _read_ring(
+                        self.map,self.ring_bytes,data_offset,
+                        captured_length)
+                yield CaptureRecord(
+                    time_seconds,connection_id,direction,kind,
+                    original_length,data)
+            index += 1
+
+    def close(self):
+        self.map.close()
+
+
+def _read_ring(ring_map,ring_bytes,offset,length):
+    position = offset % ring_bytes
+    first_length = min(length,ring_bytes - position)
+    start = _HEADER_SIZE + position
+    data = ring_map[start:start + first_length]
+    if first_length < length:
+        data += ring_map[_HEADER_SIZE:_HEADER_SIZE + length - first_length]
+    return data
@@ -0,0 +1,342 @@
+'''
+Replaying captured conversations against a bridge's to_connect_to
+endpoint, without the original clients.
+
+A CaptureReplay opens one connection to the target for each
+connection in a capture file, and sends it what the original client
+sent, either at the recorded pace, sped up, or as fast as the target
+takes it.  What the target sends back is read and counted, but not
+compared to the capture.
+
+Records are streamed from the capture file as they come due, so a
+replay's memory does not grow with the length of the capture.  Every
+CaptureReplay sharing an EventLoop replays from its thread, so many
+replays of the same or different captures can run at once as a load
+test.
+'''
+import collections
+import errno
+import socket
+import threading
+
+from interceptor.capture import CaptureReader, RecordKind
+from interceptor.clock import monotonic
+from interceptor.event_loop import EventLoop
+from interceptor.metrics import BridgeMetrics
+
+# stop reading records once this many bytes are waiting to be sent to
+# the target, until half of them have been.  Only reached if the
+# target reads more slowly than the capture is replayed.
+DEFAULT_MAX_PENDING_BYTES = 4 * 1024 * 1024
+
+# replay at most this many records before letting the loop run other
+# callbacks.
+MAX_RECORDS_PER_ADVANCE = 256
+
+RECV_SIZE = 64 * 1024
+
+class CaptureReplay(object):
+    def __init__(self,capture_path,target_host_port_pair,speed=1.,
+                 loop=None,max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+        '''
+        @param {string} capture_path --- Written by a CaptureWriter.
+        Should no longer be being written.
+
+        @param {HostPortPair} target_host_port_pair --- Where to send
+        what the captured clients sent.  Usually the
+        to_connect_to_host_port_pair of the bridge that captured.
+
+        @param {float or None} speed --- 1 replays with the recorded
+        timing, 2 twice as fast, and so on.  None sends each record as
+        soon as the target takes it.
+
+        @param {EventLoop or None} loop --- Loop to replay from.  If
+        None, start a new one.
+
+        @param {int} max_pending_bytes --- See
+        DEFAULT_MAX_PENDING_BYTES.
+
+        @throws ValueError if capture_path is not a capture file or
+        speed is not positive.
+        '''
+        if (speed is not None) and (speed <= 0):
+            raise ValueError('speed must be positive')
+        self.target_host_port_pair = target_host_port_pair
+        self.speed = speed
+        self.max_pending_bytes = max_pending_bytes
+        if loop is None:
+            loop = EventLoop()
+            loop.start()
+        self.loop = loop
+
+        self.reader = CaptureReader(capture_path)
+        self.records = self.reader.records()
+        # read from records, but not yet due.
+        self.next_record = None
+        self.records_done = False
+
+        # loop time that the first record is replayed at, and the
+        # capture time it was recorded at.
+        self.start_time = None
+        self.first_record_time = None
+
+        # capture connection id -> _ReplaySession
+        self.sessions = {}
+        # capture connection ids whose sessions have closed.  Their
+        # remaining records are dropped rather than reconnecting.
+        self.closed_connection_ids = set()
+        # bytes waiting to be sent across all sessions.
+        self.pending_bytes = 0
+        # True if stopped reading records until pending_bytes drains.
+        self.paused = False
+
+        self.finished = threading.Event()
+
+        self.records_replayed = 0
+        self.truncated_records = 0
+        self.sessions_started = 0
+        self.sessions_failed = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # how far behind the recorded timing we have fallen.
+        self.max_lateness_seconds = 0.
+
+    def start(self):
+        '''
+        Safe to call from any thread.
+        '''
+        self.loop.call_soon_threadsafe(self._advance)
+
+    def wait(self,timeout=None):
+        '''
+        Block until every record has been replayed and every replayed
+        connection closed.
+
+        @returns {bool} --- False if timed out.
+        '''
+        return self.finished.wait(timeout)
+
+    def snapshot(self):
+        return {
+            'records_replayed': self.records_replayed,
+            'truncated_records': self.truncated_records,
+            'sessions_started': self.sessions_started,
+            'sessions_failed': self.sessions_failed,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'max_lateness_seconds': self.max_lateness_seconds,
+            }
+
+    def _advance(self):
+        '''
+        Replay every record that is due, then arrange to be called
+        again when the next one is.
+        '''
+        num_replayed = 0
+        while True:
+            if self.pending_bytes > self.max_pending_bytes:
+                self.paused = True
+                return
+
+            if self.next_record is None:
+                self.next_record = next(self.records,None)
+                if self.next_record is None:
+                    self._records_done()
+                    return
+            record = self.next_record
+
+            if self.speed is not None:
+                now = monotonic()
+                if self.start_time is None:
+                    self.start_time = now
+                    self.first_record_time = record.time_seconds
+                due = self.start_time + (
+                    record.time_seconds - self.first_record_time) / self.speed
+                if due > now:
+                    self.loop.call_later(due - now,self._advance)
+                    return
+                self.max_lateness_seconds = max(
+                    self.max_lateness_seconds,now - due)
+
+            if num_replayed == MAX_RECORDS_PER_ADVANCE:
+                self.loop.call_later(0,self._advance)
+                return
+            self.next_record = None
+            self._replay_record(record)
+            num_replayed += 1
+
+    def _replay_record(self,record):
+        self.records_replayed += 1
+        if record.kind == RecordKind.OPEN:
+            self._session(record.connection_id)
+        elif record.kind == RecordKind.CLOSE:
+            session = self.sessions.get(record.connection_id,None)
+            if session is not None:
+                session.close_when_sent()
+        elif record.direction == BridgeMetrics.ONE_DIRECTION:
+            if len(record.data) < record.original_length:
+                self.truncated_records += 1
+            session = self._session(record.connection_id)
+            if session is not None:
+                session.send(record.data)
+        # the target sends its own replies; what it sent when captured
+        # is ignored.
+
+    def _session(self,connection_id):
+        '''
+        @returns {_ReplaySession or None} --- For connection_id,
+        connecting a new one if needed.  Connections whose open record
+        was evicted from the capture's ring are connected at their
+        first data record.  None if connection_id's session already
+        closed.
+        '''
+        if connection_id in self.closed_connection_ids:
+            return None
+        session = self.sessions.get(connection_id,None)
+        if session is None:
+            self.sessions_started += 1
+            session = _ReplaySession(self,connection_id)
+            self.sessions[connection_id] = session
+            session.connect()
+        return session
+
+    def _records_done(self):
+        self.records_done = True
+        self.reader.close()
+        # connections still open when the capture ended.
+        for session in list(self.sessions.values()):
+            session.close_when_sent()
+        self._finish_if_done()
+
+    def session_closed(self,session,num_unsent_bytes):
+        del self.sessions[session.connection_id]
+        self.closed_connection_ids.add(session.connection_id)
+        self._pending_sent_or_dropped(num_unsent_bytes)
+        self._finish_if_done()
+
+    def sent(self,num_bytes):
+        self.bytes_sent += num_bytes
+        self._pending_sent_or_dropped(num_bytes)
+
+    def _pending_sent_or_dropped(self,num_bytes):
+        self.pending_bytes -= num_bytes
+        if self.paused and (self.pending_bytes <= self.max_pending_bytes / 2):
+            self.paused = False
+            # not called directly: we may be inside _advance already.
+            self.loop.call_later(0,self._advance)
+
+    def _finish_if_done(self):
+        if self.records_done and (not self.sessions):
+            self.finished.set()
+
+
+class _ReplaySession(object):
+    '''
+    One connection to the target, replaying one captured connection.
+    Only used from the replay's loop thread.
+    '''
+    def __init__(self,replay,connection_id):
+        self.replay = replay
+        self.loop = replay.loop
+        self.connection_id = connection_id
+        self.sock = None
+        self.connected = False
+        self.writing = False
+        # close once everything queued has been sent.
+        self.closing = False
+        self.closed = False
+
+        # strs waiting to be sent, and how much of the first has been.
+        self.outgoing = collections.deque()
+        self.outgoing_offset = 0
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.sock.setblocking(0)
+        result = self.sock.connect_ex(
+            self.replay.target_host_port_pair.host_port_tuple())
+        if result not in (0,errno.EINPROGRESS):
+            self._fail()
+            return
+        # writable once connected, or once the connect fails.
+        self._start_writing()
+        self.loop.add_reader(self.sock,self._on_readable)
+
+    def send(self,data):
+        if self.closed:
+            return
+        self.outgoing.append(data)
+        self.replay.pending_bytes += len(data)
+        self._start_writing()
+
+    def close_when_sent(self):
+        self.closing = True
+        if self.connected and (not self.outgoing):
+            self._close()
+
+    def _start_writing(self):
+        if not self.writing:
+            self.writing = True
+            self.loop.add_writer(self.sock,self._on_writable)
+
+    def _on_writable(self):
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
+            if error != 0:
+                self._fail()
+                return
+            self.connected = True
+
+        while self.outgoing:
+            data = self.outgoing[0]
+            try:
+                num_sent = self.sock.send(
+                    memoryview(data)[self.outgoing_offset:])
+            except socket.error as inst:
+                if inst.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return
+                self._fail()
+                return
+            self.outgoing_offset += num_sent
+            if self.outgoing_offset == len(data):
+                self.outgoing.popleft()
+                self.outgoing_offset = 0
+            self.replay.sent(num_sent)
+
+        self.writing = False
+        self.loop.remove_writer(self.sock)
+        if self.closing:
+            self._close()
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error as inst:
+            if inst.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return
+            self._fail()
+            return
+        if not data:
+            # the target hung up; nothing more can be replayed.
+            self._close()
+            return
+        self.replay.bytes_received += len(data)
+
+    def _fail(self):
+        self.replay.sessions_failed += 1
+        self._close()
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+            self.loop.remove_writer(self.sock)
+            self.sock.close()
+        num_unsent_bytes = (
+            sum(len(data) for data in self.outgoing) - self.outgoing_offset)
+        self.outgoing.clear()
+        self.outgoing_offset = 0
+        self.replay.session_closed(self,num_unsent_bytes)
@@ -0,0 +1,52 @@
+'''
+A clock for measuring delays.  Unlike time.time, it never jumps or
+slews when the system's wall clock is adjusted (eg., by NTP).  Uses
+time.monotonic where Python provides it, and otherwise reads
+CLOCK_MONOTONIC through libc.
+'''
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+
+# from linux's time.h
+_CLOCK_MONOTONIC = 1
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec',ctypes.c_long),
+        ('tv_nsec',ctypes.c_long)]
+
+def _load_libc_monotonic():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError,AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int,ctypes.POINTER(_Timespec)]
+    clock_gettime.restype = ctypes.c_int
+
+    def libc_monotonic():
+        # ctypes releases the GIL during the call, so each call needs
+        # its own timespec.
+        timespec = _Timespec()
+        if clock_gettime(_CLOCK_MONOTONIC,ctypes.byref(timespec)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    # calling it once makes sure it works before we rely on it.
+    try:
+        libc_monotonic()
+    except OSError:
+        return None
+    return libc_monotonic
+
+monotonic = getattr(time,'monotonic',None)
+if monotonic is None:
+    monotonic = _load_libc_monotonic()
+if monotonic is None:
+    # better than nothing, but can jump.
+    monotonic = time.time
@@ -0,0 +1,572 @@
+'''
+Decoding the json descriptions of bridges that run_interceptor.py
+takes.
+'''
+import argparse
+import copy
+import functools
+import json
+
+from interceptor.util import HostPortPair
+from interceptor.plan import plan_from_args
+from interceptor.bridge import Bridge, MultiConnectionBridge
+from interceptor.bridge import DEFAULT_RECV_BUFFER_SIZE
+from interceptor.capture import CaptureWriter, DEFAULT_RING_BYTES
+
+INTERPOSING_HOST_FIELD = 'interposing_host'
+INTERPOSING_PORT_FIELD = 'interposing_port'
+
+TO_CONNECT_TO_HOST_FIELD = 'to_connect_to_host'
+TO_CONNECT_TO_PORT_FIELD = 'to_connect_to_port'
+
+MULTI_CONNECTION_FIELD = 'multi_connection'
+RECV_BUFFER_SIZE_FIELD = 'recv_buffer_size'
+UPSTREAM_POOL_SIZE_FIELD = 'upstream_pool_size'
+CAPTURE_PATH_FIELD = 'capture_path'
+CAPTURE_RING_BYTES_FIELD = 'capture_ring_bytes'
+
+PLAN_FIELD = 'plan'
+PLAN_TYPE_FIELD = 'type'
+PLAN_ADDITIONAL_ARGS_FIELD = 'additional_args'
+
+# plan arguments naming files of recorded decisions.  Each direction of
+# a bridge has its own plan, so gets its own file: the path with one of
+# the suffixes below appended.
+RECORD_PATH_ARG = 'record_path'
+REPLAY_PATH_ARG = 'replay_path'
+ONE_DIRECTION_SUFFIX = '.one_direction'
+OTHER_DIRECTION_SUFFIX = '.other_direction'
+
+# plans made of other plans list them, each of the same form as the
+# plan field, under these arguments.
+STAGES_ARG = 'stages'
+NESTED_PLAN_ARGS = ('message_plan','selected_plan','other_plan')
+
+# fields of config files.  See bridge_descriptions_from_file.
+TEMPLATES_FIELD = 'templates'
+BRIDGES_FIELD = 'bridges'
+TEMPLATE_FIELD = 'template'
+MAX_PORT = 65535
+
+def bridge_descriptions_from_json(arg_line):
+    '''
+    @param {string} arg_line --- Should be a json string of a
+    list.  Each element has the following form:
+        {
+            interposing_host: <string>,
+            interposing_port: <int>,
+
+            to_connect_to_host: <string>,
+            to_connect_to_port: <int>,
+
+            // optional, defaults to false.  If true, accept
+            // many concurrent clients, each with its own plans.
+            multi_connection: <bool>,
+
+            // optional, most bytes to read from a socket at once.
+            recv_buffer_size: <int>,
+
+            // optional, defaults to 0.  Number of connections to
+            // to_connect_to_host:to_connect_to_port to keep open
+            // ahead of time.
+            upstream_pool_size: <int>,
+
+            // optional.  If set, record traffic through this bridge
+            // to a capture file at this path.  See capture.py.
+            capture_path: <string>,
+
+            // optional, most bytes the capture file holds before
+            // overwriting its oldest records.
+            capture_ring_bytes: <int>,
+
+            plan: {
+              type: <string>,
+              additional_args: {
+              ... // specific to plan type
+              }
+            }
+        }
+
+    @returns {list} --- BridgeDescriptions, in the same order.
+
+    @throws argparse.ArgumentTypeError if arg_line is malformed.
+    '''
+    try:
+        arg_list = json.loads(arg_line)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+    return [
+        BridgeDescription.from_dict(bridge_description)
+        for bridge_description in arg_list]
+
+
+def bridge_descriptions_from_file(path):
+    '''
+    Read bridges from a json config file, for topologies too large to
+    pass on the command line.  The file holds either a list, as in
+    bridge_descriptions_from_json, or an object of the form:
+        {
+            // optional.  Named sets of bridge description fields.
+            templates: {
+                <string>: { ... },
+                ...
+            },
+
+            bridges: [
+                {
+                    // optional.  Start from this template's fields;
+                    // fields here override them.
+                    template: <string>,
+
+                    // either a port, or an inclusive range of them,
+                    // like "9000-9999", making one bridge per port.
+                    interposing_port: <int or string>,
+
+                    // a port, which every bridge of a range forwards
+                    // to, or a range as long as interposing_port's,
+                    // paired with it in order.
+                    to_connect_to_port: <int or string>,
+
+                    ... // any other bridge description fields
+                },
+                ...
+            ]
+        }
+
+    Every entry is checked, and its plan built once, before any bridge
+    is made.  In a range, a capture_path gets each bridge's
+    interposing port appended, and record_path is not supported.
+
+    @returns {list} --- BridgeDescriptions, in order.
+
+    @throws argparse.ArgumentTypeError if the file cannot be read or
+    describes invalid bridges, naming the entry at fault.
+    '''
+    try:
+        with open(path,'r') as config_file:
+            config = json.load(config_file)
+    except (IOError,ValueError) as ex:
+        raise argparse.ArgumentTypeError(
+            'Cannot read config file %(path)s: %(error)s' %
+            { 'path': path,
+              'error': ex})
+
+    templates = {}
+    entries = config
+    if isinstance(config,dict):
+        templates = config.get(TEMPLATES_FIELD,{})
+        entries = config.get(BRIDGES_FIELD,None)
+    if not isinstance(templates,dict) or not all(
+        isinstance(template,dict) for template in templates.values()):
+        raise argparse.ArgumentTypeError(
+            'templates must map names to bridge description fields')
+    if not isinstance(entries,list):
+        raise argparse.ArgumentTypeError(
+            'Config file must list bridges')
+
+    bridge_descriptions = []
+    for index, entry in enumerate(entries):
+        try:
+            bridge_descriptions.extend(_expand_entry(entry,templates))
+        except argparse.ArgumentTypeError as ex:
+            raise argparse.ArgumentTypeError(
+                'bridges[%(index)i]: %(error)s' %
+                { 'index': index,
+                  'error': ex})
+    check_distinct_ports(bridge_descriptions)
+    return bridge_descriptions
+
+
+def check_distinct_ports(bridge_descriptions):
+    '''
+    @throws argparse.ArgumentTypeError if two bridges listen on the
+    same host and port.
+    '''
+    seen = set()
+    for bridge_description in bridge_descriptions:
+        host_port = (
+            bridge_description.interposition_host_port_pair.host_port_tuple())
+        if host_port in seen:
+            raise argparse.ArgumentTypeError(
+                'More than one bridge listens on %s:%i' % host_port)
+        seen.add(host_port)
+
+
+def _expand_entry(entry,templates):
+    '''
+    @returns {list} --- BridgeDescriptions for one entry of a config
+    file's bridges.
+    '''
+    if not isinstance(entry,dict):
+        raise argparse.ArgumentTypeError(
+            'Bridge must be a json object')
+    fields = {}
+    template_name = entry.get(TEMPLATE_FIELD,None)
+    if template_name is not None:
+        if template_name not in templates:
+            raise argparse.ArgumentTypeError(
+                'No template named %s' % (template_name,))
+        fields.update(templates[template_name])
+    fields.update(entry)
+    fields.pop(TEMPLATE_FIELD,None)
+
+    interposing_ports = _port_range(
+        fields.get(INTERPOSING_PORT_FIELD,None),INTERPOSING_PORT_FIELD)
+    to_connect_to_ports = _port_range(
+        fields.get(TO_CONNECT_TO_PORT_FIELD,None),TO_CONNECT_TO_PORT_FIELD)
+    if len(to_connect_to_ports) == 1:
+        to_connect_to_ports = to_connect_to_ports * len(interposing_ports)
+    elif len(to_connect_to_ports) != len(interposing_ports):
+        raise argparse.ArgumentTypeError(
+            'to_connect_to_port range must be a single port or as long ' +
+            'as interposing_port range')
+
+    # check the entry, and build its plan, just once.
+    fields[INTERPOSING_PORT_FIELD] = interposing_ports[0]
+    fields[TO_CONNECT_TO_PORT_FIELD] = to_connect_to_ports[0]
+    bridge_description = BridgeDescription.from_dict(fields)
+    if len(interposing_ports) == 1:
+        return [bridge_description]
+
+    if _records_decisions(bridge_description.plan_additional_args):
+        raise argparse.ArgumentTypeError(
+            'record_path is not supported for port ranges: every bridge ' +
+            'would overwrite the file')
+    return [
+        bridge_description.with_ports(interposing_port,to_connect_to_port)
+        for interposing_port, to_connect_to_port in
+        zip(interposing_ports,to_connect_to_ports)]
+
+
+def _port_range(value,field):
+    '''
+    @param {int, string, or None} value --- A port, or a string
+    "<first>-<last>".
+
+    @returns {list} --- The ports value names, in order.  [None] if
+    value is None, leaving it to BridgeDescription.from_dict to report.
+    '''
+    if value is None or isinstance(value,(int,long)):
+        return [value]
+    try:
+        first, _, last = str(value).partition('-')
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            ('%(field)s must be a port or a range like 9000-9999, ' +
+             'not %(value)s') %
+            { 'field': field,
+              'value': value})
+    if not (0 < first <= last <= MAX_PORT):
+        raise argparse.ArgumentTypeError(
+            '%(field)s range %(value)s is empty or out of bounds' %
+            { 'field': field,
+              'value': value})
+    return range(first,last + 1)
+
+
+class BridgeDescription(object):
+    '''
+    Everything needed to make a bridge.  Unlike a bridge, can be sent
+    to another process.
+    '''
+    def __init__(self,interposition_host_port_pair,
+                 to_connect_to_host_port_pair,plan_type,
+                 plan_additional_args,multi_connection=False,
+                 recv_buffer_size=DEFAULT_RECV_BUFFER_SIZE,
+                 upstream_pool_size=0,capture_path=None,
+                 capture_ring_bytes=DEFAULT_RING_BYTES):
+        self.interposition_host_port_pair = interposition_host_port_pair
+        self.to_connect_to_host_port_pair = to_connect_to_host_port_pair
+        self.plan_type = plan_type
+        self.plan_additional_args = plan_additional_args
+        self.multi_connection = multi_connection
+        self.recv_buffer_size = recv_buffer_size
+        self.upstream_pool_size = upstream_pool_size
+        self.capture_path = capture_path
+        self.capture_ring_bytes = capture_ring_bytes
+
+    @staticmethod
+    def from_dict(bridge_description):
+        '''
+        @param {dict} bridge_description --- One element of the list
+        described in bridge_descriptions_from_json.
+
+        @throws argparse.ArgumentTypeError if missing fields or
+        invalid values.
+        '''
+        interposing_host = bridge_description.get(
+            INTERPOSING_HOST_FIELD,None)
+        interposing_port = bridge_description.get(
+            INTERPOSING_PORT_FIELD,None)
+
+        to_connect_to_host = bridge_description.get(
+            TO_CONNECT_TO_HOST_FIELD,None)
+        to_connect_to_port = bridge_description.get(
+            TO_CONNECT_TO_PORT_FIELD,None)
+
+        multi_connection = bridge_description.get(
+            MULTI_CONNECTION_FIELD,False)
+        recv_buffer_size = int(
+            bridge_description.get(
+                RECV_BUFFER_SIZE_FIELD,DEFAULT_RECV_BUFFER_SIZE))
+        if recv_buffer_size <= 0:
+            raise argparse.ArgumentTypeError(
+                'recv_buffer_size must be positive')
+        upstream_pool_size = int(
+            bridge_description.get(UPSTREAM_POOL_SIZE_FIELD,0))
+        if upstream_pool_size < 0:
+            raise argparse.ArgumentTypeError(
+                'upstream_pool_size must not be negative')
+        capture_path = bridge_description.get(CAPTURE_PATH_FIELD,None)
+        capture_ring_bytes = int(
+            bridge_description.get(
+                CAPTURE_RING_BYTES_FIELD,DEFAULT_RING_BYTES))
+        if capture_ring_bytes <= 0:
+            raise argparse.ArgumentTypeError(
+                'capture_ring_bytes must be positive')
+
+        plan_params = bridge_description.get(PLAN_FIELD,None)
+
+        if interposing_host is None:
+            raise argparse.ArgumentTypeError(
+                'Must specify interposing_host field for ' +
+                'bridge description')
+        if interposing_port is None:
+            raise argparse.ArgumentTypeError(
+                'Must specify interposing_port field for ' +
+                'bridge description')
+        if to_connect_to_host is None:
+            raise argparse.ArgumentTypeError(
+                'Must specify to_connect_to_host field for ' +
+                'bridge description')
+        if to_connect_to_port is None:
+            raise argparse.ArgumentTypeError(
+                'Must specify to_connect_to_port field for ' +
+                'bridge description')
+        interposing_port = int(interposing_port)
+        to_connect_to_port = int(to_connect_to_port)
+        plan_type, plan_additional_args = _decode_plan_params(
+            plan_params,multi_connection)
+
+        return BridgeDescription(
+            HostPortPair(interposing_host,interposing_port),
+            HostPortPair(to_connect_to_host,to_connect_to_port),
+            plan_type,plan_additional_args,multi_connection,
+            recv_buffer_size,upstream_pool_size,capture_path,
+            capture_ring_bytes)
+
+    def with_plan(self,plan_params):
+        '''
+        @param {dict} plan_params --- Of the same form as the plan
+        field described in bridge_descriptions_from_json.
+
+        @returns {BridgeDescription} --- Copy of this description,
+        with plan_params's plan instead.
+
+        @throws argparse.ArgumentTypeError if plan_params is invalid.
+        '''
+        plan_type, plan_additional_args = _decode_plan_params(
+            plan_params,self.multi_connection)
+        return self._replace(
+            plan_type=plan_type,plan_additional_args=plan_additional_args)
+
+    def with_ports(self,interposing_port,to_connect_to_port):
+        '''
+        @returns {BridgeDescription} --- Copy of this description,
+        listening on and forwarding to other ports of the same hosts.
+        Its capture file, if any, has interposing_port appended.
+        '''
+        capture_path = self.capture_path
+        if capture_path is not None:
+            capture_path += '.%i' % interposing_port
+        return self._replace(
+            interposition_host_port_pair=HostPortPair(
+                self.interposition_host_port_pair.host,interposing_port),
+            to_connect_to_host_port_pair=HostPortPair(
+                self.to_connect_to_host_port_pair.host,to_connect_to_port),
+            capture_path=capture_path)
+
+    def _replace(self,**fields):
+        '''
+        @returns {BridgeDescription} --- Shallow copy of this
+        description with fields set.  Copies share plan arguments,
+        which are never modified.
+        '''
+        replaced = copy.copy(self)
+        for name, value in fields.items():
+            setattr(replaced,name,value)
+        return replaced
+
+    def plan_factories(self):
+        '''
+        @returns {tuple} --- (one_direction_plan_factory,
+        other_direction_plan_factory).  Each takes no arguments and
+        returns a new Plan, as MultiConnectionBridge and
+        Bridge.swap_plans expect.
+        '''
+        one_direction_args = _direction_args(
+            self.plan_additional_args,ONE_DIRECTION_SUFFIX)
+        other_direction_args = _direction_args(
+            self.plan_additional_args,OTHER_DIRECTION_SUFFIX)
+        return (
+            functools.partial(
+                plan_from_args,self.plan_type,one_direction_args),
+            functools.partial(
+                plan_from_args,self.plan_type,other_direction_args))
+
+    def make_bridge(self,reuse_port=False,capture_suffix=''):
+        '''
+        @param {bool} reuse_port --- See Bridge.
+
+        @param {string} capture_suffix --- Appended to capture_path, so
+        that bridges made from the same description in different
+        processes write different capture files.
+
+        @returns {Bridge} --- Not yet started.  Its capture file, if
+        any, has been created.
+        '''
+        capture = None
+        if self.capture_path is not None:
+            capture = CaptureWriter(
+                self.capture_path + capture_suffix,self.capture_ring_bytes)
+
+        one_direction_plan_factory, other_direction_plan_factory = (
+            self.plan_factories())
+        if self.multi_connection:
+            return MultiConnectionBridge(
+                self.interposition_host_port_pair,
+                one_direction_plan_factory,
+                self.to_connect_to_host_port_pair,
+                other_direction_plan_factory,
+                recv_buffer_size=self.recv_buffer_size,
+                upstream_pool_size=self.upstream_pool_size,
+                reuse_port=reuse_port,
+                capture=capture)
+
+        # plans are made when the first client connects.
+        return Bridge(
+            self.interposition_host_port_pair,None,
+            self.to_connect_to_host_port_pair,None,
+            recv_buffer_size=self.recv_buffer_size,
+            upstream_pool_size=self.upstream_pool_size,
+            reuse_port=reuse_port,
+            capture=capture,
+            plan_factories=(
+                one_direction_plan_factory,other_direction_plan_factory))
+
+
+def _decode_plan_params(plan_params,multi_connection):
+    '''
+    @param {dict or None} plan_params --- The plan field of a bridge
+    description.
+
+    @returns {tuple} --- (plan_type, plan_additional_args)
+
+    @throws argparse.ArgumentTypeError if plan_params is invalid.
+    '''
+    if not isinstance(plan_params,dict):
+        raise argparse.ArgumentTypeError(
+            'Must specify plan field for ' +
+            'bridge description')
+    plan_type = plan_params.get(PLAN_TYPE_FIELD,None)
+    plan_additional_args = plan_params.get(
+        PLAN_ADDITIONAL_ARGS_FIELD,None)
+    if plan_type is None:
+        raise argparse.ArgumentTypeError(
+            'Must specify plan_type field for ' +
+            'bridge description')
+    if plan_additional_args is None:
+        raise argparse.ArgumentTypeError(
+            'Must specify plan_additional_args field for ' +
+            'bridge description')
+    if multi_connection and _records_decisions(plan_additional_args):
+        raise argparse.ArgumentTypeError(
+            'record_path is not supported for multi_connection ' +
+            'bridges: every connection would overwrite the file')
+    # report bad plans now rather than when a client connects, but
+    # without creating files yet.
+    plan_from_args(
+        plan_type,
+        _direction_args(
+            plan_additional_args,ONE_DIRECTION_SUFFIX,
+            keep_record_path=False))
+    return plan_type, plan_additional_args
+
+
+def _direction_args(plan_additional_args,suffix,keep_record_path=True):
+    '''
+    @param {bool} keep_record_path --- If False, drop record_path
+    arguments, so that making the plan creates no files.
+
+    @returns {dict} --- Copy of plan_additional_args with suffix
+    appended to any decisions file paths, including those of nested
+    plans.
+    '''
+    direction_args = dict(plan_additional_args)
+    if not keep_record_path:
+        direction_args.pop(RECORD_PATH_ARG,None)
+    for arg in (RECORD_PATH_ARG,REPLAY_PATH_ARG):
+        if direction_args.get(arg,None) is not None:
+            direction_args[arg] = direction_args[arg] + suffix
+
+    def nested_direction_plan(plan_params):
+        plan_params = dict(plan_params)
+        plan_params[PLAN_ADDITIONAL_ARGS_FIELD] = _direction_args(
+            plan_params.get(PLAN_ADDITIONAL_ARGS_FIELD,{}),suffix,
+            keep_record_path)
+        return plan_params
+    return _map_nested_plans(direction_args,nested_direction_plan)
+
+
+def _records_decisions(plan_additional_args):
+    '''
+    @returns {bool} --- True if the plan, or any plan nested in it,
+    has a record_path.
+    '''
+    if RECORD_PATH_ARG in plan_additional_args:
+        return True
+    for plan_params in _nested_plans(plan_additional_args):
+        if _records_decisions(
+            plan_params.get(PLAN_ADDITIONAL_ARGS_FIELD,{})):
+            return True
+    return False
+
+
+def _nested_plans(plan_additional_args):
+    '''
+    @returns {list} --- dicts describing the plans nested directly in
+    plan_additional_args.
+    '''
+    nested_plans = []
+    stages = plan_additional_args.get(STAGES_ARG,None)
+    if isinstance(stages,list):
+        nested_plans.extend(
+            stage for stage in stages if isinstance(stage,dict))
+    for arg in NESTED_PLAN_ARGS:
+        if isinstance(plan_additional_args.get(arg,None),dict):
+            nested_plans.append(plan_additional_args[arg])
+    return nested_plans
+
+
+def _map_nested_plans(plan_additional_args,function):
+    '''
+    @param {function} function --- Takes the dict describing a nested
+    plan and returns a replacement for it.  Malformed nested plans are
+    left for plan_from_args to report.
+
+    @returns {dict} --- Copy of plan_additional_args with function
+    applied to each plan nested directly in it.
+    '''
+    mapped_args = dict(plan_additional_args)
+    stages = mapped_args.get(STAGES_ARG,None)
+    if isinstance(stages,list):
+        mapped_args[STAGES_ARG] = [
+            function(stage) if isinstance(stage,dict) else stage
+            for stage in stages]
+    for arg in NESTED_PLAN_ARGS:
+        if isinstance(mapped_args.get(arg,None),dict):
+            mapped_args[arg] = function(mapped_args[arg])
+    return mapped_args
@@ -0,0 +1,278 @@
+'''
+Changing the bridges a running interceptor forwards for, without
+restarting it or dropping connections.
+
+A BridgeSet holds the running bridges by id.  Bridges can be added
+and removed, and a bridge's plans swapped for new ones while its
+connections keep forwarding.  A ControlServer takes these commands as
+newline-delimited json over a unix socket, one reply line per command:
+
+    {"command": "list"}
+    {"command": "stats"}
+    {"command": "add", "bridge": <bridge description>}
+    {"command": "remove", "id": <int>, "close_connections": <bool>}
+    {"command": "swap_plan", "id": <int>, "plan": <plan>}
+
+Bridge descriptions and plans have the forms described in
+config.bridge_descriptions_from_json.  Each reply has an ok field, and
+either the command's result or an error string.
+
+Everything a command needs is checked, and new plans are made, before
+anything running is touched, so a bad command changes nothing.  None
+of this runs on the forwarding path: a swap only hands each connection
+its new plans, which take over at the connection's next read.
+'''
+import argparse
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+from interceptor.config import BridgeDescription
+from interceptor.metrics import bridge_snapshot
+
+class ControlCommand(object):
+    LIST = 'list'
+    STATS = 'stats'
+    ADD = 'add'
+    REMOVE = 'remove'
+    SWAP_PLAN = 'swap_plan'
+
+
+class ControlError(Exception):
+    '''
+    A command was malformed or named a bridge that is not running.
+    '''
+
+
+class BridgeSet(object):
+    def __init__(self):
+        # serializes commands, so two swaps of the same bridge cannot
+        # interleave.  Never held while forwarding.
+        self.lock = threading.Lock()
+        # id -> (BridgeDescription, Bridge)
+        self.bridges = {}
+        self.next_id = 0
+
+    def add(self,bridge_description):
+        '''
+        Make a bridge and start it listening.
+
+        @param {BridgeDescription} bridge_description
+
+        @returns {int} --- The bridge's id.  Ids are never reused.
+
+        @throws ControlError if the bridge cannot listen on its port.
+        '''
+        bridge = bridge_description.make_bridge()
+        try:
+            # bind now, so that a port in use is reported to the caller.
+            bridge.listen(bridge.listen_backlog)
+        except socket.error as ex:
+            bridge.close()
+            raise ControlError(
+                'Cannot listen on %(listen)s: %(error)s' %
+                { 'listen': _host_port_string(
+                        bridge_description.interposition_host_port_pair),
+                  'error': ex})
+        with self.lock:
+            bridge_id = self.next_id
+            self.next_id += 1
+            self.bridges[bridge_id] = (bridge_description,bridge)
+        bridge.non_blocking_connection_setup()
+        return bridge_id
+
+    def remove(self,bridge_id,close_connections=False):
+        '''
+        Stop a bridge accepting clients.
+
+        @param {bool} close_connections --- If False, the bridge's
+        connections keep forwarding until they go down on their own.
+
+        @throws ControlError if no bridge has bridge_id.
+        '''
+        with self.lock:
+            bridge_description, bridge = self._get(bridge_id)
+            del self.bridges[bridge_id]
+        bridge.close(close_connections)
+
+    def swap_plan(self,bridge_id,plan_params):
+        '''
+        Forward with a new plan on a bridge, including on its current
+        connections.  See Bridge.swap_plans.
+
+        @param {dict} plan_params --- Of the form of the plan field of
+        a bridge description.
+
+        @throws ControlError if no bridge has bridge_id.
+
+        @throws argparse.ArgumentTypeError if plan_params is invalid.
+        '''
+        with self.lock:
+            bridge_description, bridge = self._get(bridge_id)
+            bridge_description = bridge_description.with_plan(plan_params)
+            bridge.swap_plans(*bridge_description.plan_factories())
+            self.bridges[bridge_id] = (bridge_description,bridge)
+
+    def describe(self):
+        '''
+        @returns {list} --- json-serializable dicts, one per running
+        bridge, in order of id.
+        '''
+        with self.lock:
+            items = sorted(self.bridges.items())
+        return [
+            {'id': bridge_id,
+             'listen': _host_port_string(
+                    bridge_description.interposition_host_port_pair),
+             'connect_to': _host_port_string(
+                    bridge_description.to_connect_to_host_port_pair),
+             'multi_connection': bridge_description.multi_connection,
+             'plan': {
+                    'type': bridge_description.plan_type,
+                    'additional_args': (
+                        bridge_description.plan_additional_args)},
+             'connections': len(bridge.current_connections())}
+            for bridge_id, (bridge_description, bridge) in items]
+
+    def snapshot(self):
+        '''
+        @returns {dict} --- Like metrics.bridges_snapshot, with each
+        bridge's id.
+        '''
+        with self.lock:
+            items = sorted(self.bridges.items())
+        snapshots = []
+        for bridge_id, (bridge_description, bridge) in items:
+            snapshot = bridge_snapshot(bridge)
+            snapshot['id'] = bridge_id
+            snapshots.append(snapshot)
+        return {'bridges': snapshots}
+
+    def _get(self,bridge_id):
+        '''
+        Must hold lock.
+        '''
+        if bridge_id not in self.bridges:
+            raise ControlError('No bridge with id %s' % (bridge_id,))
+        return self.bridges[bridge_id]
+
+
+class ControlServer(object):
+    '''
+    Serves commands for a BridgeSet on a unix socket.
+    '''
+    def __init__(self,path,bridge_set):
+        '''
+        @param {string} path --- Where to create the unix socket.  A
+        stale socket left there by an earlier run is replaced.
+
+        @param {BridgeSet} bridge_set
+        '''
+        self.path = path
+        self.bridge_set = bridge_set
+        control_server = self
+
+        class _Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        break
+                    if not line.strip():
+                        continue
+                    reply = control_server.handle_line(line)
+                    self.wfile.write(json.dumps(reply) + '\n')
+                    self.wfile.flush()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.unix_server = _ThreadingUnixStreamServer(path,_Handler)
+
+    def start(self):
+        t = threading.Thread(target=self.unix_server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def close(self):
+        self.unix_server.shutdown()
+        self.unix_server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def handle_line(self,line):
+        '''
+        @param {string} line --- One json command.
+
+        @returns {dict} --- json-serializable reply.
+        '''
+        try:
+            command = json.loads(line)
+            if not isinstance(command,dict):
+                raise ControlError('Command must be a json object')
+            return self._run_command(command)
+        except (ValueError,ControlError,argparse.ArgumentTypeError) as ex:
+            return {'ok': False,'error': str(ex)}
+
+    def _run_command(self,command):
+        name = command.get('command',None)
+        bridge_set = self.bridge_set
+        if name == ControlCommand.LIST:
+            return {'ok': True,'bridges': bridge_set.describe()}
+        if name == ControlCommand.STATS:
+            return {'ok': True,'stats': bridge_set.snapshot()}
+        if name == ControlCommand.ADD:
+            bridge_description = BridgeDescription.from_dict(
+                _required(command,'bridge',dict))
+            return {'ok': True,'id': bridge_set.add(bridge_description)}
+        if name == ControlCommand.REMOVE:
+            bridge_set.remove(
+                _required(command,'id',int),
+                bool(command.get('close_connections',False)))
+            return {'ok': True}
+        if name == ControlCommand.SWAP_PLAN:
+            bridge_set.swap_plan(
+                _required(command,'id',int),_required(command,'plan',dict))
+            return {'ok': True}
+        raise ControlError('Unknown command %s' % (name,))
+
+
+def send_command(path,command):
+    '''
+    Send one command to a ControlServer and wait for its reply.
+
+    @param {string} path --- The ControlServer's socket.
+
+    @param {dict} command
+
+    @returns {dict} --- The reply.
+    '''
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(command) + '\n')
+        reply = sock.makefile('r').readline()
+    finally:
+        sock.close()
+    return json.loads(reply)
+
+
+def _host_port_string(host_port_pair):
+    return '%s:%i' % (host_port_pair.host,host_port_pair.port)
+
+
+def _required(command,field,field_type):
+    value = command.get(field,None)
+    if not isinstance(value,field_type):
+        raise ControlError(
+            'Command %(command)s needs a %(type)s %(field)s field' %
+            { 'command': command.get('command',None),
+              'type': field_type.__name__,
+              'field': field})
+    return value
+
+
+class _ThreadingUnixStreamServer(SocketServer.ThreadingMixIn,
+                                 SocketServer.UnixStreamServer):
+    daemon_threads = True
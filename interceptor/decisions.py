@@ -0,0 +1,121 @@
+'''
+Recording the random decisions plans make, chunk by chunk, so that a
+run can be replayed exactly with plan.ReplayPlan.
+
+A decisions file is a header followed by one fixed-size record per
+chunk, in chunk order:
+
+    header: magic 'IDEC', version (uint16), record size (uint16)
+    record: chunk index (uint32), delay seconds (float64),
+            failed (uint8)
+
+all little-endian.  For a delay plan, the delay is how long the chunk
+was delayed.  For a fail plan, it is how long the plan waited before
+bringing the connection down, if failed is set.
+'''
+import array
+import os
+import struct
+import sys
+import threading
+
+MAGIC = 'IDEC'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHH')
+_RECORD = struct.Struct('<IdB')
+# byte offset of each field within a record
+_CHUNK_INDEX_OFFSET = 0
+_DELAY_OFFSET = 4
+_FAILED_OFFSET = 12
+
+class DecisionRecorder(object):
+    '''
+    Appends one record per decision to a decisions file.  Each record
+    is written straight to the file, so a run that crashes or is
+    killed keeps every decision made before then.
+    '''
+    def __init__(self,path):
+        '''
+        @param {string} path --- Overwritten if it exists.
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = os.open(path,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0644)
+        os.write(self.fd,_HEADER.pack(MAGIC,VERSION,_RECORD.size))
+        self.num_records = 0
+
+    def record(self,delay_seconds,failed):
+        '''
+        Record the decision for the next chunk.  Safe to call from any
+        thread.
+        '''
+        with self.lock:
+            os.write(
+                self.fd,
+                _RECORD.pack(self.num_records,delay_seconds,int(failed)))
+            self.num_records += 1
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
+
+
+class Decisions(object):
+    '''
+    Decisions loaded from a file.  delays and failed are arrays
+    indexed by chunk index.
+    '''
+    def __init__(self,delays,failed):
+        self.delays = delays
+        self.failed = failed
+
+    def __len__(self):
+        return len(self.delays)
+
+
+def load_decisions(path):
+    '''
+    @returns {Decisions}
+
+    @throws ValueError if path is not a decisions file, or its chunk
+    indices are not 0, 1, 2, ...
+    '''
+    with open(path,'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise ValueError(path + ' is not a decisions file')
+    magic, version, record_size = _HEADER.unpack_from(data,0)
+    if (magic != MAGIC) or (version != VERSION) or (
+        record_size != _RECORD.size):
+        raise ValueError(path + ' is not a version 1 decisions file')
+
+    records = data[_HEADER.size:]
+    num_records = len(records) / record_size
+    # a run killed mid-write can leave part of a record at the end.
+    records = records[:num_records * record_size]
+
+    chunk_indices = _column(records,record_size,_CHUNK_INDEX_OFFSET,'I')
+    if chunk_indices != array.array('I',xrange(num_records)):
+        raise ValueError(path + ' has missing or out of order chunks')
+    return Decisions(
+        _column(records,record_size,_DELAY_OFFSET,'d'),
+        _column(records,record_size,_FAILED_OFFSET,'B'))
+
+
+def _column(records,record_size,offset,typecode):
+    '''
+    @returns {array.array} --- The field at offset of every record.
+    Uses slicing rather than unpacking record by record, so a
+    million records load in well under a second.
+    '''
+    column = array.array(typecode)
+    width = column.itemsize
+    num_records = len(records) / record_size
+    packed = bytearray(num_records * width)
+    for i in range(0,width):
+        packed[i::width] = records[offset + i::record_size]
+    column.fromstring(str(packed))
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
@@ -0,0 +1,279 @@
+'''
+Distributions of delays, for plans that model real network paths.
+
+Every distribution samples in constant time, so a busy bridge spends
+next to nothing choosing delays.  An empirical distribution, loaded
+from a file of measured round trip times, does its work when it is
+loaded: it indexes its CDF by evenly spaced probabilities, at least
+as finely as the CDF has points, so that a sample looks up the
+segment of the CDF it falls in and inverts it, almost always without
+searching.  Loaded files are cached, so the many plans of a multi
+connection bridge share one index.
+'''
+import os
+import threading
+
+# fewest entries in an empirical distribution's index.
+MIN_INDEX_SIZE = 4096
+
+class DistributionType(object):
+    UNIFORM = 'uniform'
+    NORMAL = 'normal'
+    PARETO = 'pareto'
+    EMPIRICAL = 'empirical'
+
+    ALL = (UNIFORM,NORMAL,PARETO,EMPIRICAL)
+
+
+class EmpiricalFileFormat(object):
+    # one sample per line.
+    SAMPLES = 'samples'
+    # "<lower> <upper> <count>" per line: count samples spread evenly
+    # between lower and upper.
+    HISTOGRAM = 'histogram'
+    # "<value> <cumulative probability>" per line, both non-decreasing.
+    CDF = 'cdf'
+
+    ALL = (SAMPLES,HISTOGRAM,CDF)
+
+
+class Distribution(object):
+    def __init__(self,max_seconds=None):
+        '''
+        @param {float or None} max_seconds --- If not None, larger
+        samples are cut down to this.  Samples are never negative.
+        '''
+        self.max_seconds = max_seconds
+
+    def sample(self,rand):
+        '''
+        @param {random.Random} rand --- The only source of randomness,
+        so that seeded plans are repeatable.
+
+        @returns {float} --- Seconds.
+        '''
+        seconds = max(0.,self.draw(rand))
+        if (self.max_seconds is not None) and (seconds > self.max_seconds):
+            return self.max_seconds
+        return seconds
+
+    def draw(self,rand):
+        '''
+        @returns {float} --- An unclamped sample.
+        '''
+        raise NotImplementedError()
+
+
+class UniformDistribution(Distribution):
+    def __init__(self,lower_seconds,upper_seconds,max_seconds=None):
+        super(UniformDistribution,self).__init__(max_seconds)
+        self.lower_seconds = lower_seconds
+        self.upper_seconds = upper_seconds
+
+    def draw(self,rand):
+        # the same draw as rand.uniform.
+        return self.lower_seconds + (
+            self.upper_seconds - self.lower_seconds) * rand.random()
+
+
+class NormalDistribution(Distribution):
+    def __init__(self,mean_seconds,stddev_seconds,max_seconds=None):
+        '''
+        Negative samples become 0.
+        '''
+        if stddev_seconds < 0:
+            raise ValueError('stddev_seconds must not be negative')
+        super(NormalDistribution,self).__init__(max_seconds)
+        self.mean_seconds = mean_seconds
+        self.stddev_seconds = stddev_seconds
+
+    def draw(self,rand):
+        return rand.gauss(self.mean_seconds,self.stddev_seconds)
+
+
+class ParetoDistribution(Distribution):
+    def __init__(self,scale_seconds,shape,max_seconds=None):
+        '''
+        @param {float} scale_seconds --- Smallest sample.
+
+        @param {float} shape --- Positive.  The smaller, the heavier
+        the tail; below 2 the variance is infinite, so max_seconds is
+        usually wanted.
+        '''
+        if (scale_seconds <= 0) or (shape <= 0):
+            raise ValueError('scale_seconds and shape must be positive')
+        super(ParetoDistribution,self).__init__(max_seconds)
+        self.scale_seconds = scale_seconds
+        self.shape = shape
+
+    def draw(self,rand):
+        return self.scale_seconds * rand.paretovariate(self.shape)
+
+
+class EmpiricalDistribution(Distribution):
+    def __init__(self,cdf_points,max_seconds=None):
+        '''
+        @param {list} cdf_points --- (seconds, cumulative probability)
+        tuples, both non-decreasing, with the last probability
+        positive.  The CDF is linear between points, and probabilities
+        are scaled so the last is 1.
+
+        @throws ValueError if cdf_points is empty or not
+        non-decreasing.
+        '''
+        super(EmpiricalDistribution,self).__init__(max_seconds)
+        if not cdf_points:
+            raise ValueError('Empty distribution')
+        seconds = [float(point[0]) for point in cdf_points]
+        probabilities = [float(point[1]) for point in cdf_points]
+        for i in range(1,len(cdf_points)):
+            if (seconds[i] < seconds[i - 1]) or (
+                probabilities[i] < probabilities[i - 1]):
+                raise ValueError(
+                    'Distribution is not non-decreasing at %s' % seconds[i])
+        if probabilities[-1] <= 0:
+            raise ValueError('Distribution has no probability')
+        # probability at or below the first point sits exactly on it.
+        self.seconds = [seconds[0]] + seconds
+        self.probabilities = [0.] + probabilities
+        self.total = probabilities[-1]
+
+        # index[i] is the first segment ending above probability
+        # total * i / len(index).  Segment j runs from point j to point
+        # j + 1.
+        index_size = max(MIN_INDEX_SIZE,len(self.seconds))
+        self.index = []
+        segment = 0
+        for i in range(0,index_size):
+            target = self.total * i / index_size
+            while (segment < len(self.seconds) - 2) and (
+                self.probabilities[segment + 1] <= target):
+                segment += 1
+            self.index.append(segment)
+        self.index_scale = index_size / self.total
+
+    def draw(self,rand):
+        probability = rand.random() * self.total
+        # min guards against rounding up to len(index).
+        segment = self.index[
+            min(int(probability * self.index_scale),len(self.index) - 1)]
+        # only searches when several points share an index entry.
+        while self.probabilities[segment + 1] < probability:
+            segment += 1
+        low_probability = self.probabilities[segment]
+        high_probability = self.probabilities[segment + 1]
+        if high_probability == low_probability:
+            return self.seconds[segment + 1]
+        low_seconds = self.seconds[segment]
+        return low_seconds + (
+            (probability - low_probability) /
+            (high_probability - low_probability) *
+            (self.seconds[segment + 1] - low_seconds))
+
+    @staticmethod
+    def from_samples(samples,max_seconds=None):
+        '''
+        @param {list} samples --- Seconds, in any order.
+        '''
+        samples = sorted(samples)
+        if not samples:
+            raise ValueError('No samples')
+        if len(samples) == 1:
+            return EmpiricalDistribution(
+                [(samples[0],0.),(samples[0],1.)],max_seconds)
+        last_index = float(len(samples) - 1)
+        return EmpiricalDistribution(
+            [(sample,index / last_index)
+             for index, sample in enumerate(samples)],
+            max_seconds)
+
+    @staticmethod
+    def from_histogram(buckets,max_seconds=None):
+        '''
+        @param {list} buckets --- (lower seconds, upper seconds, count)
+        tuples, in increasing order and not overlapping.
+        '''
+        cdf_points = []
+        total = 0.
+        for lower, upper, count in buckets:
+            if (upper < lower) or (count < 0):
+                raise ValueError(
+                    'Bad histogram bucket %s-%s' % (lower,upper))
+            cdf_points.append((lower,total))
+            total += count
+            cdf_points.append((upper,total))
+        return EmpiricalDistribution(cdf_points,max_seconds)
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def load_empirical_distribution(path,file_format,unit_seconds=1.,
+                                max_seconds=None):
+    '''
+    @param {string} path --- Text file in file_format.  Blank lines
+    and lines starting with # are ignored.
+
+    @param {EmpiricalFileFormat} file_format
+
+    @param {float} unit_seconds --- Seconds per unit of the values in
+    the file, eg., .001 if they are milliseconds.
+
+    @returns {EmpiricalDistribution} --- Shared with earlier calls for
+    the same, unchanged, file.
+
+    @throws IOError if path cannot be read.
+
+    @throws ValueError if the file is malformed.
+    '''
+    if file_format not in EmpiricalFileFormat.ALL:
+        raise ValueError(
+            'file_format must be one of ' +
+            ', '.join(EmpiricalFileFormat.ALL))
+    stat = os.stat(path)
+    key = (os.path.abspath(path),stat.st_mtime,stat.st_size,file_format,
+           unit_seconds,max_seconds)
+    with _loaded_lock:
+        distribution = _loaded.get(key,None)
+    if distribution is not None:
+        return distribution
+
+    rows = []
+    with open(path,'r') as distribution_file:
+        for line_number, line in enumerate(distribution_file):
+            line = line.strip()
+            if (not line) or line.startswith('#'):
+                continue
+            try:
+                rows.append([float(field) for field in line.split()])
+            except ValueError:
+                raise ValueError(
+                    '%(path)s line %(line)i is not numbers' %
+                    { 'path': path,
+                      'line': line_number + 1})
+    expected_fields = {
+        EmpiricalFileFormat.SAMPLES: 1,
+        EmpiricalFileFormat.HISTOGRAM: 3,
+        EmpiricalFileFormat.CDF: 2}[file_format]
+    if any(len(row) != expected_fields for row in rows):
+        raise ValueError(
+            '%(path)s: each %(format)s line needs %(fields)i numbers' %
+            { 'path': path,
+              'format': file_format,
+              'fields': expected_fields})
+
+    if file_format == EmpiricalFileFormat.SAMPLES:
+        distribution = EmpiricalDistribution.from_samples(
+            [row[0] * unit_seconds for row in rows],max_seconds)
+    elif file_format == EmpiricalFileFormat.HISTOGRAM:
+        distribution = EmpiricalDistribution.from_histogram(
+            [(row[0] * unit_seconds,row[1] * unit_seconds,row[2])
+             for row in rows],
+            max_seconds)
+    else:
+        distribution = EmpiricalDistribution(
+            [(row[0] * unit_seconds,row[1]) for row in rows],max_seconds)
+
+    with _loaded_lock:
+        _loaded[key] = distribution
+    return distribution
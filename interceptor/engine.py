@@ -0,0 +1,212 @@
+import Queue
+import threading
+import traceback
+
+from interceptor.event_loop import EventLoop
+
+class EngineType(object):
+    THREADED = 'threaded'
+    EVENT_LOOP = 'event_loop'
+
+
+def engine_from_type(engine_type):
+    '''
+    @param {EngineType} engine_type
+
+    @throws ValueError if unknown engine type.
+    '''
+    if engine_type == EngineType.THREADED:
+        return ThreadedEngine()
+    elif engine_type == EngineType.EVENT_LOOP:
+        return EventLoopEngine()
+    raise ValueError('Unknown engine type ' + str(engine_type))
+
+
+class Engine(object):
+    '''
+    Decides which thread(s) read from a bridge's sockets and hand the
+    data to plans.
+    '''
+    def start_pair(self,pair):
+        '''
+        Begin forwarding for a _SendReceiveSocketPair.
+        '''
+    def stop_pair(self,pair):
+        '''
+        Called while the pair's connection is being brought down,
+        before its sockets are closed.  After this returns, the engine
+        must not touch pair's sockets.
+        '''
+    def resume_pair(self,pair):
+        '''
+        Called from any thread when the plan of a pair that was
+        waiting for it to accept data does so again.
+        '''
+    def write_loop(self):
+        '''
+        @returns {EventLoop} --- Writes what sockets of this engine's
+        pairs could not take right away, once they can.
+        '''
+        raise NotImplementedError()
+
+    def close_connection(self,connection):
+        '''
+        Bring connection down on behalf of any thread, eg., one
+        closing its bridge.  May return before it is down.
+        '''
+        connection.down_up_connection()
+
+
+class ThreadedEngine(Engine):
+    '''
+    Every pair gets its own thread blocking in poll.  Threads are
+    kept when their pair is done and reused for later pairs, so
+    connections failing and coming back up do not churn threads.
+    '''
+    def __init__(self):
+        self.workers = _WorkerPool()
+        # started the first time a socket cannot take what is sent to
+        # it.
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        
+    def start_pair(self,pair):
+        self.workers.submit(pair.run)
+
+    def stop_pair(self,pair):
+        # pair's thread wakes up when its socket is shut down, or, if
+        # it is waiting for its plan, on this.
+        pair.resume_event.set()
+
+    def resume_pair(self,pair):
+        pair.resume_event.set()
+
+    def write_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = EventLoop()
+                self.loop.start()
+            return self.loop
+
+
+class EventLoopEngine(Engine):
+    '''
+    A single EventLoop thread reads from and writes to every pair of
+    every bridge that uses this engine.  Plans are called on that
+    thread, with the same recv contract as the threaded engine.  What
+    they send never blocks the loop: sockets that cannot take it yet
+    are written to once the loop sees them writable.
+    '''
+    def __init__(self):
+        self.loop = EventLoop()
+        self.loop.start()
+
+    def start_pair(self,pair):
+        self.loop.call_soon_threadsafe(self._start_reading,pair)
+
+    def stop_pair(self,pair):
+        # connections are only ever brought down from the loop's
+        # thread when using this engine.
+        self.loop.remove_reader(pair.socket_to_listen_on)
+        pair.release_resources()
+
+    def resume_pair(self,pair):
+        self.loop.call_soon_threadsafe(self._start_reading,pair)
+
+    def write_loop(self):
+        return self.loop
+
+    def close_connection(self,connection):
+        # stop_pair must run on the loop's thread.
+        if self.loop.in_loop_thread():
+            connection.down_up_connection()
+        else:
+            self.loop.call_soon_threadsafe(connection.down_up_connection)
+
+    def _start_reading(self,pair):
+        if pair.connection.closed:
+            return
+        if not pair.accepting_data():
+            # the plan resumes the pair when it has room.
+            return
+        self.loop.add_reader(
+            pair.socket_to_listen_on,lambda: self._on_readable(pair))
+
+    def _on_readable(self,pair):
+        error = None
+        try:
+            seconds_before_close = pair.handle_readable()
+        except Exception as inst:
+            pair.print_exception(inst)
+            error = inst
+            seconds_before_close = 0
+
+        if seconds_before_close is None:
+            if not pair.accepting_data():
+                # let data back up into the sender until the plan
+                # resumes the pair.
+                self.loop.remove_reader(pair.socket_to_listen_on)
+            return
+
+        # stop reading from the socket while we wait to close it.
+        self.loop.remove_reader(pair.socket_to_listen_on)
+        if seconds_before_close > 0:
+            self.loop.call_later(
+                seconds_before_close,pair.connection.down_up_connection)
+        else:
+            pair.connection.down_up_connection(error)
+
+
+class _WorkerPool(object):
+    '''
+    Runs each submitted function on a thread of its own, reusing
+    threads that have finished running earlier functions.  Never has
+    more threads than the most functions that ran at once.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = Queue.Queue()
+        # threads waiting for a job that no job has been submitted to
+        # yet.
+        self.idle_workers = 0
+
+    def submit(self,function):
+        with self.lock:
+            if self.idle_workers > 0:
+                self.idle_workers -= 1
+            else:
+                t = threading.Thread(target=self._work)
+                t.setDaemon(True)
+                t.start()
+        self.jobs.put(function)
+
+    def _work(self):
+        while True:
+            function = self.jobs.get()
+            try:
+                function()
+            except Exception as inst:
+                print '[DEBUG] Exception in engine worker'
+                traceback.print_exc()
+            with self.lock:
+                self.idle_workers += 1
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+def get_default_engine():
+    '''
+    @returns {Engine} --- Engine used by bridges that were not given
+    one explicitly.  Threaded unless set_default_engine was called.
+    '''
+    global _default_engine
+    with _default_engine_lock:
+        if _default_engine is None:
+            _default_engine = ThreadedEngine()
+        return _default_engine
+
+def set_default_engine(engine):
+    global _default_engine
+    with _default_engine_lock:
+        _default_engine = engine
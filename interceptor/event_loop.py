@@ -0,0 +1,289 @@
+import collections
+import errno
+import fcntl
+import heapq
+import os
+import select
+import threading
+import traceback
+
+from interceptor.clock import monotonic
+
+class EventLoop(object):
+    '''
+    A single-threaded reactor.  Callbacks registered for readable or
+    writable files and timers all run on the loop's thread, one at a
+    time.
+
+    add_reader, remove_reader, add_writer, and remove_writer must only
+    be called from the loop's thread.  Other threads should use
+    call_soon_threadsafe to get there.
+    '''
+    def __init__(self):
+        self.poller = _make_poller()
+
+        # fd -> callback
+        self.readers = {}
+        self.writers = {}
+
+        # heap of _Timer objects
+        self.timers = []
+        self.timer_sequence = 0
+
+        # callbacks to run on the next iteration.  Filled by any
+        # thread.
+        self.ready = collections.deque()
+        self.ready_lock = threading.Lock()
+
+        # writing to wakeup_write_fd breaks the loop out of poll so it
+        # can notice new ready callbacks and timers.
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_read_fd,self.wakeup_write_fd):
+            flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+            fcntl.fcntl(fd,fcntl.F_SETFL,flags | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_read_fd,True,False)
+        self.wakeup_pending = False
+
+        self.thread = None
+
+    def start(self):
+        '''
+        Run the loop in a separate daemon thread.
+        '''
+        t = threading.Thread(target=self.run_forever)
+        t.setDaemon(True)
+        self.thread = t
+        t.start()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self.thread
+
+    def run_forever(self):
+        self.thread = threading.current_thread()
+        while True:
+            self.run_once()
+
+    def run_once(self):
+        timeout = None
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0,self.timers[0].when - monotonic())
+
+        for fd, readable, writable in self.poller.poll(timeout):
+            if fd == self.wakeup_read_fd:
+                self._drain_wakeup()
+                continue
+            # a callback may have removed later fds from this batch,
+            # so look callbacks up for each event.
+            if readable:
+                callback = self.readers.get(fd,None)
+                if callback is not None:
+                    _run_callback(callback,())
+            if writable:
+                callback = self.writers.get(fd,None)
+                if callback is not None:
+                    _run_callback(callback,())
+
+        now = monotonic()
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                _run_callback(timer.callback,timer.args)
+
+        with self.ready_lock:
+            to_run = self.ready
+            self.ready = collections.deque()
+        for callback, args in to_run:
+            _run_callback(callback,args)
+
+    def call_soon_threadsafe(self,callback,*args):
+        '''
+        Run callback(*args) on the loop's thread.  Safe to call from
+        any thread.
+        '''
+        with self.ready_lock:
+            self.ready.append((callback,args))
+            should_wakeup = not self.wakeup_pending
+            self.wakeup_pending = True
+        if should_wakeup:
+            self._wakeup()
+
+    def call_later(self,seconds,callback,*args):
+        '''
+        Run callback(*args) on the loop's thread after seconds.  Must
+        be called from the loop's thread.
+
+        @returns {_Timer} --- Call cancel on it to stop callback from
+        running.
+        '''
+        self.timer_sequence += 1
+        timer = _Timer(
+            monotonic() + seconds,self.timer_sequence,callback,args)
+        heapq.heappush(self.timers,timer)
+        return timer
+
+    def add_reader(self,fileobj,callback):
+        fd = _fileno(fileobj)
+        self.readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self,fileobj):
+        fd = _fileno(fileobj)
+        if self.readers.pop(fd,None) is not None:
+            self._update(fd)
+
+    def add_writer(self,fileobj,callback):
+        fd = _fileno(fileobj)
+        self.writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self,fileobj):
+        fd = _fileno(fileobj)
+        if self.writers.pop(fd,None) is not None:
+            self._update(fd)
+
+    def _update(self,fd):
+        self.poller.register(fd,fd in self.readers,fd in self.writers)
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_write_fd,'x')
+        except OSError as inst:
+            if inst.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_read_fd,4096):
+                pass
+        except OSError as inst:
+            if inst.errno != errno.EAGAIN:
+                raise
+        # only after draining: otherwise we could drain the write of a
+        # thread that saw wakeup_pending cleared, leaving it set with
+        # nothing in the pipe, and never be woken again.  Callbacks
+        # added before this without writing are run later in this
+        # iteration.
+        with self.ready_lock:
+            self.wakeup_pending = False
+
+
+class _Timer(object):
+    def __init__(self,when,sequence,callback,args):
+        self.when = when
+        self.sequence = sequence
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self,other):
+        return (self.when,self.sequence) < (other.when,other.sequence)
+
+
+def _run_callback(callback,args):
+    '''
+    One misbehaving callback should not stop the loop for everyone
+    else.
+    '''
+    try:
+        callback(*args)
+    except Exception as inst:
+        print '[DEBUG] Exception in event loop callback'
+        traceback.print_exc()
+
+
+def _fileno(fileobj):
+    if isinstance(fileobj,(int,long)):
+        return fileobj
+    return fileobj.fileno()
+
+
+def _make_poller():
+    if hasattr(select,'epoll'):
+        return _EpollPoller()
+    return _SelectPoller()
+
+
+class _EpollPoller(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.registered = set()
+
+    def register(self,fd,readable,writable):
+        '''
+        Listen for readable and writable events on fd.  If neither is
+        requested, stop listening on fd.
+        '''
+        mask = 0
+        if readable:
+            mask |= select.EPOLLIN
+        if writable:
+            mask |= select.EPOLLOUT
+
+        if mask == 0:
+            if fd in self.registered:
+                self.registered.discard(fd)
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError,OSError):
+                    # fd was already closed, and closing removed it.
+                    pass
+        elif fd in self.registered:
+            self.epoll.modify(fd,mask)
+        else:
+            self.epoll.register(fd,mask)
+            self.registered.add(fd)
+
+    def poll(self,timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError as inst:
+            if inst.errno == errno.EINTR:
+                return []
+            raise
+
+        error_mask = select.EPOLLERR | select.EPOLLHUP
+        to_return = []
+        for fd, mask in events:
+            error = bool(mask & error_mask)
+            to_return.append(
+                (fd,
+                 error or bool(mask & select.EPOLLIN),
+                 error or bool(mask & select.EPOLLOUT)))
+        return to_return
+
+
+class _SelectPoller(object):
+    def __init__(self):
+        self.readable = set()
+        self.writable = set()
+
+    def register(self,fd,readable,writable):
+        if readable:
+            self.readable.add(fd)
+        else:
+            self.readable.discard(fd)
+        if writable:
+            self.writable.add(fd)
+        else:
+            self.writable.discard(fd)
+
+    def poll(self,timeout):
+        try:
+            readable,writable,_ = select.select(
+                list(self.readable),list(self.writable),[],timeout)
+        except select.error as inst:
+            if inst.args[0] == errno.EINTR:
+                return []
+            raise
+        readable = set(readable)
+        writable = set(writable)
+        return [
+            (fd, fd in readable, fd in writable)
+            for fd in readable | writable]
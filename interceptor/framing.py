@@ -0,0 +1,202 @@
+'''
+Splitting the byte stream a plan sees into the messages of the
+protocol it carries.
+
+A FrameDecoder is fed reads as they arrive and returns every frame
+they complete.  Partial frames are kept in one growable buffer; the
+decoder remembers where the unread part starts rather than slicing
+the buffer after every frame, and only compacts it once most of it has
+been read.  So the cost of decoding is linear in the bytes fed, however
+large the frames and however finely they are split across reads.
+'''
+import struct
+
+DEFAULT_MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+class FramingType(object):
+    # each frame is a length header, then that many bytes
+    LENGTH_PREFIX = 'length_prefix'
+    # each frame ends with a delimiter
+    DELIMITER = 'delimiter'
+    # every frame is the same size
+    FIXED_SIZE = 'fixed_size'
+
+    ALL = (LENGTH_PREFIX,DELIMITER,FIXED_SIZE)
+
+
+class FramingError(Exception):
+    '''
+    The stream does not follow the framing.  Raised from the plan, so
+    the bridge brings the connection down.
+    '''
+
+
+class FrameDecoder(object):
+    def __init__(self,max_frame_bytes=DEFAULT_MAX_FRAME_BYTES):
+        '''
+        @param {int} max_frame_bytes --- Largest frame to buffer.  A
+        longer one raises FramingError rather than growing the buffer
+        without bound.
+        '''
+        self.max_frame_bytes = max_frame_bytes
+        self.buffer = bytearray()
+        # start of the bytes in buffer not yet returned in a frame.
+        self.offset = 0
+
+    def pending_bytes(self):
+        '''
+        @returns {int} --- Bytes fed but not yet returned in a frame.
+        '''
+        return len(self.buffer) - self.offset
+
+    def take_pending(self):
+        '''
+        @returns {str} --- Bytes fed but not yet returned in a frame.
+        The decoder forgets them, and starts a new frame with the next
+        byte fed.
+        '''
+        pending = bytes(self.buffer[self.offset:])
+        del self.buffer[:]
+        self.offset = 0
+        self.reset()
+        return pending
+
+    def reset(self):
+        '''
+        Called when the buffer is emptied other than by decoding.
+        '''
+
+    def feed(self,data):
+        '''
+        @param {str} data --- Next bytes of the stream.
+
+        @returns {list} --- strs, each a whole frame, including its
+        header or delimiter, in order.  Joined, they are exactly the
+        bytes fed so far that completed frames.
+
+        @throws FramingError
+        '''
+        self.buffer.extend(data)
+        frames = []
+        while True:
+            end = self.frame_end()
+            if end is None:
+                break
+            frames.append(bytes(self.buffer[self.offset:end]))
+            self.offset = end
+
+        if self.offset == len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        elif self.offset > len(self.buffer) / 2:
+            # each byte is moved at most once per halving, so
+            # compacting stays linear overall.
+            del self.buffer[:self.offset]
+            self.offset = 0
+        if self.pending_bytes() > self.max_frame_bytes:
+            raise FramingError(
+                'Frame longer than %i bytes' % self.max_frame_bytes)
+        return frames
+
+    def frame_end(self):
+        '''
+        @returns {int or None} --- Index in buffer just past the frame
+        starting at offset, or None if that frame is not complete yet.
+
+        @throws FramingError
+        '''
+        raise NotImplementedError()
+
+
+class LengthPrefixDecoder(FrameDecoder):
+    _LENGTH_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+    def __init__(self,header_bytes=4,big_endian=True,
+                 length_includes_header=False,
+                 max_frame_bytes=DEFAULT_MAX_FRAME_BYTES):
+        '''
+        @param {int} header_bytes --- 1, 2, 4, or 8.  The unsigned
+        length that starts each frame.
+
+        @param {bool} length_includes_header --- If True, the length
+        counts the header's own bytes too.
+
+        @throws ValueError if header_bytes is not supported.
+        '''
+        if header_bytes not in self._LENGTH_FORMATS:
+            raise ValueError('header_bytes must be 1, 2, 4, or 8')
+        super(LengthPrefixDecoder,self).__init__(max_frame_bytes)
+        self.header = struct.Struct(
+            ('>' if big_endian else '<') +
+            self._LENGTH_FORMATS[header_bytes])
+        self.length_includes_header = length_includes_header
+
+    def frame_end(self):
+        if len(self.buffer) - self.offset < self.header.size:
+            return None
+        length = self.header.unpack_from(self.buffer,self.offset)[0]
+        if self.length_includes_header:
+            if length < self.header.size:
+                raise FramingError(
+                    'Frame length %i is shorter than its header' % length)
+            frame_bytes = length
+        else:
+            frame_bytes = self.header.size + length
+        if frame_bytes > self.max_frame_bytes:
+            raise FramingError(
+                'Frame of %i bytes is longer than %i bytes' %
+                (frame_bytes,self.max_frame_bytes))
+
+        end = self.offset + frame_bytes
+        if end > len(self.buffer):
+            return None
+        return end
+
+
+class DelimiterDecoder(FrameDecoder):
+    def __init__(self,delimiter='\n',max_frame_bytes=DEFAULT_MAX_FRAME_BYTES):
+        '''
+        @param {str} delimiter --- Ends every frame.  Not empty.
+
+        @throws ValueError if delimiter is empty.
+        '''
+        if not delimiter:
+            raise ValueError('delimiter must not be empty')
+        super(DelimiterDecoder,self).__init__(max_frame_bytes)
+        self.delimiter = delimiter
+        # bytes after offset already searched without finding a
+        # delimiter, so no byte is searched twice.  Relative to offset,
+        # so compacting the buffer does not change it.
+        self.searched_bytes = 0
+
+    def reset(self):
+        self.searched_bytes = 0
+
+    def frame_end(self):
+        index = self.buffer.find(
+            self.delimiter,self.offset + self.searched_bytes)
+        if index == -1:
+            # a delimiter may start in the last few bytes.
+            self.searched_bytes = max(
+                0,
+                len(self.buffer) - self.offset - len(self.delimiter) + 1)
+            return None
+        self.searched_bytes = 0
+        return index + len(self.delimiter)
+
+
+class FixedSizeDecoder(FrameDecoder):
+    def __init__(self,frame_bytes):
+        '''
+        @param {int} frame_bytes --- Size of every frame.  Positive.
+        '''
+        if frame_bytes <= 0:
+            raise ValueError('frame_bytes must be positive')
+        super(FixedSizeDecoder,self).__init__(frame_bytes)
+        self.frame_bytes = frame_bytes
+
+    def frame_end(self):
+        end = self.offset + self.frame_bytes
+        if end > len(self.buffer):
+            return None
+        return end
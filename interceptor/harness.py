@@ -0,0 +1,177 @@
+'''
+Running a bridge from a test, without sleeping to wait for it.
+
+    with InterceptorBridge(upstream,lambda: ConstantDelayPlan(.1)) as bridge:
+        client.connect(bridge.host_port_pair().host_port_tuple())
+        client.sendall(request)
+        bridge.wait_for(BridgeEvent.DRAINED)
+
+The bridge is listening when the with block starts, on a port the
+kernel picks unless told otherwise, so tests neither sleep before
+connecting nor collide on ports, and many can run at once, each in
+its own thread.  Events are counted from the start, so waiting for
+one that has already happened returns right away.
+'''
+import socket
+import threading
+import time
+
+from interceptor.bridge import Bridge, ConnectionListener
+from interceptor.bridge import MultiConnectionBridge
+from interceptor.clock import monotonic
+from interceptor.plan import PassThroughPlan
+from interceptor.util import HostPortPair
+
+DEFAULT_WAIT_SECONDS = 10.
+# how often wait_for checks whether the bridge has drained.
+DRAIN_POLL_SECONDS = .005
+
+class BridgeEvent(object):
+    # a client connected, and the bridge connected it upstream.
+    CONNECTED = 'connected'
+    # a connection was brought down, for any reason.
+    CLOSED = 'closed'
+    # a connection was brought down by an error, eg., a reset.  Also
+    # counts as CLOSED.
+    FAILED = 'failed'
+    # the bridge holds no data.  Not counted: waiting for it waits
+    # until it is true.
+    DRAINED = 'drained'
+
+    COUNTED = (CONNECTED,CLOSED,FAILED)
+
+
+class InterceptorBridge(ConnectionListener):
+    def __init__(self,to_connect_to_host_port_pair,
+                 one_direction_plan_factory=PassThroughPlan,
+                 other_direction_plan_factory=PassThroughPlan,
+                 to_listen_on_host_port_pair=None,
+                 multi_connection=False,
+                 engine=None):
+        '''
+        @param {HostPortPair} to_connect_to_host_port_pair --- Where
+        to forward clients to.
+
+        @param {function} one_direction_plan_factory,
+        other_direction_plan_factory --- Take no arguments and return
+        a new Plan, eg., a Plan subclass.
+
+        @param {HostPortPair or None} to_listen_on_host_port_pair ---
+        If None, listen on 127.0.0.1 on any free port.  A port of 0
+        also means any free port.
+
+        @param {bool} multi_connection --- If True, forward for any
+        number of clients at once, each with its own plans.
+        Otherwise, forward for one client at a time, as Bridge does.
+
+        @param {Engine or None} engine --- See Bridge.
+        '''
+        if to_listen_on_host_port_pair is None:
+            to_listen_on_host_port_pair = HostPortPair('127.0.0.1',0)
+        if multi_connection:
+            self.bridge = MultiConnectionBridge(
+                to_listen_on_host_port_pair,one_direction_plan_factory,
+                to_connect_to_host_port_pair,other_direction_plan_factory,
+                engine=engine)
+        else:
+            self.bridge = Bridge(
+                to_listen_on_host_port_pair,None,
+                to_connect_to_host_port_pair,None,engine,
+                plan_factories=(
+                    one_direction_plan_factory,other_direction_plan_factory))
+        self.bridge.add_connection_listener(self)
+
+        self.condition = threading.Condition()
+        # BridgeEvent -> number of times it has happened.
+        self.event_counts = dict(
+            (event,0) for event in BridgeEvent.COUNTED)
+        # what brought down connections that failed, in order.
+        self.errors = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def start(self):
+        '''
+        Returns once the bridge is listening: clients may connect as
+        soon as it does.
+
+        @throws socket.error if the bridge cannot listen.
+        '''
+        try:
+            self.bridge.listen(self.bridge.listen_backlog)
+        except socket.error:
+            self.bridge.close()
+            raise
+        self.bridge.non_blocking_connection_setup()
+
+    def close(self):
+        '''
+        Stop listening, and bring down every connection.
+        '''
+        self.bridge.close(close_connections=True)
+
+    def host_port_pair(self):
+        '''
+        @returns {HostPortPair} --- What clients should connect to.
+        '''
+        return self.bridge.listening_host_port_pair()
+
+    def event_count(self,event):
+        '''
+        @param {BridgeEvent} event --- One of BridgeEvent.COUNTED.
+        '''
+        with self.condition:
+            return self.event_counts[event]
+
+    def wait_for(self,event,count=1,timeout=DEFAULT_WAIT_SECONDS):
+        '''
+        Block until event has happened count times since start, or
+        for DRAINED, until the bridge holds no data.
+
+        @param {BridgeEvent} event
+
+        @param {float or None} timeout --- Most seconds to wait.  If
+        None, wait forever.
+
+        @returns {bool} --- False if timed out.
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        if event == BridgeEvent.DRAINED:
+            while not self.bridge.drained():
+                if (deadline is not None) and (monotonic() >= deadline):
+                    return False
+                time.sleep(DRAIN_POLL_SECONDS)
+            return True
+
+        with self.condition:
+            while self.event_counts[event] < count:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def connection_started(self,connection):
+        with self.condition:
+            self.event_counts[BridgeEvent.CONNECTED] += 1
+            self.condition.notify_all()
+
+    def connection_closed(self,connection,error):
+        with self.condition:
+            if error is not None:
+                self.errors.append(error)
+                self.event_counts[BridgeEvent.FAILED] += 1
+            self.event_counts[BridgeEvent.CLOSED] += 1
+            self.condition.notify_all()
+
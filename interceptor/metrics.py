@@ -0,0 +1,236 @@
+'''
+Counters and histograms describing what bridges forward, and an HTTP
+endpoint that serves them as json.
+
+Counters on the forwarding path are plain attributes written by a
+single thread (the one reading that direction of that connection), so
+updating them costs an attribute increment and takes no lock.
+'''
+import BaseHTTPServer
+import copy
+import json
+import threading
+
+# Histogram bucket i counts values v with 2**(i-1) <= v < 2**i
+# microseconds (bucket 0 counts values under 1 microsecond).
+NUM_HISTOGRAM_BUCKETS = 40
+
+class Histogram(object):
+    '''
+    Log2-bucketed histogram of durations.  Should only be written by
+    one thread at a time.
+    '''
+    def __init__(self):
+        self.buckets = [0] * NUM_HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total_seconds = 0.
+        self.max_seconds = 0.
+
+    def record(self,seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        index = int(seconds * 1e6).bit_length() if seconds > 0 else 0
+        if index >= NUM_HISTOGRAM_BUCKETS:
+            index = NUM_HISTOGRAM_BUCKETS - 1
+        self.buckets[index] += 1
+
+    def snapshot(self):
+        # trailing empty buckets make the json noisy.
+        last_bucket = NUM_HISTOGRAM_BUCKETS
+        while last_bucket > 0 and self.buckets[last_bucket - 1] == 0:
+            last_bucket -= 1
+        return {
+            'count': self.count,
+            'total_seconds': self.total_seconds,
+            'max_seconds': self.max_seconds,
+            'log2_microsecond_buckets': self.buckets[:last_bucket],
+            }
+
+
+class DirectionMetrics(object):
+    '''
+    What one direction of one connection has forwarded.
+    '''
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.exceptions = 0
+
+    def add(self,other):
+        self.bytes += other.bytes
+        self.chunks += other.chunks
+        self.exceptions += other.exceptions
+
+    def snapshot(self):
+        return {
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'exceptions': self.exceptions,
+            }
+
+
+class BridgeMetrics(object):
+    '''
+    Totals for a bridge.  Each direction of each live connection
+    counts into its own DirectionMetrics, which is folded into the
+    bridge's totals when the connection goes away.
+    '''
+    # indices into direction lists
+    ONE_DIRECTION = 0
+    OTHER_DIRECTION = 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.retired_directions = (DirectionMetrics(),DirectionMetrics())
+        # DirectionMetrics -> direction index, for live connections.
+        self.live_directions = {}
+        self.connections_accepted = 0
+        # times a connection was brought down (down_up_connection)
+        self.connections_brought_down = 0
+
+    def new_direction(self,direction_index):
+        '''
+        @returns {DirectionMetrics} --- For a newly started direction
+        of a connection.  Pass it to retire_direction when done.
+        '''
+        direction_metrics = DirectionMetrics()
+        with self.lock:
+            self.live_directions[direction_metrics] = direction_index
+        return direction_metrics
+
+    def retire_direction(self,direction_metrics):
+        with self.lock:
+            direction_index = self.live_directions.pop(
+                direction_metrics,None)
+            if direction_index is not None:
+                self.retired_directions[direction_index].add(
+                    direction_metrics)
+
+    def connection_accepted(self):
+        with self.lock:
+            self.connections_accepted += 1
+
+    def connection_brought_down(self):
+        with self.lock:
+            self.connections_brought_down += 1
+
+    def snapshot(self):
+        with self.lock:
+            totals = (DirectionMetrics(),DirectionMetrics())
+            for direction_index in (self.ONE_DIRECTION,self.OTHER_DIRECTION):
+                totals[direction_index].add(
+                    self.retired_directions[direction_index])
+            for direction_metrics, direction_index in (
+                self.live_directions.items()):
+                totals[direction_index].add(direction_metrics)
+
+            return {
+                'connections_accepted': self.connections_accepted,
+                'connections_brought_down': self.connections_brought_down,
+                'live_connections': len(self.live_directions) / 2,
+                'one_direction': totals[self.ONE_DIRECTION].snapshot(),
+                'other_direction': totals[self.OTHER_DIRECTION].snapshot(),
+                }
+
+
+def bridge_snapshot(bridge):
+    '''
+    @returns {dict} --- bridge's metrics and those of the plans it is
+    currently using.
+    '''
+    snapshot = bridge.metrics.snapshot()
+    snapshot['listen'] = '%s:%i' % (
+        bridge.to_listen_on_host_port_pair.host,
+        bridge.to_listen_on_host_port_pair.port)
+    snapshot['connect_to'] = '%s:%i' % (
+        bridge.to_connect_to_host_port_pair.host,
+        bridge.to_connect_to_host_port_pair.port)
+    if bridge.upstream_pool is not None:
+        snapshot['upstream_pool'] = bridge.upstream_pool.snapshot()
+    snapshot['plans'] = [
+        plan.metrics_snapshot() for plan in bridge.current_plans()]
+    return snapshot
+
+
+def bridges_snapshot(bridges):
+    '''
+    @param {list} bridges --- Elements are Bridges, or None for
+    bridges this process does not run.
+
+    @returns {dict} --- The json StatsServer serves for bridges.
+    '''
+    return {
+        'bridges': [
+            None if bridge is None else bridge_snapshot(bridge)
+            for bridge in bridges],
+        }
+
+
+def combine_bridge_snapshots(snapshots):
+    '''
+    @param {list} snapshots --- Non-empty list of bridge_snapshots of
+    the same bridge, each from a different process.
+
+    @returns {dict} --- A snapshot with counters summed across
+    processes and the plans of every process.
+    '''
+    combined = copy.deepcopy(snapshots[0])
+    for snapshot in snapshots[1:]:
+        _add_snapshot(combined,snapshot)
+    return combined
+
+
+def _add_snapshot(into,snapshot):
+    for key, value in snapshot.items():
+        if key not in into:
+            into[key] = copy.deepcopy(value)
+        elif isinstance(value,dict):
+            _add_snapshot(into[key],value)
+        elif isinstance(value,list):
+            into[key].extend(copy.deepcopy(value))
+        elif isinstance(value,(int,long,float)):
+            into[key] += value
+
+
+class StatsServer(object):
+    '''
+    Serves GET /stats as json.
+    '''
+    def __init__(self,host_port_pair,snapshot_function):
+        '''
+        @param {HostPortPair} host_port_pair --- Where to listen for
+        HTTP requests.  Should usually be on localhost.
+
+        @param {function} snapshot_function --- Takes no arguments and
+        returns a json-serializable dict to serve (eg., from
+        bridges_snapshot).
+        '''
+        self.snapshot_function = snapshot_function
+        stats_server = self
+
+        class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/','/stats'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(
+                    stats_server.snapshot_function(),indent=2)
+                self.send_response(200)
+                self.send_header('Content-Type','application/json')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,format,*args):
+                # don't print a line for every request.
+                pass
+
+        self.http_server = BaseHTTPServer.HTTPServer(
+            host_port_pair.host_port_tuple(),_Handler)
+
+    def start(self):
+        t = threading.Thread(target=self.http_server.serve_forever)
+        t.setDaemon(True)
+        t.start()
@@ -1,9 +1,31 @@
-import time
+import collections
+import functools
+import math
 import random
 import argparse
-import Queue
 import threading
 
+from interceptor.clock import monotonic
+from interceptor.decisions import DecisionRecorder, load_decisions
+from interceptor.distribution import DistributionType, EmpiricalFileFormat
+from interceptor.distribution import UniformDistribution, NormalDistribution
+from interceptor.distribution import ParetoDistribution
+from interceptor.distribution import load_empirical_distribution
+from interceptor.framing import FramingType, LengthPrefixDecoder
+from interceptor.framing import DelimiterDecoder, FixedSizeDecoder
+from interceptor.framing import DEFAULT_MAX_FRAME_BYTES
+from interceptor.metrics import Histogram
+from interceptor.scheduler import get_default_scheduler
+
+# delayed chunks due at the same time are joined into writes of about
+# this many bytes.  Joining copies, so beyond this one write per chunk
+# costs less than the copy.
+COALESCE_BYTES = 64 * 1024
+# plans that queue data stop accepting more once this much is queued,
+# unless told otherwise, so that a fast sender behind a long delay or
+# a slow rate cannot grow memory without limit.
+DEFAULT_MAX_QUEUED_BYTES = 4 * 1024 * 1024
+
 def plan_from_args(plan_type,additional_args):
     '''
     @param {PlanType} plan_type
@@ -22,7 +44,9 @@ def plan_from_args(plan_type,additional_args):
                 'Error: delay plan type requires argument delay_seconds ' +
                 'to be specified.')
         seconds_to_delay = float(seconds_to_delay)
-        return ConstantDelayPlan(seconds_to_delay)
+        return ConstantDelayPlan(
+            seconds_to_delay,
+            max_queued_bytes=_max_queued_bytes_from_args(additional_args))
     elif plan_type == PlanType.RANDOM_DELAY_PLAN:
         lower_bound = additional_args.get('lower_delay_seconds',None)
         upper_bound = additional_args.get('upper_delay_seconds',None)
@@ -33,9 +57,39 @@ def plan_from_args(plan_type,additional_args):
                 'to be specified.')
         lower_bound = float(lower_bound)
         upper_bound = float(upper_bound)
-        return RandomDelayPlan(lower_bound,upper_bound)
+        pipelined = bool(additional_args.get('pipelined',False))
+        return RandomDelayPlan(
+            lower_bound,upper_bound,pipelined,
+            max_queued_bytes=_max_queued_bytes_from_args(additional_args),
+            seed=additional_args.get('seed',None),
+            recorder=_recorder_from_args(additional_args))
+    elif plan_type == PlanType.DISTRIBUTION_DELAY_PLAN:
+        return DistributionDelayPlan(
+            _distribution_from_args(additional_args),
+            bool(additional_args.get('pipelined',False)),
+            max_queued_bytes=_max_queued_bytes_from_args(additional_args),
+            seed=additional_args.get('seed',None),
+            recorder=_recorder_from_args(additional_args))
     elif plan_type == PlanType.DROP_PLAN:
         return DropPlan()
+    elif plan_type == PlanType.RATE_LIMIT_PLAN:
+        bytes_per_second = additional_args.get('bytes_per_second',None)
+        if bytes_per_second is None:
+            raise argparse.ArgumentTypeError(
+                'Error: rate limit plan requires argument ' +
+                'bytes_per_second to be specified.')
+        bytes_per_second = float(bytes_per_second)
+        burst_bytes = additional_args.get('burst_bytes',None)
+        if burst_bytes is not None:
+            burst_bytes = int(burst_bytes)
+        if (bytes_per_second <= 0) or (
+            (burst_bytes is not None) and (burst_bytes <= 0)):
+            raise argparse.ArgumentTypeError(
+                'Error: rate limit plan requires positive ' +
+                'bytes_per_second and burst_bytes.')
+        return RateLimitPlan(
+            bytes_per_second,burst_bytes,
+            max_queued_bytes=_max_queued_bytes_from_args(additional_args))
     elif plan_type == PlanType.RANDOM_FAIL_PLAN:
         failure_probability = additional_args.get('failure_probability',None)
         if failure_probability is None:
@@ -43,10 +97,218 @@ def plan_from_args(plan_type,additional_args):
                 'Error: random fail plan requires argument ' +
                 'failure_probability argument to be specified.')
 
-        return RandomFailPlan(float(failure_probability))
+        return RandomFailPlan(
+            float(failure_probability),additional_args.get('seed',None),
+            _recorder_from_args(additional_args))
+    elif plan_type == PlanType.CORRUPT_PLAN:
+        error_rate = additional_args.get('error_rate_per_byte',None)
+        if error_rate is None:
+            raise argparse.ArgumentTypeError(
+                'Error: corrupt plan requires argument ' +
+                'error_rate_per_byte to be specified.')
+        error_rate = float(error_rate)
+        if (error_rate < 0) or (error_rate > 1):
+            raise argparse.ArgumentTypeError(
+                'Error: error_rate_per_byte must be between 0 and 1.')
+        mode = additional_args.get('mode',CorruptionMode.BIT_FLIP)
+        if mode not in CorruptionMode.ALL:
+            raise argparse.ArgumentTypeError(
+                'Error: corrupt plan mode must be one of ' +
+                ', '.join(CorruptionMode.ALL))
+        return CorruptPlan(
+            error_rate,mode,additional_args.get('seed',None))
+    elif plan_type == PlanType.REPLAY_PLAN:
+        replay_path = additional_args.get('replay_path',None)
+        if replay_path is None:
+            raise argparse.ArgumentTypeError(
+                'Error: replay plan requires argument replay_path ' +
+                'to be specified.')
+        try:
+            decisions = load_decisions(replay_path)
+        except (IOError,ValueError) as ex:
+            raise argparse.ArgumentTypeError(
+                'Error: could not load replay_path: ' + str(ex))
+        return ReplayPlan(
+            decisions,
+            max_queued_bytes=_max_queued_bytes_from_args(additional_args))
+    elif plan_type == PlanType.PIPELINE_PLAN:
+        stage_params = additional_args.get('stages',None)
+        if not stage_params:
+            raise argparse.ArgumentTypeError(
+                'Error: pipeline plan requires a non-empty list ' +
+                'argument stages.')
+        stages = []
+        for stage in stage_params:
+            if (not isinstance(stage,dict)) or (
+                stage.get('type',None) is None):
+                raise argparse.ArgumentTypeError(
+                    'Error: every stage of a pipeline plan requires ' +
+                    'a type.')
+            stages.append(
+                plan_from_args(
+                    stage['type'],stage.get('additional_args',{})))
+        return PipelinePlan(stages)
+    elif plan_type == PlanType.FRAMED_PLAN:
+        return FramedPlan(
+            _decoder_from_args(additional_args),
+            _nested_plan_from_args(additional_args,'message_plan'))
+    elif plan_type == PlanType.MESSAGE_SELECT_PLAN:
+        message_indices = additional_args.get('message_indices',None)
+        every_nth = additional_args.get('every_nth',None)
+        match_hex = additional_args.get('match_hex',None)
+        if (message_indices is None) and (every_nth is None) and (
+            match_hex is None):
+            raise argparse.ArgumentTypeError(
+                'Error: message select plan requires at least one of ' +
+                'message_indices, every_nth, or match_hex.')
+        match_bytes = None
+        try:
+            if message_indices is not None:
+                message_indices = [int(index) for index in message_indices]
+            if every_nth is not None:
+                every_nth = int(every_nth)
+                if every_nth <= 0:
+                    raise ValueError('every_nth must be positive')
+            if match_hex is not None:
+                match_bytes = match_hex.decode('hex')
+        except (TypeError,ValueError) as ex:
+            raise argparse.ArgumentTypeError(
+                'Error: bad message select plan argument: ' + str(ex))
+        other_plan = None
+        if additional_args.get('other_plan',None) is not None:
+            other_plan = _nested_plan_from_args(additional_args,'other_plan')
+        return MessageSelectPlan(
+            _nested_plan_from_args(additional_args,'selected_plan'),
+            other_plan,message_indices,every_nth,
+            int(additional_args.get('match_offset',0)),match_bytes)
     
     raise argparse.ArgumentTypeError('Unknown plan type')
 
+
+def _nested_plan_from_args(additional_args,arg):
+    '''
+    @param {string} arg --- Argument of additional_args holding a plan
+    of the form {type: <string>, additional_args: {...}}.
+
+    @throws argparse.ArgumentTypeError if missing or malformed.
+    '''
+    plan_params = additional_args.get(arg,None)
+    if (not isinstance(plan_params,dict)) or (
+        plan_params.get('type',None) is None):
+        raise argparse.ArgumentTypeError(
+            'Error: argument ' + arg + ' must be a plan with a type.')
+    return plan_from_args(
+        plan_params['type'],plan_params.get('additional_args',{}))
+
+
+def _decoder_from_args(additional_args):
+    '''
+    @returns {FrameDecoder} --- For the framing arguments of framed
+    plans.
+    '''
+    framing = additional_args.get('framing',None)
+    try:
+        max_frame_bytes = int(
+            additional_args.get('max_frame_bytes',DEFAULT_MAX_FRAME_BYTES))
+        if framing == FramingType.LENGTH_PREFIX:
+            return LengthPrefixDecoder(
+                int(additional_args.get('header_bytes',4)),
+                bool(additional_args.get('big_endian',True)),
+                bool(additional_args.get('length_includes_header',False)),
+                max_frame_bytes)
+        elif framing == FramingType.DELIMITER:
+            return DelimiterDecoder(
+                str(additional_args.get('delimiter','\n')),max_frame_bytes)
+        elif framing == FramingType.FIXED_SIZE:
+            frame_bytes = additional_args.get('frame_bytes',None)
+            if frame_bytes is None:
+                raise ValueError('fixed_size framing requires frame_bytes')
+            return FixedSizeDecoder(int(frame_bytes))
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError('Error: ' + str(ex))
+    raise argparse.ArgumentTypeError(
+        'Error: framed plan requires argument framing, one of ' +
+        ', '.join(FramingType.ALL))
+
+
+def _distribution_from_args(additional_args):
+    '''
+    @returns {Distribution} --- For the distribution arguments of
+    distribution delay plans.
+    '''
+    distribution = additional_args.get('distribution',None)
+
+    def required(arg):
+        value = additional_args.get(arg,None)
+        if value is None:
+            raise ValueError(
+                '%(distribution)s distribution requires %(arg)s' %
+                { 'distribution': distribution,
+                  'arg': arg})
+        return value
+
+    try:
+        max_seconds = additional_args.get('max_delay_seconds',None)
+        if max_seconds is not None:
+            max_seconds = float(max_seconds)
+        if distribution == DistributionType.UNIFORM:
+            return UniformDistribution(
+                float(required('lower_delay_seconds')),
+                float(required('upper_delay_seconds')),max_seconds)
+        elif distribution == DistributionType.NORMAL:
+            return NormalDistribution(
+                float(required('mean_seconds')),
+                float(required('stddev_seconds')),max_seconds)
+        elif distribution == DistributionType.PARETO:
+            return ParetoDistribution(
+                float(required('scale_seconds')),
+                float(required('shape')),max_seconds)
+        elif distribution == DistributionType.EMPIRICAL:
+            return load_empirical_distribution(
+                str(required('path')),
+                additional_args.get(
+                    'file_format',EmpiricalFileFormat.SAMPLES),
+                float(additional_args.get('unit_seconds',1.)),max_seconds)
+    except (IOError,OSError,ValueError) as ex:
+        raise argparse.ArgumentTypeError('Error: ' + str(ex))
+    raise argparse.ArgumentTypeError(
+        'Error: distribution delay plan requires argument distribution, ' +
+        'one of ' + ', '.join(DistributionType.ALL))
+
+
+def _recorder_from_args(additional_args):
+    '''
+    @returns {DecisionRecorder or None} --- For the optional
+    record_path argument of plans that make random decisions.
+    '''
+    record_path = additional_args.get('record_path',None)
+    if record_path is None:
+        return None
+    try:
+        return DecisionRecorder(record_path)
+    except OSError as ex:
+        raise argparse.ArgumentTypeError(
+            'Error: could not open record_path: ' + str(ex))
+
+
+def _max_queued_bytes_from_args(additional_args):
+    '''
+    @returns {int or None} --- Optional max_queued_bytes argument of
+    plans that queue data.  DEFAULT_MAX_QUEUED_BYTES if absent; None,
+    for no cap, only if given as null.
+
+    @throws argparse.ArgumentTypeError if not positive.
+    '''
+    max_queued_bytes = additional_args.get(
+        'max_queued_bytes',DEFAULT_MAX_QUEUED_BYTES)
+    if max_queued_bytes is None:
+        return None
+    max_queued_bytes = int(max_queued_bytes)
+    if max_queued_bytes <= 0:
+        raise argparse.ArgumentTypeError(
+            'Error: max_queued_bytes must be positive.')
+    return max_queued_bytes
+
     
 class PlanType(object):
     PASS_THROUGH_PLAN = 'pass_through'
@@ -54,9 +316,25 @@ class PlanType(object):
     RANDOM_DELAY_PLAN = 'random_delay'
     DROP_PLAN = 'drop'
     RANDOM_FAIL_PLAN = 'random_fail_plan'
+    RATE_LIMIT_PLAN = 'rate_limit'
+    CORRUPT_PLAN = 'corrupt'
+    REPLAY_PLAN = 'replay'
+    PIPELINE_PLAN = 'pipeline'
+    FRAMED_PLAN = 'framed'
+    MESSAGE_SELECT_PLAN = 'message_select'
+    DISTRIBUTION_DELAY_PLAN = 'distribution_delay'
 
     
 class Plan(object):
+    # If False, the plan promises that it forwards every byte it
+    # receives, unchanged and right away, so the bridge may move the
+    # bytes itself (without copying them through python) instead of
+    # calling recv.
+    needs_payload = True
+
+    # see set_resume_callback
+    resume_callback = None
+    
     def recv(self,received_data,socket_to_send_data_to):
         '''
         Called when we read data from one socket and returns data to
@@ -66,139 +344,1138 @@ class Plan(object):
         socket.  If float, wait for this number of seconds and then
         close the socket.
         '''
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        '''
+        Like calling recv on each of received_chunks in order, but
+        plans can override it to pay per-call costs once per list.
+
+        @returns {float or None} --- See recv.  Chunks after one that
+        brings the connection down are not received.
+        '''
+        for received_data in received_chunks:
+            recv_return = self.recv(received_data,socket_to_send_data_to)
+            if recv_return is not None:
+                return recv_return
+        return None
+
     def notify_closed(self):
         '''
         Tell this plan that the connection it was forwarding for was
         closed.
         '''
+    def metrics_snapshot(self):
+        '''
+        @returns {dict} --- json-serializable description of what the
+        plan has done so far.
+        '''
+        return {'type': self.__class__.__name__}
+
+    def accepting_data(self):
+        '''
+        @returns {bool} --- If False, the bridge stops reading from
+        the socket that feeds this plan (so that TCP flow control
+        pushes back on the sender) until the plan calls its resume
+        callback.
+        '''
+        return True
+
+    def set_resume_callback(self,resume_callback):
+        '''
+        @param {function} resume_callback --- Takes no arguments.  A
+        plan that stopped accepting data calls it (from any thread)
+        once it accepts data again.  Set by the bridge.
+        '''
+        self.resume_callback = resume_callback
+
+    def idle(self):
+        '''
+        Used to swap a plan out without reordering bytes: its
+        replacement gets no data until it is idle.
+
+        @returns {bool} --- True if the plan holds no data that it
+        will still send on its own.  If False, the plan calls its
+        resume callback once it is idle.
+        '''
+        return True
+
+    def take_unsent(self):
+        '''
+        Called when the plan is swapped out, so that its replacement
+        receives what it was holding.
+
+        @returns {str} --- Bytes received but held until more arrive,
+        eg the start of a message.  The plan forgets them.
+        '''
+        return ''
 
 class PassThroughPlan(Plan):
+    needs_payload = False
+    
     def recv(self,received_data,socket_to_send_data_to):
         socket_to_send_data_to.sendall(received_data)
         return None
 
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        socket_to_send_data_to.sendall(''.join(received_chunks))
+        return None
+
     
 class DropPlan(Plan):
     def recv(self,received_data,socket_to_send_data_to):
         return None
 
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        return None
+
 class DelayDataElement(object):
     def __init__(self,data,socket,received_time_seconds):
         self.data = data
         self.socket = socket
         self.received_time_seconds = received_time_seconds
+        # when this element should be sent.  Set when the element is
+        # received or when it reaches the front of its plan's queue.
+        self.send_time_seconds = None
 
     def send_data(self):
         self.socket.sendall(self.data)
         
     
+def _coalesce(delay_data_elements):
+    '''
+    @returns {list} --- (socket, chunks) tuples, covering
+    delay_data_elements in order.  Consecutive elements for the same
+    socket share a tuple, up to about COALESCE_BYTES of them.
+    '''
+    groups = []
+    group_bytes = 0
+    for delay_data_element in delay_data_elements:
+        data = delay_data_element.data
+        if (groups and (groups[-1][0] is delay_data_element.socket) and
+            (group_bytes + len(data) <= COALESCE_BYTES)):
+            groups[-1][1].append(data)
+            group_bytes += len(data)
+        else:
+            groups.append((delay_data_element.socket,[data]))
+            group_bytes = len(data)
+    return groups
+
+
+def send_chunks(sock,chunks):
+    '''
+    Send chunks that are due together in one write, so that they leave
+    in as few segments as the kernel can manage rather than one each.
+
+    @param {socket} sock --- Or anything with sendall.  If it also has
+    sendall_many, chunks are handed to it as they are, keeping their
+    boundaries.
+    '''
+    sendall_many = getattr(sock,'sendall_many',None)
+    if sendall_many is not None:
+        sendall_many(chunks)
+    elif len(chunks) == 1:
+        sock.sendall(chunks[0])
+    else:
+        sock.sendall(''.join(chunks))
+
+
+class DelayDeviationStats(object):
+    '''
+    How far from their target send times a plan actually sent data.
+    Positive deviations mean data was sent late.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.
+        self.max_abs_seconds = 0.
+
+    def record(self,deviation_seconds):
+        self.count += 1
+        self.total_seconds += deviation_seconds
+        abs_deviation = abs(deviation_seconds)
+        if abs_deviation > self.max_abs_seconds:
+            self.max_abs_seconds = abs_deviation
+
+    def mean_seconds(self):
+        if self.count == 0:
+            return 0.
+        return self.total_seconds / self.count
+
+    
 class DelayPlan(Plan):
-    def __init__(self, sending_thread_target):
+    # whether the scheduler should work hard (spin) to send data at
+    # exactly the target time.
+    precise_timing = True
+    
+    def __init__(self,scheduler=None,deviation_callback=None,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES):
         '''
-        @param {function} --- thread to start to handle sending 
+        @param {DelayScheduler or None} scheduler --- Sends data when
+        it is due.  If None, use the scheduler shared by all plans.
+
+        @param {int or None} max_queued_bytes --- If not None, stop
+        accepting data while at least this many bytes are waiting to
+        be sent.  The queue can overshoot by up to one read.  If None,
+        the queue is unbounded, so only pass None for senders known to
+        be slower than the plan.  Either way, a bridge stops reading
+        while the socket has not taken what was sent, so a slow
+        receiver fills this queue too.
+
+        @param {function or None} deviation_callback --- If not None,
+        called with a DelayDataElement and the number of seconds after
+        its target time that it was actually sent, for every chunk
+        sent.  Called from the scheduler's thread, so should be fast.
         '''
+        if scheduler is None:
+            scheduler = get_default_scheduler()
+        self.scheduler = scheduler
+        self.deviation_callback = deviation_callback
+        self.max_queued_bytes = max_queued_bytes
+        self.deviation_stats = DelayDeviationStats()
+        
         # contains all data received so far, in order and the socket
-        # to send the data out on when ready.
-        self.data_queue = Queue.Queue()
+        # to send the data out on when ready.  Whenever it is
+        # non-empty, exactly one callback to _send_due is scheduled.
+        self.lock = threading.Lock()
+        self.data_queue = collections.deque()
+        # total size of data in data_queue
+        self.queued_bytes = 0
+        # how long each chunk waited in data_queue.  Only written from
+        # the scheduler's thread.
+        self.queued_delay_histogram = Histogram()
 
-        t = threading.Thread(target=sending_thread_target)
-        t.setDaemon(True)
-        t.start()
+        # bumped whenever the queue is cleared, so that callbacks
+        # scheduled for the old contents do nothing.
+        self.generation = 0
+        # elements taken from data_queue that _send_due has not
+        # finished sending.
+        self.num_sending = 0
+        # whether to call the resume callback once the queue empties
+        # and everything taken from it has been sent.  Set by idle.
+        self.resume_when_idle = False
+
+    def send_time_on_receive(self,delay_data_element):
+        '''
+        Called for each element as it is received, in order.
+
+        @returns {float or None} --- Time (as returned by
+        clock.monotonic) at which to send delay_data_element.  If
+        None, send_time is called when the element reaches the front
+        of the queue instead.  Times must not decrease from one
+        element to the next.
+        '''
+        return None
+    
+    def send_time(self,delay_data_element,current_time):
+        '''
+        Called once for each element whose send_time_on_receive
+        returned None, when it reaches the front of the queue.
+
+        @returns {float} --- Time (as returned by clock.monotonic) at
+        which to send delay_data_element.
+        '''
+        raise NotImplementedError()
+
+    def accepting_data(self):
+        return (
+            (self.max_queued_bytes is None) or
+            (self.queued_bytes < self.max_queued_bytes))
+
+    def idle(self):
+        with self.lock:
+            if self._idle():
+                return True
+            self.resume_when_idle = True
+            return False
+
+    def _idle(self):
+        '''
+        Must hold lock.
+        '''
+        return (not self.data_queue) and (self.num_sending == 0)
 
     def notify_closed(self):
-        with self.data_queue.queue.mutex:
-            self.data_queue.queue.clear()
+        with self.lock:
+            resume = (not self.accepting_data()) or self.resume_when_idle
+            self.data_queue.clear()
+            self.queued_bytes = 0
+            self.generation += 1
+            self.resume_when_idle = False
+        if resume:
+            self._resume()
+
+    def _resume(self):
+        '''
+        Should not hold lock.
+        '''
+        resume_callback = self.resume_callback
+        if resume_callback is not None:
+            resume_callback()
+
+    def metrics_snapshot(self):
+        snapshot = super(DelayPlan,self).metrics_snapshot()
+        snapshot.update({
+                'queue_depth': len(self.data_queue),
+                'queued_bytes': self.queued_bytes,
+                'max_queued_bytes': self.max_queued_bytes,
+                'queued_delay': self.queued_delay_histogram.snapshot(),
+                'mean_deviation_seconds': (
+                    self.deviation_stats.mean_seconds()),
+                'max_abs_deviation_seconds': (
+                    self.deviation_stats.max_abs_seconds),
+                })
+        return snapshot
         
     def recv(self,received_data,socket_to_send_data_to):
-        self.data_queue.put(
-            DelayDataElement(
-                received_data,socket_to_send_data_to,
-                # FIXME: assuming time.time will give me better than
-                # second accuracy.
-                time.time()))
+        self._enqueue([received_data],socket_to_send_data_to)
         return None
 
-class ConstantDelayPlan(DelayPlan):
-    def __init__(self,seconds_to_delay_before_forwarding):
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        self._enqueue(received_chunks,socket_to_send_data_to)
+        return None
+
+    def _enqueue(self,received_chunks,socket_to_send_data_to):
         '''
-        @param {float} seconds_to_delay_before_forwarding
+        Queue each of received_chunks, taking lock just once.
         '''
-        self.seconds_to_delay_before_forwarding = (
-            seconds_to_delay_before_forwarding)
-        super(ConstantDelayPlan,self).__init__(self.sending_thread)
+        current_time = monotonic()
+        with self.lock:
+            was_empty = not self.data_queue
+            for received_data in received_chunks:
+                delay_data_element = DelayDataElement(
+                    received_data,socket_to_send_data_to,current_time)
+                delay_data_element.send_time_seconds = (
+                    self.send_time_on_receive(delay_data_element))
+                self.data_queue.append(delay_data_element)
+                self.queued_bytes += len(received_data)
+            if was_empty and self.data_queue:
+                self._schedule_head(current_time)
 
-    def sending_thread(self):
-        while True:
-            delay_data_element = self.data_queue.get()            
-            current_time = time.time()
+    def _schedule_head(self,current_time):
+        '''
+        Must hold lock and have a non-empty queue.
+        '''
+        head = self.data_queue[0]
+        if head.send_time_seconds is None:
+            head.send_time_seconds = self.send_time(head,current_time)
+        self.scheduler.schedule(
+            head.send_time_seconds,
+            functools.partial(self._send_due,self.generation),
+            self.precise_timing)
+
+    def _send_due(self,generation):
+        '''
+        Runs on the scheduler's thread.  Sends every element at the
+        front of the queue that is due, then schedules the next one.
+        '''
+        to_send = []
+        with self.lock:
+            if generation != self.generation:
+                return
+            was_accepting = self.accepting_data()
             
-            time_should_send = (
-                self.seconds_to_delay_before_forwarding +
-                delay_data_element.received_time_seconds)
+            current_time = monotonic()
+            while self.data_queue:
+                head = self.data_queue[0]
+                if head.send_time_seconds is None:
+                    head.send_time_seconds = self.send_time(
+                        head,current_time)
+                if head.send_time_seconds > current_time:
+                    self._schedule_head(current_time)
+                    break
+                delay_data_element = self.data_queue.popleft()
+                self.queued_bytes -= len(delay_data_element.data)
+                to_send.append(delay_data_element)
+            self.num_sending += len(to_send)
+            resume = (not was_accepting) and self.accepting_data()
 
-            time_to_sleep = time_should_send - current_time
-            if time_to_sleep > 0:
-                time.sleep(time_to_sleep)
+        if resume:
+            self._resume()
 
+        current_time = monotonic()
+        for delay_data_element in to_send:
+            self.queued_delay_histogram.record(
+                current_time - delay_data_element.received_time_seconds)
+            deviation_seconds = (
+                current_time - delay_data_element.send_time_seconds)
+            self.deviation_stats.record(deviation_seconds)
+            if self.deviation_callback is not None:
+                self.deviation_callback(
+                    delay_data_element,deviation_seconds)
+
+        # in a bridge, sock never blocks: it holds what the socket
+        # cannot take yet.
+        for sock, chunks in _coalesce(to_send):
             try:
+                send_chunks(sock,chunks)
+            except:
                 # socket is closed.  everything will eventually shut
                 # down on its own.
-                delay_data_element.send_data()
-            except:
                 pass
 
+        with self.lock:
+            self.num_sending -= len(to_send)
+            resume = self.resume_when_idle and self._idle()
+            if resume:
+                self.resume_when_idle = False
+        if resume:
+            self._resume()
+
+
+class ConstantDelayPlan(DelayPlan):
+    def __init__(self,seconds_to_delay_before_forwarding,
+                 scheduler=None,deviation_callback=None,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES):
+        '''
+        @param {float} seconds_to_delay_before_forwarding
+
+        @param {DelayScheduler or None} scheduler, {function or None}
+        deviation_callback, {int or None} max_queued_bytes --- See
+        DelayPlan.
+        '''
+        self.seconds_to_delay_before_forwarding = (
+            seconds_to_delay_before_forwarding)
+        super(ConstantDelayPlan,self).__init__(
+            scheduler,deviation_callback,max_queued_bytes)
+
+    def send_time(self,delay_data_element,current_time):
+        return (
+            self.seconds_to_delay_before_forwarding +
+            delay_data_element.received_time_seconds)
+
     
-class RandomDelayPlan(DelayPlan):
+class SampledDelayPlan(DelayPlan):
+    '''
+    Delays each chunk by a sample of a Distribution.
+    '''
+    def __init__(self,distribution,pipelined=False,scheduler=None,
+                 deviation_callback=None,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES,seed=None,
+                 recorder=None):
+        '''
+        @param {Distribution} distribution --- Seconds to delay.
+
+        @param {bool} pipelined --- If False, a chunk's delay is
+        sampled once every chunk before it has been sent.  If True,
+        it is sampled as soon as the chunk is received, and the chunk
+        is sent at its own deadline, or with the chunk before it if
+        that one is due later (to keep bytes in order).  Either way,
+        all chunks that are due go out together.
+
+        @param {DelayScheduler or None} scheduler, {function or None}
+        deviation_callback, {int or None} max_queued_bytes --- See
+        DelayPlan.
+
+        @param {hashable or None} seed --- Seeds this plan's random
+        number generator.  If None, seeded from the system.
+
+        @param {DecisionRecorder or None} recorder --- If not None,
+        records each chunk's delay.
+        '''
+        self.distribution = distribution
+        self.pipelined = pipelined
+        self.random = random.Random(seed)
+        self.recorder = recorder
+
+        # send time of the last chunk received, if pipelined.
+        self.last_send_time_seconds = None
+
+        super(SampledDelayPlan,self).__init__(
+            scheduler,deviation_callback,max_queued_bytes)
+
+    def sample_delay(self):
+        '''
+        Called once per chunk, in chunk order.
+        '''
+        delay = self.distribution.sample(self.random)
+        if self.recorder is not None:
+            self.recorder.record(delay,False)
+        return delay
+
+    def send_time_on_receive(self,delay_data_element):
+        if not self.pipelined:
+            return None
+        send_time = (
+            self.sample_delay() + delay_data_element.received_time_seconds)
+        if ((self.last_send_time_seconds is not None) and
+            (self.last_send_time_seconds > send_time)):
+            send_time = self.last_send_time_seconds
+        self.last_send_time_seconds = send_time
+        return send_time
+        
+    def send_time(self,delay_data_element,current_time):
+        return (
+            self.sample_delay() +
+            delay_data_element.received_time_seconds)
+
+
+class RandomDelayPlan(SampledDelayPlan):
     def __init__(self,uniform_lower_bound_seconds,
-                 uniform_upper_bound_seconds):
+                 uniform_upper_bound_seconds,pipelined=False,
+                 scheduler=None,deviation_callback=None,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES,seed=None,
+                 recorder=None):
         '''
         @param {float} uniform_upper_bound_seconds,
         uniform_lower_bound_seconds
+
+        @param {bool} pipelined, {DelayScheduler or None} scheduler,
+        {function or None} deviation_callback, {int or None}
+        max_queued_bytes, {hashable or None} seed, {DecisionRecorder
+        or None} recorder --- See SampledDelayPlan.
         '''
         self.uniform_lower_bound_seconds = uniform_lower_bound_seconds
         self.uniform_upper_bound_seconds = uniform_upper_bound_seconds
+        super(RandomDelayPlan,self).__init__(
+            UniformDistribution(
+                uniform_lower_bound_seconds,uniform_upper_bound_seconds),
+            pipelined,scheduler,deviation_callback,max_queued_bytes,seed,
+            recorder)
 
-        super(ConstantDelayPlan,self).__init__(self.sending_thread)
 
-    def sending_thread(self):
-        while True:
-            delay_data_element = self.data_queue.get()            
-            current_time = time.time()
+class DistributionDelayPlan(SampledDelayPlan):
+    '''
+    Delays each chunk by a sample of any Distribution, such as one
+    measured on a production network path.
+    '''
 
-            seconds_to_delay_before_forwarding = random.uniform(
-                self.uniform_lower_bound_seconds,
-                self.uniform_upper_bound_seconds)
-            time_should_send = (
-                seconds_to_delay_before_forwarding +
-                delay_data_element.received_time_seconds)
 
-            time_to_sleep = time_should_send - current_time
-            if time_to_sleep > 0:
-                time.sleep(time_to_sleep)
+class RateLimitPlan(DelayPlan):
+    '''
+    Caps throughput with a token bucket.  The bucket holds at most
+    burst_bytes tokens and refills at bytes_per_second.  Sending a
+    byte costs a token, so after an idle period up to burst_bytes go
+    out at once, and after that data goes out at bytes_per_second.
+    
+    Data waits on the shared scheduler rather than in a thread of its
+    own.
+    '''
+    # pacing many chunks a second does not need sub-millisecond
+    # precision, and spinning for each would burn CPU.
+    precise_timing = False
 
-            try:
-                # socket is closed.  everything will eventually shut
-                # down on its own.
-                delay_data_element.send_data()
-            except:
-                pass
+    # if not specified, the bucket holds this many seconds of data.
+    DEFAULT_BURST_SECONDS = .1
+    
+    def __init__(self,bytes_per_second,burst_bytes=None,
+                 scheduler=None,deviation_callback=None,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES):
+        '''
+        @param {float} bytes_per_second --- Long-run throughput.
+
+        @param {int or None} burst_bytes --- Size of the bucket.  If
+        None, DEFAULT_BURST_SECONDS worth of data.
+
+        @param {DelayScheduler or None} scheduler, {function or None}
+        deviation_callback, {int or None} max_queued_bytes --- See
+        DelayPlan.
+        '''
+        if burst_bytes is None:
+            burst_bytes = max(
+                1,int(bytes_per_second * self.DEFAULT_BURST_SECONDS))
+        self.bytes_per_second = float(bytes_per_second)
+        self.burst_bytes = burst_bytes
+
+        # tokens in the bucket as of tokens_time.  Only accessed while
+        # holding lock.
+        self.tokens = float(burst_bytes)
+        self.tokens_time = None
+
+        super(RateLimitPlan,self).__init__(
+            scheduler,deviation_callback,max_queued_bytes)
+
+    def recv(self,received_data,socket_to_send_data_to):
+        return self.recv_many([received_data],socket_to_send_data_to)
+
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        # a chunk bigger than the bucket could never be paid for at
+        # once, so pace it out in bucket-sized pieces.
+        pieces = []
+        for received_data in received_chunks:
+            if len(received_data) <= self.burst_bytes:
+                pieces.append(received_data)
+                continue
+            for offset in range(0,len(received_data),self.burst_bytes):
+                pieces.append(
+                    received_data[offset:offset + self.burst_bytes])
+        self._enqueue(pieces,socket_to_send_data_to)
+        return None
+
+    def send_time(self,delay_data_element,current_time):
+        if self.tokens_time is None:
+            self.tokens_time = current_time
+
+        # elements are sent in order, so none can go out before the
+        # previous one did.
+        send_time = max(current_time,self.tokens_time)
+        self.tokens = min(
+            self.burst_bytes,
+            self.tokens +
+            (send_time - self.tokens_time) * self.bytes_per_second)
+        self.tokens_time = send_time
+
+        num_bytes = len(delay_data_element.data)
+        if self.tokens < num_bytes:
+            # wait until the bucket has refilled enough.
+            send_time += (num_bytes - self.tokens) / self.bytes_per_second
+            self.tokens = num_bytes
+            self.tokens_time = send_time
+        self.tokens -= num_bytes
+        return send_time
+
+
+class ReplayPlan(DelayPlan):
+    '''
+    Makes the decisions a DecisionRecorder recorded, chunk by chunk:
+    delays each chunk by its recorded delay, and brings the
+    connection down after chunks that recorded a failure.  Looking up
+    a chunk's decision is an array index, so replaying costs no more
+    than the plan that was recorded.
+
+    Chunks past the end of the recording are forwarded without delay.
+    '''
+    def __init__(self,decisions,scheduler=None,deviation_callback=None,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES):
+        '''
+        @param {decisions.Decisions} decisions --- From
+        decisions.load_decisions.
+
+        @param {DelayScheduler or None} scheduler, {function or None}
+        deviation_callback, {int or None} max_queued_bytes --- See
+        DelayPlan.
+        '''
+        self.decisions = decisions
+        # index of the next chunk to be received.  Only accessed from
+        # the thread calling recv.
+        self.chunk_index = 0
+        # delay of the chunk being received
+        self.delay_seconds = 0
+        # send time of the last chunk received.
+        self.last_send_time_seconds = None
+        super(ReplayPlan,self).__init__(
+            scheduler,deviation_callback,max_queued_bytes)
+
+    def recv(self,received_data,socket_to_send_data_to):
+        chunk_index = self.chunk_index
+        self.chunk_index += 1
+        self.delay_seconds = 0
+        if chunk_index < len(self.decisions):
+            if self.decisions.failed[chunk_index]:
+                # recordings with failures come from fail plans, which
+                # never delay, so nothing is queued ahead of this.
+                socket_to_send_data_to.sendall(received_data)
+                return self.decisions.delays[chunk_index]
+            self.delay_seconds = self.decisions.delays[chunk_index]
+        return super(ReplayPlan,self).recv(
+            received_data,socket_to_send_data_to)
+
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        # each chunk has its own decision.
+        return Plan.recv_many(self,received_chunks,socket_to_send_data_to)
+
+    def send_time_on_receive(self,delay_data_element):
+        send_time = (
+            self.delay_seconds + delay_data_element.received_time_seconds)
+        # keep bytes in order, as the recorded plan did.
+        if ((self.last_send_time_seconds is not None) and
+            (self.last_send_time_seconds > send_time)):
+            send_time = self.last_send_time_seconds
+        self.last_send_time_seconds = send_time
+        return send_time
 
+    
 class RandomFailConstantDelayPlan(Plan):
-    def __init__(self,failure_probability,seconds_to_wait_to_fail):
+    def __init__(self,failure_probability,seconds_to_wait_to_fail,
+                 seed=None,recorder=None):
         '''
         @param {float} failure_probability, seconds_to_wait_to_fail
+
+        @param {hashable or None} seed, {DecisionRecorder or None}
+        recorder --- See SampledDelayPlan.  Records whether each chunk
+        failed.
         '''
         self.failure_probability = failure_probability
         self.seconds_to_wait_to_fail = seconds_to_wait_to_fail
+        self.random = random.Random(seed)
+        self.recorder = recorder
         
     def recv(self,received_data,socket_to_send_data_to):
         socket_to_send_data_to.sendall(received_data)
-        if random.random() < self.failure_probability:
+        failed = self.random.random() < self.failure_probability
+        if self.recorder is not None:
+            self.recorder.record(
+                self.seconds_to_wait_to_fail if failed else 0,failed)
+        if failed:
             # fail instantly
             return self.seconds_to_wait_to_fail
         return None
 
             
 class RandomFailPlan(RandomFailConstantDelayPlan):
-    def __init__(self,failure_probability):
-        super(RandomFailPlan,self).__init__(failure_probability,0)
+    def __init__(self,failure_probability,seed=None,recorder=None):
+        super(RandomFailPlan,self).__init__(
+            failure_probability,0,seed,recorder)
+
+
+class CorruptionMode(object):
+    # flip one random bit of the byte
+    BIT_FLIP = 'bit_flip'
+    # replace the byte with a different, random, one
+    OVERWRITE = 'overwrite'
+    # drop the byte and the rest of its chunk
+    TRUNCATE = 'truncate'
+
+    ALL = (BIT_FLIP,OVERWRITE,TRUNCATE)
+
+
+class CorruptPlan(Plan):
+    '''
+    Forwards data right away, but each byte is corrupted with
+    probability error_rate_per_byte.
+
+    Rather than rolling for every byte, we draw the number of clean
+    bytes before the next error from a geometric distribution and
+    count it down across chunks.  A chunk with no error in it is
+    forwarded as is, without being copied or looked at.
+    '''
+    def __init__(self,error_rate_per_byte,mode=CorruptionMode.BIT_FLIP,
+                 seed=None):
+        '''
+        @param {float} error_rate_per_byte --- Between 0 and 1.
+
+        @param {CorruptionMode} mode
+
+        @param {hashable or None} seed --- Seeds this plan's random
+        number generator, so that the same seed corrupts the same
+        bytes of the same stream.  If None, seeded from the system.
+        '''
+        self.error_rate_per_byte = error_rate_per_byte
+        self.mode = mode
+        self.random = random.Random(seed)
+        if error_rate_per_byte <= 0:
+            self.log_clean_probability = None
+        elif error_rate_per_byte >= 1:
+            self.log_clean_probability = float('-inf')
+        else:
+            # log1p keeps tiny rates from rounding to log(1) == 0.
+            self.log_clean_probability = math.log1p(-error_rate_per_byte)
+            if self.log_clean_probability == 0:
+                # too rare to ever happen.
+                self.log_clean_probability = None
+
+        # clean bytes to forward before the next error.  None if there
+        # will never be one.
+        self.bytes_until_error = self._sample_gap()
+        self.corrupted_bytes = 0
+        self.truncated_chunks = 0
+
+    def _sample_gap(self):
+        '''
+        @returns {int or None} --- Number of clean bytes before the
+        next error.  None if there will never be one.
+        '''
+        if self.log_clean_probability is None:
+            return None
+        if self.log_clean_probability == float('-inf'):
+            return 0
+        # inverse of the geometric distribution's cdf.  1 - random()
+        # is in (0,1], so its log is finite.
+        gap = (
+            math.log(1 - self.random.random()) /
+            self.log_clean_probability)
+        if gap == float('inf'):
+            # the rate is so small that the quotient overflowed.
+            return None
+        return int(gap)
+
+    def metrics_snapshot(self):
+        snapshot = super(CorruptPlan,self).metrics_snapshot()
+        snapshot.update({
+                'corrupted_bytes': self.corrupted_bytes,
+                'truncated_chunks': self.truncated_chunks,
+                })
+        return snapshot
+
+    def recv(self,received_data,socket_to_send_data_to):
+        num_bytes = len(received_data)
+        if (self.bytes_until_error is None) or (
+            self.bytes_until_error >= num_bytes):
+            if self.bytes_until_error is not None:
+                self.bytes_until_error -= num_bytes
+            socket_to_send_data_to.sendall(received_data)
+            return None
+
+        position = self.bytes_until_error
+        if self.mode == CorruptionMode.TRUNCATE:
+            received_data = received_data[:position]
+            self.truncated_chunks += 1
+            self.corrupted_bytes += 1
+            # the dropped bytes never count towards the next error.
+            self.bytes_until_error = self._sample_gap()
+        else:
+            corrupted = bytearray(received_data)
+            while position < num_bytes:
+                if self.mode == CorruptionMode.BIT_FLIP:
+                    corrupted[position] ^= 1 << self.random.randrange(8)
+                else:
+                    corrupted[position] = (
+                        corrupted[position] +
+                        self.random.randrange(1,256)) % 256
+                self.corrupted_bytes += 1
+                gap = self._sample_gap()
+                if gap is None:
+                    # no further errors.
+                    position = None
+                    break
+                position += 1 + gap
+            if position is None:
+                self.bytes_until_error = None
+            else:
+                self.bytes_until_error = position - num_bytes
+            received_data = bytes(corrupted)
+
+        if received_data:
+            socket_to_send_data_to.sendall(received_data)
+        return None
+
+
+class PipelinePlan(Plan):
+    '''
+    Runs data through a list of plans, in order.  What each stage
+    sends goes to the next stage instead of to the socket, and what
+    the last stage sends goes to the socket.  Eg, delaying, then rate
+    limiting, then failing 1% of the time.
+
+    Whatever a stage sends while receiving is collected and handed to
+    the next stage as one list, through recv_many.  Stages that send
+    later, like delays, hand what they send to the next stage from
+    the thread they send from.  Stages only ever run one thread at a
+    time, so stateful stages see their data in order, and seeded runs
+    are reproducible.
+    '''
+    def __init__(self,stages):
+        '''
+        @param {list} stages --- Plans.  Must not be shared with other
+        pipelines or bridges.
+        '''
+        self.stages = stages
+        self.outlets = [
+            _StageOutlet(self,stage_index + 1)
+            for stage_index in range(0,len(stages))]
+        # the pipeline forwards unchanged if all its stages do.
+        self.needs_payload = any(stage.needs_payload for stage in stages)
+        for stage in stages:
+            stage.set_resume_callback(self._resume)
+
+        # held while running stages, from recv or from a stage that
+        # sends later.  A pipeline nested in another takes on the outer
+        # one's lock, so that the two never wait on each other.
+        self.lock = threading.RLock()
+        # what the last stage sends to.  Set by the first recv.
+        self.socket_to_send_data_to = None
+        # if a stage asked to bring the connection down while sending
+        # later, how long to wait first.  Nothing is forwarded after.
+        self.failure_seconds = None
+
+    def recv(self,received_data,socket_to_send_data_to):
+        return self.recv_many([received_data],socket_to_send_data_to)
+
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        outer_pipeline = getattr(socket_to_send_data_to,'pipeline',None)
+        if outer_pipeline is not None:
+            # the outer pipeline holds its lock while calling us.
+            self.lock = outer_pipeline.lock
+        with self.lock:
+            self.socket_to_send_data_to = socket_to_send_data_to
+            if self.failure_seconds is not None:
+                return self.failure_seconds
+            return self.run_stages(0,received_chunks)
+
+    def run_stages(self,stage_index,chunks):
+        '''
+        Must hold lock.  Run chunks through the stages from
+        stage_index on, in the calling thread, for as long as they
+        forward right away.
+
+        @returns {float or None} --- See recv.  The first stage to ask
+        to bring the connection down decides how long to wait, but
+        what it forwarded first still goes through the later stages.
+        '''
+        recv_return = None
+        while chunks and (stage_index < len(self.stages)):
+            outlet = self.outlets[stage_index]
+            outlet.local.batch = []
+            try:
+                stage_return = self.stages[stage_index].recv_many(
+                    chunks,outlet)
+            finally:
+                chunks = outlet.local.batch
+                outlet.local.batch = None
+            if recv_return is None:
+                recv_return = stage_return
+            stage_index += 1
+
+        if chunks and (stage_index == len(self.stages)):
+            self.socket_to_send_data_to.sendall(''.join(chunks))
+        return recv_return
+
+    def forward_later(self,stage_index,chunks):
+        '''
+        Called when a stage sends outside of its recv.
+        '''
+        with self.lock:
+            if self.failure_seconds is not None:
+                return
+            recv_return = self.run_stages(stage_index,chunks)
+            if recv_return is None:
+                return
+            self.failure_seconds = recv_return
+        self._close_after(recv_return)
+
+    def fail_later(self,seconds):
+        '''
+        Called when a nested pipeline's stage asks, outside of its
+        recv, to bring the connection down after seconds.
+        '''
+        with self.lock:
+            if self.failure_seconds is not None:
+                return
+            self.failure_seconds = seconds
+        self._close_after(seconds)
+
+    def _close_after(self,seconds):
+        '''
+        Should not hold lock.  Bring the connection down without
+        waiting for recv, which may never be called again: a client
+        waiting on a response sends nothing more.
+        '''
+        close_after = getattr(self.socket_to_send_data_to,'close_after',None)
+        if close_after is not None:
+            close_after(seconds)
+
+    def notify_closed(self):
+        for stage in self.stages:
+            stage.notify_closed()
+
+    def accepting_data(self):
+        for stage in self.stages:
+            if not stage.accepting_data():
+                return False
+        return True
+
+    def idle(self):
+        for stage in self.stages:
+            if not stage.idle():
+                return False
+        return True
+
+    def take_unsent(self):
+        # only the first stage holds bytes as they were received.
+        return self.stages[0].take_unsent()
+
+    def _resume(self):
+        # the bridge checks accepting_data again, so a stage resuming
+        # while another is still full is harmless.
+        resume_callback = self.resume_callback
+        if resume_callback is not None:
+            resume_callback()
+
+    def metrics_snapshot(self):
+        snapshot = super(PipelinePlan,self).metrics_snapshot()
+        snapshot['stages'] = [
+            stage.metrics_snapshot() for stage in self.stages]
+        return snapshot
+
+
+class _StageOutlet(object):
+    '''
+    Passed to a pipeline stage in place of a socket.  Sending on it
+    feeds the next stage.
+    '''
+    def __init__(self,pipeline,next_stage_index):
+        self.pipeline = pipeline
+        self.next_stage_index = next_stage_index
+        # batch is a list while the pipeline is running this outlet's
+        # stage on the current thread.
+        self.local = threading.local()
+
+    def sendall(self,data):
+        self.sendall_many([data])
+
+    def sendall_many(self,chunks):
+        '''
+        Feed chunks to the next stage as separate chunks, so stages
+        that care about chunk boundaries see the same ones behind a
+        delay as without it.
+        '''
+        batch = getattr(self.local,'batch',None)
+        if batch is not None:
+            batch.extend(chunks)
+        else:
+            self.pipeline.forward_later(self.next_stage_index,list(chunks))
+
+    def close_after(self,seconds):
+        '''
+        See _SocketOutlet.close_after.
+        '''
+        self.pipeline.fail_later(seconds)
+
+
+class FramedPlan(Plan):
+    '''
+    Reassembles the protocol's messages from reads, and hands
+    message_plan whole messages, one chunk per message, instead of
+    reads.  Bytes of a message are held back until all of it has
+    arrived.
+    '''
+    def __init__(self,decoder,message_plan):
+        '''
+        @param {FrameDecoder} decoder --- Not shared with any other
+        plan.
+
+        @param {Plan} message_plan
+        '''
+        self.decoder = decoder
+        self.message_plan = message_plan
+        self.messages = 0
+        message_plan.set_resume_callback(self._resume)
+
+    def recv(self,received_data,socket_to_send_data_to):
+        messages = self.decoder.feed(received_data)
+        if not messages:
+            return None
+        self.messages += len(messages)
+        return self.message_plan.recv_many(messages,socket_to_send_data_to)
+
+    def notify_closed(self):
+        self.message_plan.notify_closed()
+
+    def accepting_data(self):
+        return self.message_plan.accepting_data()
+
+    def idle(self):
+        return self.message_plan.idle()
+
+    def take_unsent(self):
+        return self.decoder.take_pending()
+
+    def _resume(self):
+        resume_callback = self.resume_callback
+        if resume_callback is not None:
+            resume_callback()
+
+    def metrics_snapshot(self):
+        snapshot = super(FramedPlan,self).metrics_snapshot()
+        snapshot.update({
+                'messages': self.messages,
+                'partial_message_bytes': self.decoder.pending_bytes(),
+                'message_plan': self.message_plan.metrics_snapshot(),
+                })
+        return snapshot
+
+
+class MessageSelectPlan(Plan):
+    '''
+    Hands the messages it selects to selected_plan and the others to
+    other_plan.  Eg, dropping the fifth message, or delaying only
+    heartbeats.  Meant as the message_plan of a FramedPlan, so that
+    each chunk it receives is a message.
+
+    If the two plans forward after different delays, selected and
+    other messages can be reordered relative to each other.
+    '''
+    def __init__(self,selected_plan,other_plan=None,message_indices=None,
+                 every_nth=None,match_offset=0,match_bytes=None):
+        '''
+        A message is selected if it matches any of the criteria given.
+
+        @param {Plan or None} other_plan --- If None, forward other
+        messages unchanged.
+
+        @param {list or None} message_indices --- Indices of messages
+        to select.  0 is the first message.
+
+        @param {int or None} every_nth --- Select the nth message,
+        the 2nth, and so on.
+
+        @param {int} match_offset, {str or None} match_bytes --- Select
+        messages that have match_bytes starting match_offset bytes in.
+        For length prefixed messages, the offset counts the header.
+        '''
+        if other_plan is None:
+            other_plan = PassThroughPlan()
+        self.selected_plan = selected_plan
+        self.other_plan = other_plan
+        self.message_indices = frozenset(message_indices or ())
+        self.every_nth = every_nth
+        self.match_offset = match_offset
+        self.match_bytes = match_bytes
+        for plan in (selected_plan,other_plan):
+            plan.set_resume_callback(self._resume)
+
+        # index of the next message received.
+        self.message_index = 0
+        self.selected_messages = 0
+
+    def selects(self,message,message_index):
+        return (
+            (message_index in self.message_indices) or
+            ((self.every_nth is not None) and
+             ((message_index + 1) % self.every_nth == 0)) or
+            ((self.match_bytes is not None) and
+             message.startswith(self.match_bytes,self.match_offset)))
+
+    def recv(self,received_data,socket_to_send_data_to):
+        return self.recv_many([received_data],socket_to_send_data_to)
+
+    def recv_many(self,received_chunks,socket_to_send_data_to):
+        # hand each plan runs of consecutive messages, so that the
+        # common case of few selected messages stays batched.
+        run = []
+        run_selected = False
+        for message in received_chunks:
+            selected = self.selects(message,self.message_index)
+            self.message_index += 1
+            if selected:
+                self.selected_messages += 1
+            if run and (selected != run_selected):
+                recv_return = self._recv_run(
+                    run,run_selected,socket_to_send_data_to)
+                if recv_return is not None:
+                    return recv_return
+                run = []
+            run.append(message)
+            run_selected = selected
+        if run:
+            return self._recv_run(run,run_selected,socket_to_send_data_to)
+        return None
+
+    def _recv_run(self,run,selected,socket_to_send_data_to):
+        plan = self.selected_plan if selected else self.other_plan
+        return plan.recv_many(run,socket_to_send_data_to)
+
+    def notify_closed(self):
+        self.selected_plan.notify_closed()
+        self.other_plan.notify_closed()
+
+    def accepting_data(self):
+        return (
+            self.selected_plan.accepting_data() and
+            self.other_plan.accepting_data())
+
+    def idle(self):
+        return self.selected_plan.idle() and self.other_plan.idle()
+
+    def _resume(self):
+        resume_callback = self.resume_callback
+        if resume_callback is not None:
+            resume_callback()
+
+    def metrics_snapshot(self):
+        snapshot = super(MessageSelectPlan,self).metrics_snapshot()
+        snapshot.update({
+                'messages': self.message_index,
+                'selected_messages': self.selected_messages,
+                'selected_plan': self.selected_plan.metrics_snapshot(),
+                'other_plan': self.other_plan.metrics_snapshot(),
+                })
+        return snapshot
@@ -0,0 +1,135 @@
+import collections
+import select
+import socket
+import threading
+import time
+
+from interceptor.util import Backoff, wait_readable
+
+class UpstreamConnectionPool(object):
+    '''
+    Keeps up to size connections to a host open before anyone needs
+    them, so that an accepted client can be paired with an upstream
+    connection without waiting for a handshake.  A background thread
+    replaces connections as they are taken, backing off while the
+    host refuses connections.
+    '''
+    def __init__(self,host_port_pair,size):
+        '''
+        @param {HostPortPair} host_port_pair --- Where to connect to.
+
+        @param {int} size --- Most idle connections to keep open.
+        '''
+        self.host_port_pair = host_port_pair
+        self.size = size
+
+        self.lock = threading.Lock()
+        # notified when a connection is taken from idle_sockets.
+        self.condition = threading.Condition(self.lock)
+        self.idle_sockets = collections.deque()
+        self.thread = None
+        self.closed = False
+
+        # how many times get returned a pooled connection, found the
+        # pool empty, and threw away a connection the other side had
+        # closed.
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def start(self):
+        '''
+        Start filling the pool.  Safe to call multiple times.
+        '''
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._refill)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def get(self):
+        '''
+        Non-blocking.
+
+        @returns {socket or None} --- A connected socket, or None if
+        the pool has none ready.
+        '''
+        while True:
+            with self.condition:
+                if self.closed or (not self.idle_sockets):
+                    self.misses += 1
+                    return None
+                sock = self.idle_sockets.popleft()
+                self.condition.notify()
+
+            if _is_open(sock):
+                with self.lock:
+                    self.hits += 1
+                return sock
+
+            with self.lock:
+                self.stale += 1
+            sock.close()
+
+    def close(self):
+        '''
+        Close every idle connection and stop making new ones.  get
+        returns None from now on.
+        '''
+        with self.condition:
+            self.closed = True
+            idle_sockets = list(self.idle_sockets)
+            self.idle_sockets.clear()
+            self.condition.notify()
+        for sock in idle_sockets:
+            sock.close()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'idle': len(self.idle_sockets),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                }
+
+    def _refill(self):
+        backoff = Backoff()
+        while True:
+            with self.condition:
+                while (len(self.idle_sockets) >= self.size) and (
+                    not self.closed):
+                    self.condition.wait()
+                if self.closed:
+                    return
+
+            sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            try:
+                sock.connect(self.host_port_pair.host_port_tuple())
+            except socket.error:
+                sock.close()
+                time.sleep(backoff.next_delay())
+                continue
+
+            backoff.reset()
+            with self.lock:
+                if not self.closed:
+                    self.idle_sockets.append(sock)
+                    continue
+            sock.close()
+            return
+
+
+def _is_open(sock):
+    '''
+    @returns {bool} --- False if the other side has closed or reset
+    sock.  Data the other side already sent is left for the reader.
+    '''
+    try:
+        if not wait_readable(sock,0):
+            return True
+        return len(sock.recv(1,socket.MSG_PEEK)) != 0
+    except (socket.error,select.error):
+        return False
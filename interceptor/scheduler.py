@@ -0,0 +1,139 @@
+import errno
+import fcntl
+import heapq
+import os
+import select
+import threading
+import traceback
+
+from interceptor.clock import monotonic
+
+# select (like sleep) often wakes up tens of microseconds late.  To
+# hit deadlines more precisely, we stop waiting this long before a
+# deadline and spin for the rest.
+DEFAULT_SPIN_SECONDS = .0005
+
+class DelayScheduler(object):
+    '''
+    A single thread that runs callbacks at requested times.  Every
+    delay plan sharing a scheduler sends its data from this thread, so
+    the number of threads does not grow with the number of plans.
+
+    Callbacks run one at a time, so must never block: one that did
+    would hold up every other callback on the same scheduler.  Plans
+    in a bridge send to outlets that hold what the socket cannot take
+    rather than wait for a receiver that is not reading.
+    '''
+    def __init__(self,spin_seconds=DEFAULT_SPIN_SECONDS):
+        '''
+        @param {float} spin_seconds --- Busy-wait for at most this long
+        before each deadline instead of sleeping.  0 never spins.
+        '''
+        self.spin_seconds = spin_seconds
+        self.lock = threading.Lock()
+        # heap of (time_seconds, sequence, callback, precise).
+        # sequence breaks ties so that callbacks scheduled for the
+        # same time run in the order they were scheduled.
+        self.heap = []
+        self.sequence = 0
+
+        # written to when a callback is scheduled earlier than the one
+        # the scheduling thread is currently waiting for.
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_read_fd,self.wakeup_write_fd):
+            flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+            fcntl.fcntl(fd,fcntl.F_SETFL,flags | os.O_NONBLOCK)
+
+        self.thread = None
+
+    def schedule(self,time_seconds,callback,precise=True):
+        '''
+        Run callback() on the scheduler's thread at time_seconds (as
+        returned by clock.monotonic).  Safe to call from any thread.
+
+        @param {bool} precise --- If False, the scheduler will not
+        spin to hit time_seconds exactly.  Callers that schedule many
+        deadlines a second and can tolerate some lateness should pass
+        False to save CPU.
+        '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+            self.sequence += 1
+            earliest = (not self.heap) or (time_seconds < self.heap[0][0])
+            heapq.heappush(
+                self.heap,(time_seconds,self.sequence,callback,precise))
+
+        if earliest:
+            try:
+                os.write(self.wakeup_write_fd,'x')
+            except OSError as inst:
+                if inst.errno != errno.EAGAIN:
+                    raise
+
+    def _run(self):
+        while True:
+            with self.lock:
+                deadline = None
+                timeout = None
+                if self.heap:
+                    deadline, _, _, precise = self.heap[0]
+                    timeout = deadline - monotonic()
+                    if precise:
+                        timeout -= self.spin_seconds
+                    timeout = max(0,timeout)
+
+            if timeout != 0:
+                # unlike sleep, select lets schedule wake us early.
+                try:
+                    select.select([self.wakeup_read_fd],[],[],timeout)
+                except select.error as inst:
+                    if inst.args[0] != errno.EINTR:
+                        raise
+                self._drain_wakeup()
+                # something may have been scheduled earlier while we
+                # were waiting.
+                continue
+
+            while monotonic() < deadline:
+                pass
+
+            # release everything that is due at once.
+            due = []
+            with self.lock:
+                now = monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+
+            for callback in due:
+                try:
+                    callback()
+                except Exception as inst:
+                    print '[DEBUG] Exception in delay scheduler callback'
+                    traceback.print_exc()
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_read_fd,4096):
+                pass
+        except OSError as inst:
+            if inst.errno != errno.EAGAIN:
+                raise
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+def get_default_scheduler():
+    '''
+    @returns {DelayScheduler} --- Shared by all plans that were not
+    given a scheduler explicitly.
+    '''
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = DelayScheduler()
+        return _default_scheduler
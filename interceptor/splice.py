@@ -0,0 +1,56 @@
+'''
+Moves bytes between file descriptors inside the kernel with Linux's
+splice(2).  Uses os.splice where Python provides it, and otherwise
+calls libc directly.  On other platforms, splice_available returns
+False and callers should copy through user space instead.
+'''
+import ctypes
+import ctypes.util
+import os
+import sys
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+
+def _load_libc_splice():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        libc_splice = libc.splice
+    except (OSError,AttributeError):
+        return None
+    libc_splice.argtypes = [
+        ctypes.c_int,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,
+        ctypes.c_size_t,ctypes.c_uint]
+    libc_splice.restype = ctypes.c_ssize_t
+    return libc_splice
+
+_os_splice = getattr(os,'splice',None)
+_libc_splice = None
+if _os_splice is None:
+    _libc_splice = _load_libc_splice()
+
+def splice_available():
+    return (_os_splice is not None) or (_libc_splice is not None)
+
+def splice(fd_in,fd_out,length,flags=0):
+    '''
+    Move up to length bytes from fd_in to fd_out.  One of them must
+    be a pipe.
+
+    @returns {int} --- Number of bytes moved.  0 means fd_in reached
+    end of file.
+
+    @throws OSError on failure, including EAGAIN when flags contains
+    SPLICE_F_NONBLOCK and nothing could be moved.
+    '''
+    if _os_splice is not None:
+        return _os_splice(fd_in,fd_out,length,flags=flags)
+
+    result = _libc_splice(fd_in,None,fd_out,None,length,flags)
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err,os.strerror(err))
+    return result
@@ -0,0 +1,188 @@
+'''
+Running bridges in several worker processes, so that forwarding is
+not limited to the one core a single python process can use.
+'''
+import multiprocessing
+import threading
+import time
+
+from interceptor.clock import monotonic
+from interceptor.engine import engine_from_type, set_default_engine
+from interceptor.metrics import bridges_snapshot, combine_bridge_snapshots
+
+# how often the supervisor checks for workers that have died.
+RESTART_CHECK_SECONDS = .5
+# how long to wait for a worker to report its metrics.
+SNAPSHOT_TIMEOUT_SECONDS = 2.
+
+class Supervisor(object):
+    '''
+    Runs a list of bridges across num_workers processes.  Every worker
+    runs every multi connection bridge, all listening on the same
+    port with SO_REUSEPORT, so the kernel spreads accepted clients
+    across workers.  A single connection bridge only ever forwards for
+    one client at a time, so each runs in just one worker, assigned
+    round robin.
+
+    Workers that die are restarted.  Their connections are lost, as
+    if their plans had failed.
+    '''
+    def __init__(self,bridge_descriptions,num_workers,engine_type):
+        '''
+        @param {list} bridge_descriptions --- config.BridgeDescriptions.
+
+        @param {int} num_workers --- Number of worker processes.
+
+        @param {EngineType} engine_type --- Engine each worker uses.
+        '''
+        self.bridge_descriptions = bridge_descriptions
+        self.num_workers = num_workers
+        self.engine_type = engine_type
+        self.workers = [
+            _WorkerHandle(worker_index) for worker_index in
+            range(0,num_workers)]
+
+    def start(self):
+        for worker in self.workers:
+            self._start_worker(worker)
+
+    def run_forever(self):
+        '''
+        Restart workers that die.  Blocking.
+        '''
+        while True:
+            time.sleep(RESTART_CHECK_SECONDS)
+            self.restart_dead_workers()
+
+    def restart_dead_workers(self):
+        for worker in self.workers:
+            with worker.lock:
+                if worker.process.is_alive():
+                    continue
+                print (
+                    '[DEBUG] Restarting worker %(index)i, which exited ' +
+                    'with %(exitcode)s') % {
+                    'index': worker.worker_index,
+                    'exitcode': worker.process.exitcode}
+                worker.restarts += 1
+            self._start_worker(worker)
+
+    def snapshot(self):
+        '''
+        @returns {dict} --- Like metrics.bridges_snapshot, with every
+        bridge's metrics combined across workers, plus a description
+        of each worker.
+        '''
+        worker_snapshots = [worker.snapshot() for worker in self.workers]
+
+        bridges = []
+        for bridge_index in range(0,len(self.bridge_descriptions)):
+            snapshots = [
+                worker_snapshot['bridges'][bridge_index]
+                for worker_snapshot in worker_snapshots
+                if (worker_snapshot is not None) and
+                (worker_snapshot['bridges'][bridge_index] is not None)]
+            if snapshots:
+                bridges.append(combine_bridge_snapshots(snapshots))
+            else:
+                bridges.append(None)
+
+        return {
+            'workers': [worker.description() for worker in self.workers],
+            'bridges': bridges,
+            }
+
+    def _start_worker(self,worker):
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(self.bridge_descriptions,worker.worker_index,
+                  self.num_workers,self.engine_type,child_connection))
+        process.daemon = True
+        process.start()
+        # the child has its own copy.
+        child_connection.close()
+        with worker.lock:
+            worker.process = process
+            worker.connection = parent_connection
+
+
+class _WorkerHandle(object):
+    '''
+    The supervisor's side of one worker slot.  The process in it
+    changes when the worker is restarted.
+    '''
+    def __init__(self,worker_index):
+        self.worker_index = worker_index
+        self.lock = threading.Lock()
+        self.process = None
+        # multiprocessing Connection for asking the worker for metrics.
+        self.connection = None
+        self.restarts = 0
+        # lets us ignore replies to requests that timed out.
+        self.request_id = 0
+
+    def description(self):
+        with self.lock:
+            return {
+                'index': self.worker_index,
+                'pid': self.process.pid,
+                'alive': self.process.is_alive(),
+                'restarts': self.restarts,
+                }
+
+    def snapshot(self):
+        '''
+        @returns {dict or None} --- The worker's bridges_snapshot, or
+        None if it did not answer in time.
+        '''
+        with self.lock:
+            self.request_id += 1
+            try:
+                self.connection.send(self.request_id)
+                deadline = monotonic() + SNAPSHOT_TIMEOUT_SECONDS
+                while True:
+                    timeout = deadline - monotonic()
+                    if (timeout <= 0) or (not self.connection.poll(timeout)):
+                        return None
+                    request_id, snapshot = self.connection.recv()
+                    if request_id == self.request_id:
+                        return snapshot
+            except (EOFError,IOError):
+                # worker died; it will be restarted.
+                return None
+
+
+def _run_worker(bridge_descriptions,worker_index,num_workers,engine_type,
+                connection):
+    '''
+    Main function of a worker process.  Starts its bridges and then
+    answers requests for metrics until the supervisor goes away.
+    '''
+    set_default_engine(engine_from_type(engine_type))
+
+    # None for bridges another worker runs, so indices match across
+    # workers.
+    bridges = []
+    capture_suffix = '.worker%i' % worker_index
+    for bridge_index in range(0,len(bridge_descriptions)):
+        bridge_description = bridge_descriptions[bridge_index]
+        if bridge_description.multi_connection:
+            bridges.append(
+                bridge_description.make_bridge(True,capture_suffix))
+        elif bridge_index % num_workers == worker_index:
+            bridges.append(
+                bridge_description.make_bridge(False,capture_suffix))
+        else:
+            bridges.append(None)
+
+    for bridge in bridges:
+        if bridge is not None:
+            bridge.non_blocking_connection_setup()
+
+    while True:
+        try:
+            request_id = connection.recv()
+        except (EOFError,IOError):
+            return
+        connection.send((request_id,bridges_snapshot(bridges)))
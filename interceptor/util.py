@@ -1,4 +1,10 @@
+import random
+import select
 
+# connection retries start out waiting about this long, and wait at
+# most DEFAULT_MAX_BACKOFF_SECONDS.
+DEFAULT_INITIAL_BACKOFF_SECONDS = .005
+DEFAULT_MAX_BACKOFF_SECONDS = .5
 
 class HostPortPair(object):
     def __init__(self,host,port):
@@ -7,3 +13,55 @@ class HostPortPair(object):
         
     def host_port_tuple(self):
         return (self.host,self.port)
+
+
+class Backoff(object):
+    '''
+    Jittered exponential backoff between retries.  The ceiling on the
+    delay doubles after every failure, up to max_seconds, and each
+    delay is drawn from the upper half of the current ceiling so that
+    bridges retrying against the same host spread out.
+    '''
+    def __init__(self,initial_seconds=DEFAULT_INITIAL_BACKOFF_SECONDS,
+                 max_seconds=DEFAULT_MAX_BACKOFF_SECONDS):
+        self.initial_seconds = initial_seconds
+        self.max_seconds = max_seconds
+        self.ceiling_seconds = initial_seconds
+
+    def next_delay(self):
+        '''
+        @returns {float} --- Seconds to wait before the next retry.
+        '''
+        delay = random.uniform(
+            self.ceiling_seconds / 2.,self.ceiling_seconds)
+        self.ceiling_seconds = min(
+            self.max_seconds,self.ceiling_seconds * 2)
+        return delay
+
+    def reset(self):
+        '''
+        Call after a success, so that the next failure retries
+        quickly again.
+        '''
+        self.ceiling_seconds = self.initial_seconds
+
+
+def wait_readable(sock,timeout=None):
+    '''
+    Block until sock is readable, or the other side has closed it.
+    Unlike select.select, works however large sock's file descriptor
+    is, which matters once thousands of sockets are open.
+
+    @param {float or None} timeout --- Most seconds to wait.  If
+    None, wait forever.
+
+    @returns {bool} --- False if timed out.
+    '''
+    if not hasattr(select,'poll'):
+        readable, _, _ = select.select([sock],[],[],timeout)
+        return bool(readable)
+    poller = select.poll()
+    poller.register(sock,select.POLLIN)
+    if timeout is not None:
+        timeout = int(timeout * 1000)
+    return bool(poller.poll(timeout))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import threading
+import time
+import random
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import Bridge, DEFAULT_RECV_BUFFER_SIZE
+from interceptor.engine import ThreadedEngine, EventLoopEngine
+from interceptor.util import HostPortPair
+from interceptor.plan import PassThroughPlan, ConstantDelayPlan
+from interceptor.plan import DEFAULT_MAX_QUEUED_BYTES, PlanType
+from interceptor.plan import plan_from_args
+
+TEST_NAME = 'BACKPRESSURE TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+BASE_PORT = random.randint(2222,55555)
+DELAY_SECONDS = .2
+MAX_QUEUED_BYTES = 256 * 1024
+AMOUNT_OF_DATA_TO_SEND = 4 * 1024 * 1024
+# long enough that, without a cap, a fast sender queues far more than
+# DEFAULT_MAX_QUEUED_BYTES before anything is sent.
+LONG_DELAY_SECONDS = 2.
+FLOOD_SECONDS = 1.5
+
+def run():
+    '''
+    Sends data through a delay plan with a small queue cap much faster
+    than the cap and delay allow it to be forwarded, once per engine.
+    The plan's queue should never grow much past its cap, and all of
+    the data should still arrive in order.  A delay plan given no cap
+    should still keep its queue bounded.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    engines = (ThreadedEngine(),EventLoopEngine())
+    for i in range(0,len(engines)):
+        if not run_engine(engines[i],BASE_PORT + 2*i):
+            return False
+    return check_default_cap(engines[0],BASE_PORT + 2*len(engines))
+
+
+def check_default_cap(engine,base_port):
+    interposition_host_port_pair = HostPortPair('127.0.0.1',base_port)
+    to_connect_to_host_port_pair = HostPortPair('127.0.0.1',base_port + 1)
+    listener_connection = ListenerConnection(to_connect_to_host_port_pair)
+    listener_connection.start()
+
+    plan = plan_from_args(
+        PlanType.CONSTANT_DELAY_PLAN,{'delay_seconds': LONG_DELAY_SECONDS})
+    if plan.max_queued_bytes != DEFAULT_MAX_QUEUED_BYTES:
+        print '\nPlan without a cap has cap %s\n' % plan.max_queued_bytes
+        return False
+    bridge = Bridge(
+        interposition_host_port_pair,plan,
+        to_connect_to_host_port_pair,PassThroughPlan(),
+        engine)
+    time.sleep(.5)
+    bridge.non_blocking_connection_setup()
+    time.sleep(.5)
+
+    sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sending_socket.connect(interposition_host_port_pair.host_port_tuple())
+    sender = threading.Thread(target=flood,args=(sending_socket,))
+    sender.setDaemon(True)
+    sender.start()
+
+    max_queued_bytes_seen = 0
+    start_time = time.time()
+    while time.time() - start_time < FLOOD_SECONDS:
+        max_queued_bytes_seen = max(max_queued_bytes_seen,plan.queued_bytes)
+        time.sleep(.005)
+    bridge.close(close_connections=True)
+    sending_socket.close()
+
+    if max_queued_bytes_seen < DEFAULT_MAX_QUEUED_BYTES:
+        print '\nSender was too slow to fill the queue\n'
+        return False
+    if (max_queued_bytes_seen >
+        DEFAULT_MAX_QUEUED_BYTES + DEFAULT_RECV_BUFFER_SIZE):
+        print ('\nQueue without a cap grew to %(seen)i bytes\n' %
+               { 'seen': max_queued_bytes_seen})
+        return False
+    return True
+
+
+def flood(sock):
+    chunk = 'x' * 65536
+    try:
+        while True:
+            sock.sendall(chunk)
+    except socket.error:
+        # closed at the end of the test.
+        pass
+
+
+def run_engine(engine,base_port):
+    interposition_host_port_pair = HostPortPair('127.0.0.1',base_port)
+    to_connect_to_host_port_pair = HostPortPair('127.0.0.1',base_port + 1)
+    listener_connection = ListenerConnection(to_connect_to_host_port_pair)
+    listener_connection.start()
+
+    plan = ConstantDelayPlan(
+        DELAY_SECONDS,max_queued_bytes=MAX_QUEUED_BYTES)
+    bridge = Bridge(
+        interposition_host_port_pair,plan,
+        to_connect_to_host_port_pair,PassThroughPlan(),
+        engine)
+    time.sleep(.5)
+    bridge.non_blocking_connection_setup()
+    time.sleep(.5)
+
+    sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sending_socket.connect(interposition_host_port_pair.host_port_tuple())
+    expected_data = ''.join(
+        chr(ord('a') + i % 26) * 1024
+        for i in range(0,AMOUNT_OF_DATA_TO_SEND / 1024))
+    sender = threading.Thread(
+        target=sending_socket.sendall,args=(expected_data,))
+    sender.setDaemon(True)
+    sender.start()
+
+    # the cap lets through at most MAX_QUEUED_BYTES per DELAY_SECONDS.
+    timeout_seconds = 4 * (
+        DELAY_SECONDS * AMOUNT_OF_DATA_TO_SEND / MAX_QUEUED_BYTES)
+    max_queued_bytes_seen = 0
+    start_time = time.time()
+    while len(listener_connection.read_data) < len(expected_data):
+        max_queued_bytes_seen = max(max_queued_bytes_seen,plan.queued_bytes)
+        if time.time() - start_time > timeout_seconds:
+            print '\nTimed out waiting for data\n'
+            return False
+        time.sleep(.005)
+
+    if listener_connection.read_data != expected_data:
+        print '\nData received does not match data sent\n'
+        return False
+
+    # a single read can overshoot the cap.
+    if max_queued_bytes_seen > MAX_QUEUED_BYTES + DEFAULT_RECV_BUFFER_SIZE:
+        print ('\nQueue grew to %(seen)i bytes, cap is %(cap)i\n' %
+               { 'seen': max_queued_bytes_seen,
+                 'cap': MAX_QUEUED_BYTES})
+        return False
+    return True
+
+
+class ListenerConnection(threading.Thread):
+    def __init__(self,host_port_pair_to_listen_to):
+        self.host_port_pair_to_listen_to = host_port_pair_to_listen_to
+        # all data read from the connection thus far.
+        self.read_data = ''
+
+        super(ListenerConnection,self).__init__()
+        self.setDaemon(True)
+
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(self.host_port_pair_to_listen_to.host_port_tuple())
+        s.listen(1)
+        to_listen_on_socket, addr = s.accept()
+
+        while True:
+            try:
+                data = to_listen_on_socket.recv(65536)
+            except socket.error:
+                # bridge resets the connection once the test is done
+                # with it.
+                break
+            if len(data) == 0:
+                break
+            self.read_data += data
+
+
+if __name__ == '__main__':
+    run_and_print()
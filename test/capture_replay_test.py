@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.capture import CaptureWriter, RecordKind
+from interceptor.capture_replay import CaptureReplay
+from interceptor.event_loop import EventLoop
+from interceptor.metrics import BridgeMetrics
+from interceptor.util import HostPortPair
+
+TEST_NAME = 'CAPTURE REPLAY TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+TARGET_PORT = random.randint(2222,55555)
+
+NUM_CONNECTIONS = 3
+NUM_MESSAGES = 10
+SECONDS_BETWEEN_MESSAGES = .05
+NUM_COPIES = 20
+WAIT_SECONDS = 10
+
+def run():
+    '''
+    Writes a capture of a few connections sending messages at a
+    steady pace.  Replays it against a collecting server at the
+    recorded pace, four times faster, and as fast as possible, with
+    many replays at once sharing a loop.  Checks that the server gets
+    exactly what each captured client sent, over about the expected
+    time.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory,'capture')
+        expected, recorded_seconds = write_capture(path)
+
+        target_host_port_pair = HostPortPair('127.0.0.1',TARGET_PORT)
+        server = CollectingServer(target_host_port_pair)
+        server.start()
+        time.sleep(.5)
+
+        # recorded pace
+        elapsed = replay(path,target_host_port_pair,server,1.,1)
+        if elapsed is None or not check_received(server,expected,1):
+            return False
+        if elapsed < .8 * recorded_seconds:
+            print ('\nReplayed %(recorded)fs capture in %(elapsed)fs\n' %
+                   { 'recorded': recorded_seconds,
+                     'elapsed': elapsed})
+            return False
+
+        # sped up
+        elapsed = replay(path,target_host_port_pair,server,4.,1)
+        if elapsed is None or not check_received(server,expected,1):
+            return False
+        if (elapsed < .8 * recorded_seconds / 4) or (
+            elapsed > .6 * recorded_seconds):
+            print ('\nReplayed %(recorded)fs capture 4x in %(elapsed)fs\n' %
+                   { 'recorded': recorded_seconds,
+                     'elapsed': elapsed})
+            return False
+
+        # as fast as possible, many at once
+        elapsed = replay(path,target_host_port_pair,server,None,NUM_COPIES)
+        if elapsed is None or (
+            not check_received(server,expected,NUM_COPIES)):
+            return False
+        if elapsed > recorded_seconds:
+            print ('\nReplaying as fast as possible took %fs\n' % elapsed)
+            return False
+        return True
+    finally:
+        shutil.rmtree(directory)
+
+
+def write_capture(path):
+    '''
+    @returns {tuple} --- (expected, recorded_seconds).  expected is a
+    list of what each captured client sent.
+    '''
+    writer = CaptureWriter(path)
+    expected = [''] * NUM_CONNECTIONS
+    connection_ids = [
+        writer.new_connection_id() for i in range(0,NUM_CONNECTIONS)]
+    start_time = time.time()
+    for connection_id in connection_ids:
+        writer.write(connection_id,BridgeMetrics.ONE_DIRECTION,RecordKind.OPEN)
+    for i in range(0,NUM_MESSAGES):
+        for index in range(0,NUM_CONNECTIONS):
+            message = 'connection %i message %i;' % (index,i)
+            expected[index] += message
+            writer.write(
+                connection_ids[index],BridgeMetrics.ONE_DIRECTION,
+                RecordKind.DATA,message)
+            # replies should not be replayed.
+            writer.write(
+                connection_ids[index],BridgeMetrics.OTHER_DIRECTION,
+                RecordKind.DATA,'reply')
+        time.sleep(SECONDS_BETWEEN_MESSAGES)
+    for connection_id in connection_ids:
+        writer.write(
+            connection_id,BridgeMetrics.ONE_DIRECTION,RecordKind.CLOSE)
+    recorded_seconds = time.time() - start_time
+    writer.close()
+    return expected, recorded_seconds
+
+
+def replay(path,target_host_port_pair,server,speed,num_copies):
+    '''
+    @returns {float or None} --- Seconds all replays took, or None if
+    they did not finish.
+    '''
+    server.reset()
+    loop = EventLoop()
+    loop.start()
+    replays = [
+        CaptureReplay(path,target_host_port_pair,speed,loop)
+        for i in range(0,num_copies)]
+    start_time = time.time()
+    for capture_replay in replays:
+        capture_replay.start()
+    for capture_replay in replays:
+        if not capture_replay.wait(WAIT_SECONDS):
+            print '\nReplay did not finish\n'
+            return None
+    elapsed = time.time() - start_time
+    for capture_replay in replays:
+        snapshot = capture_replay.snapshot()
+        if snapshot['sessions_failed'] != 0:
+            print '\nReplay sessions failed: %s\n' % snapshot
+            return None
+    # let the server read everything.
+    time.sleep(.2)
+    return elapsed
+
+
+def check_received(server,expected,num_copies):
+    received = server.received()
+    if sorted(received) != sorted(expected * num_copies):
+        print ('\nExpected: %(expected)s, \nReceived: %(received)s\n' %
+               { 'expected': expected,
+                 'received': received})
+        return False
+    return True
+
+
+class CollectingServer(threading.Thread):
+    '''
+    Accepts connections forever, and keeps what each sent until it
+    closed.
+    '''
+    def __init__(self,host_port_pair):
+        self.host_port_pair = host_port_pair
+        self.lock = threading.Lock()
+        self.connection_data = []
+        super(CollectingServer,self).__init__()
+        self.daemon = True
+
+    def reset(self):
+        with self.lock:
+            self.connection_data = []
+
+    def received(self):
+        with self.lock:
+            return list(self.connection_data)
+
+    def run(self):
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        listening_socket.bind(self.host_port_pair.host_port_tuple())
+        listening_socket.listen(128)
+        while True:
+            sock, addr = listening_socket.accept()
+            t = threading.Thread(target=self.collect,args=(sock,))
+            t.setDaemon(True)
+            t.start()
+
+    def collect(self,sock):
+        data = ''
+        while True:
+            received = sock.recv(1024)
+            if not received:
+                break
+            data += received
+        sock.close()
+        with self.lock:
+            self.connection_data.append(data)
+
+
+if __name__ == '__main__':
+    run_and_print()
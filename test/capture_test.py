@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import Bridge
+from interceptor.capture import CaptureReader, CaptureWriter, RecordKind
+from interceptor.framing import DelimiterDecoder
+from interceptor.metrics import BridgeMetrics
+from interceptor.plan import FramedPlan, PassThroughPlan
+from interceptor.util import HostPortPair
+
+TEST_NAME = 'CAPTURE TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+INTERPOSITION_LISTENER_PORT = random.randint(2222,55555)
+TO_CONNECT_TO_PORT = INTERPOSITION_LISTENER_PORT + 1
+SWAP_INTERPOSITION_LISTENER_PORT = INTERPOSITION_LISTENER_PORT + 2
+SWAP_TO_CONNECT_TO_PORT = INTERPOSITION_LISTENER_PORT + 3
+
+SMALL_RING_BYTES = 1000
+NUM_SMALL_RING_RECORDS = 500
+NUM_MESSAGES = 100
+
+def run():
+    '''
+    Writes many more records than fit into a small capture ring and
+    checks that exactly the newest records survive, including ones
+    that wrap around the end of the ring.  Then captures a connection
+    through an echoing bridge and checks that the capture holds
+    everything sent each way, bracketed by open and close records.
+    Checks that bytes a swapped out plan was holding are captured
+    only once.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        return (
+            check_ring(directory) and
+            check_bridge_capture(directory) and
+            check_swap_capture(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_ring(directory):
+    path = os.path.join(directory,'ring')
+    writer = CaptureWriter(path,SMALL_RING_BYTES)
+    written = []
+    for i in range(0,NUM_SMALL_RING_RECORDS):
+        data = str(i) * (i % 7)
+        writer.write(i,i % 2,RecordKind.DATA,data)
+        written.append((i,data))
+    # larger than the ring: kept, but cut short.
+    writer.write(1,0,RecordKind.DATA,'z' * 2 * SMALL_RING_BYTES)
+    writer.close()
+
+    reader = CaptureReader(path)
+    records = list(reader.records())
+    reader.close()
+    if (len(records) != 1) or (
+        records[0].original_length != 2 * SMALL_RING_BYTES) or (
+        len(records[0].data) >= SMALL_RING_BYTES):
+        print '\nRecord larger than the ring was not truncated\n'
+        return False
+
+    # without the large record, the newest records should all be
+    # there, in order.
+    path = os.path.join(directory,'ring2')
+    writer = CaptureWriter(path,SMALL_RING_BYTES)
+    for connection_id, data in written:
+        writer.write(connection_id,connection_id % 2,RecordKind.DATA,data)
+    writer.close()
+    reader = CaptureReader(path)
+    records = list(reader.records())
+    reader.close()
+    if len(records) != reader.num_records:
+        print '\nHeader counts a different number of records\n'
+        return False
+
+    if len(records) < 10:
+        print '\nSmall ring kept too few records\n'
+        return False
+    expected = written[-len(records):]
+    for record, (connection_id, data) in zip(records,expected):
+        if ((record.connection_id != connection_id) or
+            (record.direction != connection_id % 2) or
+            (record.data != data)):
+            print ('\nExpected record %(expected)s, read %(read)s\n' %
+                   { 'expected': (connection_id,data),
+                     'read': (record.connection_id,record.data)})
+            return False
+    return True
+
+
+def check_bridge_capture(directory):
+    path = os.path.join(directory,'bridge')
+    interposition_host_port_pair = HostPortPair(
+        '127.0.0.1',INTERPOSITION_LISTENER_PORT)
+    to_connect_to_host_port_pair = HostPortPair(
+        '127.0.0.1',TO_CONNECT_TO_PORT)
+
+    echo_server = EchoServer(to_connect_to_host_port_pair)
+    echo_server.start()
+    time.sleep(.5)
+
+    capture = CaptureWriter(path)
+    bridge = Bridge(
+        interposition_host_port_pair,PassThroughPlan(),
+        to_connect_to_host_port_pair,PassThroughPlan(),
+        capture=capture)
+    bridge.non_blocking_connection_setup()
+    time.sleep(.5)
+
+    sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sending_socket.connect(interposition_host_port_pair.host_port_tuple())
+    expected = ''
+    echoed = ''
+    for i in range(0,NUM_MESSAGES):
+        message = 'message %i;' % i
+        expected += message
+        sending_socket.sendall(message)
+        while len(echoed) < len(expected):
+            echoed += sending_socket.recv(1024)
+    sending_socket.close()
+    time.sleep(.5)
+    capture.close()
+
+    reader = CaptureReader(path)
+    records = list(reader.records())
+    reader.close()
+    if (len(records) < 2) or (records[0].kind != RecordKind.OPEN) or (
+        records[-1].kind != RecordKind.CLOSE):
+        print '\nCapture is not bracketed by open and close records\n'
+        return False
+
+    captured = {
+        BridgeMetrics.ONE_DIRECTION: '',
+        BridgeMetrics.OTHER_DIRECTION: ''}
+    for record in records:
+        if record.connection_id != records[0].connection_id:
+            print '\nRecords have different connection ids\n'
+            return False
+        if record.kind == RecordKind.DATA:
+            captured[record.direction] += record.data
+
+    for direction in captured:
+        if captured[direction] != expected:
+            print ('\nExpected capture: %(expected)s, \n' +
+                   'Captured: %(captured)s\n') % {
+                'expected': expected,
+                'captured': captured[direction]}
+            return False
+    return True
+
+
+def check_swap_capture(directory):
+    path = os.path.join(directory,'swap')
+    interposition_host_port_pair = HostPortPair(
+        '127.0.0.1',SWAP_INTERPOSITION_LISTENER_PORT)
+    to_connect_to_host_port_pair = HostPortPair(
+        '127.0.0.1',SWAP_TO_CONNECT_TO_PORT)
+
+    echo_server = EchoServer(to_connect_to_host_port_pair)
+    echo_server.start()
+    time.sleep(.5)
+
+    capture = CaptureWriter(path)
+    # holds the start of a line until the rest arrives.
+    bridge = Bridge(
+        interposition_host_port_pair,
+        FramedPlan(DelimiterDecoder(),PassThroughPlan()),
+        to_connect_to_host_port_pair,PassThroughPlan(),
+        capture=capture)
+    bridge.non_blocking_connection_setup()
+    time.sleep(.5)
+
+    sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sending_socket.connect(interposition_host_port_pair.host_port_tuple())
+    sending_socket.sendall('start of ')
+    time.sleep(.5)
+    # the new plan receives what the framed plan was holding.
+    bridge.swap_plans(PassThroughPlan,PassThroughPlan)
+    sending_socket.sendall('a line\n')
+    expected = 'start of a line\n'
+    echoed = ''
+    while len(echoed) < len(expected):
+        echoed += sending_socket.recv(1024)
+    sending_socket.close()
+    time.sleep(.5)
+    capture.close()
+
+    reader = CaptureReader(path)
+    captured = ''.join(
+        record.data for record in reader.records()
+        if (record.kind == RecordKind.DATA) and (
+            record.direction == BridgeMetrics.ONE_DIRECTION))
+    reader.close()
+    if (echoed != expected) or (captured != expected):
+        print ('\nSwapping plans echoed %(echoed)r, captured ' +
+               '%(captured)r\n') % {
+            'echoed': echoed,
+            'captured': captured}
+        return False
+    return True
+
+
+class EchoServer(threading.Thread):
+    def __init__(self,host_port_pair):
+        self.host_port_pair = host_port_pair
+        super(EchoServer,self).__init__()
+        self.daemon = True
+
+    def run(self):
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        listening_socket.bind(self.host_port_pair.host_port_tuple())
+        listening_socket.listen(1)
+        sock, addr = listening_socket.accept()
+        try:
+            while True:
+                data = sock.recv(1024)
+                if not data:
+                    break
+                sock.sendall(data)
+        except socket.error:
+            pass
+
+
+if __name__ == '__main__':
+    run_and_print()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.plan import ConstantDelayPlan, PipelinePlan, Plan
+from interceptor.plan import COALESCE_BYTES
+
+TEST_NAME = 'COALESCE TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+DELAY_SECONDS = .05
+NUM_SMALL_CHUNKS = 100
+LARGE_CHUNK_BYTES = COALESCE_BYTES / 2 + 1
+NUM_LARGE_CHUNKS = 4
+
+def run():
+    '''
+    Checks that small chunks a delay plan holds that come due together
+    go out in one write, in order; that chunks too large to join
+    cheaply are not all joined; and that a stage behind a delay in a
+    pipeline still gets each chunk on its own.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    small_chunks = ['message %i;' % i for i in range(0,NUM_SMALL_CHUNKS)]
+    writes = delayed_writes(small_chunks)
+    if writes != [''.join(small_chunks)]:
+        print ('\nExpected one write of small chunks, got %i\n' %
+               len(writes))
+        return False
+
+    large_chunks = [
+        chr(ord('a') + i) * LARGE_CHUNK_BYTES
+        for i in range(0,NUM_LARGE_CHUNKS)]
+    writes = delayed_writes(large_chunks)
+    if ''.join(writes) != ''.join(large_chunks):
+        print '\nLarge chunks were reordered or lost\n'
+        return False
+    if max(len(write) for write in writes) > COALESCE_BYTES:
+        print '\nJoined more than %i bytes into one write\n' % COALESCE_BYTES
+        return False
+
+    sink = _CollectingSocket(sum(len(chunk) for chunk in small_chunks))
+    counting_stage = _ChunkCountingPlan()
+    pipeline = PipelinePlan([ConstantDelayPlan(DELAY_SECONDS),counting_stage])
+    pipeline.recv_many(small_chunks,sink)
+    if not sink.all_sent.wait(5):
+        print '\nPipeline did not forward everything\n'
+        return False
+    if counting_stage.chunks != small_chunks:
+        print '\nStage behind a delay saw different chunks\n'
+        return False
+    return True
+
+
+def delayed_writes(chunks):
+    '''
+    @returns {list} --- Each write a delay plan made to send chunks,
+    all received at once.
+    '''
+    sink = _CollectingSocket(sum(len(chunk) for chunk in chunks))
+    ConstantDelayPlan(DELAY_SECONDS).recv_many(chunks,sink)
+    if not sink.all_sent.wait(5):
+        return []
+    return sink.sent
+
+
+class _ChunkCountingPlan(Plan):
+    def __init__(self):
+        self.chunks = []
+
+    def recv(self,received_data,socket_to_send_data_to):
+        self.chunks.append(received_data)
+        socket_to_send_data_to.sendall(received_data)
+        return None
+
+
+class _CollectingSocket(object):
+    def __init__(self,expected_bytes):
+        self.sent = []
+        self.num_bytes = 0
+        self.expected_bytes = expected_bytes
+        self.all_sent = threading.Event()
+
+    def sendall(self,data):
+        self.sent.append(data)
+        self.num_bytes += len(data)
+        if self.num_bytes >= self.expected_bytes:
+            self.all_sent.set()
+
+
+if __name__ == '__main__':
+    run_and_print()
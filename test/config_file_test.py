@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.config import bridge_descriptions_from_file
+from interceptor.control import BridgeSet
+from interceptor.plan import PlanType
+
+TEST_NAME = 'CONFIG FILE TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+NUM_BRIDGES = 2000
+# generous: the point is that startup does not grow with threads or
+# plans per bridge.
+MAX_STARTUP_SECONDS = 10.
+MAX_NEW_THREADS = 5
+NUM_CLIENTS = 3
+
+def run():
+    '''
+    Loads a config file declaring thousands of bridges as a port range
+    through a template, and starts them all.  Checks that this is
+    quick, starts no thread and makes no plan per bridge, and that
+    clients of a few of the bridges reach the upstream ports paired
+    with theirs.  Checks that malformed config files are rejected,
+    naming the entry at fault.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        return (
+            check_large_range(directory) and
+            check_errors(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_large_range(directory):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    num_bridges = min(NUM_BRIDGES,hard / 2)
+    resource.setrlimit(resource.RLIMIT_NOFILE,(hard,hard))
+
+    first_port = random.randint(10000,30000)
+    first_upstream_port = first_port + num_bridges
+    path = write_config(
+        directory,
+        {'templates': {
+                'delayed': {
+                    'interposing_host': '127.0.0.1',
+                    'to_connect_to_host': '127.0.0.1',
+                    'plan': {
+                        'type': PlanType.CONSTANT_DELAY_PLAN,
+                        'additional_args': {'delay_seconds': .01}}}},
+         'bridges': [
+                {'template': 'delayed',
+                 'interposing_port': '%i-%i' % (
+                        first_port,first_port + num_bridges - 1),
+                 'to_connect_to_port': '%i-%i' % (
+                        first_upstream_port,
+                        first_upstream_port + num_bridges - 1)}]})
+
+    threads_before = threading.active_count()
+    start_time = time.time()
+    bridge_descriptions = bridge_descriptions_from_file(path)
+    bridge_set = BridgeSet()
+    for bridge_description in bridge_descriptions:
+        bridge_set.add(bridge_description)
+    elapsed = time.time() - start_time
+    new_threads = threading.active_count() - threads_before
+
+    if len(bridge_descriptions) != num_bridges:
+        print '\nExpected %(expected)i bridges, loaded %(loaded)i\n' % {
+            'expected': num_bridges,
+            'loaded': len(bridge_descriptions)}
+        return False
+    if elapsed > MAX_STARTUP_SECONDS:
+        print '\nStarting %(num)i bridges took %(elapsed)fs\n' % {
+            'num': num_bridges,
+            'elapsed': elapsed}
+        return False
+    if new_threads > MAX_NEW_THREADS:
+        print '\nStarting idle bridges started %i threads\n' % new_threads
+        return False
+
+    # a few clients, each of whose bridge should forward to the
+    # upstream port paired with its own.
+    offsets = random.sample(range(0,num_bridges),NUM_CLIENTS)
+    for offset in offsets:
+        message = 'to bridge %i' % offset
+        received = send_through(
+            first_port + offset,first_upstream_port + offset,message)
+        if received != message:
+            print ('\nBridge %(offset)i forwarded %(received)s\n' %
+                   { 'offset': offset,
+                     'received': received})
+            return False
+
+    with_plans = [
+        index for index, (description, bridge) in
+        sorted(bridge_set.bridges.items()) if bridge.current_plans()]
+    if sorted(with_plans) != sorted(offsets):
+        print '\nPlans were made for bridges %s\n' % with_plans
+        return False
+    return True
+
+
+def send_through(port,upstream_port,message):
+    '''
+    @returns {str} --- What upstream_port received from a client that
+    connected to port and sent message.
+    '''
+    listening_socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    listening_socket.bind(('127.0.0.1',upstream_port))
+    listening_socket.listen(1)
+    listening_socket.settimeout(5)
+
+    client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    client.connect(('127.0.0.1',port))
+    client.sendall(message)
+    try:
+        upstream, addr = listening_socket.accept()
+    except socket.timeout:
+        return None
+    upstream.settimeout(5)
+    received = ''
+    try:
+        while len(received) < len(message):
+            data = upstream.recv(1024)
+            if not data:
+                break
+            received += data
+    except socket.timeout:
+        pass
+    for sock in (client,upstream,listening_socket):
+        sock.close()
+    return received
+
+
+def check_errors(directory):
+    plan = {'type': PlanType.PASS_THROUGH_PLAN,'additional_args': {}}
+    good = {
+        'interposing_host': '127.0.0.1','interposing_port': 9000,
+        'to_connect_to_host': '127.0.0.1','to_connect_to_port': 8000,
+        'plan': plan}
+    for config, expected_in_error in (
+        ({'bridges': [good,dict(good,interposing_port='8990-9010')]},
+         '9000'),
+        ({'bridges': [good,dict(good,interposing_port='9001-9010',
+                               to_connect_to_port='8000-8002')]},
+         'bridges[1]'),
+        ({'bridges': [dict(good,template='missing')]},'missing'),
+        ({'bridges': [dict(good,interposing_port='9010-9001')]},'range'),
+        ({'bridges': [dict(good,interposing_port='90a')]},'90a'),
+        ({'bridges': [
+                    dict(good,interposing_port='9001-9010',
+                         plan={'type': PlanType.RANDOM_DELAY_PLAN,
+                               'additional_args': {
+                                'lower_delay_seconds': 0,
+                                'upper_delay_seconds': 1,
+                                'record_path': '/tmp/decisions'}})]},
+         'record_path'),
+        ({'bridges': [dict(good,plan={'type': 'no_such_plan',
+                                     'additional_args': {}})]},
+         'bridges[0]'),
+        ({'templates': []},'templates')):
+        try:
+            bridge_descriptions_from_file(write_config(directory,config))
+        except argparse.ArgumentTypeError as ex:
+            if expected_in_error not in str(ex):
+                print ('\nError %(error)s does not mention %(expected)s\n' %
+                       { 'error': ex,
+                         'expected': expected_in_error})
+                return False
+            continue
+        print '\nAccepted bad config %s\n' % config
+        return False
+
+    # a plain list, like --bridges, is a config file too.
+    if len(bridge_descriptions_from_file(
+            write_config(directory,[good]))) != 1:
+        print '\nDid not load a list of bridges\n'
+        return False
+    return True
+
+
+def write_config(directory,config):
+    path = os.path.join(directory,'config.json')
+    with open(path,'w') as config_file:
+        json.dump(config,config_file)
+    return path
+
+
+if __name__ == '__main__':
+    run_and_print()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.control import BridgeSet, ControlServer, send_command
+from interceptor.engine import EngineType, engine_from_type
+from interceptor.engine import set_default_engine
+from interceptor.plan import PlanType
+
+TEST_NAME = 'CONTROL TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+SEND_SECONDS = 2.
+SECONDS_BETWEEN_MESSAGES = .002
+# a reload must not wait on traffic.
+MAX_SWAP_SECONDS = .1
+WAIT_SECONDS = 5
+
+# swapped in turn while a client sends.  Framed plans are swapped out
+# mid-frame, so their partial frames must be handed on.
+PLANS = [
+    {'type': PlanType.CONSTANT_DELAY_PLAN,
+     'additional_args': {'delay_seconds': .2}},
+    {'type': PlanType.PASS_THROUGH_PLAN,'additional_args': {}},
+    {'type': PlanType.FRAMED_PLAN,
+     'additional_args': {
+            'framing': 'delimiter',
+            'message_plan': {
+                'type': PlanType.CONSTANT_DELAY_PLAN,
+                'additional_args': {'delay_seconds': .05}}}},
+    {'type': PlanType.RATE_LIMIT_PLAN,
+     'additional_args': {'bytes_per_second': 1000000}},
+    {'type': PlanType.CONSTANT_DELAY_PLAN,
+     'additional_args': {'delay_seconds': .01}},
+    ]
+
+def run():
+    '''
+    Adds a bridge through a control socket, and swaps its plans over
+    and over while a client streams numbered lines through it.  Checks
+    that each swap returns within milliseconds, that the connection is
+    never brought down, and that the server receives every line, in
+    order.  Then removes the bridge, checking that its connection keeps
+    forwarding while new clients are refused, and that removing with
+    close_connections brings connections down.  Runs with both
+    engines.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        for engine_type in (EngineType.THREADED,EngineType.EVENT_LOOP):
+            set_default_engine(engine_from_type(engine_type))
+            if not run_with_engine(os.path.join(directory,engine_type)):
+                print '\nFailed with %s engine\n' % engine_type
+                return False
+        return True
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_with_engine(control_path):
+    interposing_port = random.randint(2222,55555)
+    to_connect_to_port = interposing_port + 1
+
+    server = CollectingServer(to_connect_to_port)
+    server.start()
+    control_server = ControlServer(control_path,BridgeSet())
+    control_server.start()
+    time.sleep(.5)
+
+    try:
+        reply = send_command(
+            control_path,
+            {'command': 'add',
+             'bridge': bridge_description(
+                    interposing_port,to_connect_to_port,PLANS[-1])})
+        if not reply['ok']:
+            print '\nCould not add bridge: %s\n' % reply
+            return False
+        bridge_id = reply['id']
+        time.sleep(.5)
+
+        client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        client.connect(('127.0.0.1',interposing_port))
+        sender = Sender(client)
+        sender.start()
+        if not swap_while_sending(control_path,bridge_id,sender):
+            return False
+        if not check_received(server,0,sender.sent):
+            return False
+
+        reply = send_command(control_path,{'command': 'stats'})
+        bridge_stats = reply['stats']['bridges'][0]
+        if (bridge_stats['connections_accepted'] != 1) or (
+            bridge_stats['connections_brought_down'] != 0):
+            print '\nSwapping plans disturbed the connection: %s\n' % (
+                bridge_stats,)
+            return False
+
+        return (
+            check_bad_commands(control_path,bridge_id) and
+            check_remove(
+                control_path,bridge_id,interposing_port,to_connect_to_port,
+                client,server))
+    finally:
+        control_server.close()
+
+
+def bridge_description(interposing_port,to_connect_to_port,plan):
+    return {
+        'interposing_host': '127.0.0.1',
+        'interposing_port': interposing_port,
+        'to_connect_to_host': '127.0.0.1',
+        'to_connect_to_port': to_connect_to_port,
+        'plan': plan}
+
+
+def swap_while_sending(control_path,bridge_id,sender):
+    swap_seconds = SEND_SECONDS / (2 * len(PLANS))
+    for plan in PLANS * 2:
+        time.sleep(swap_seconds)
+        start_time = time.time()
+        reply = send_command(
+            control_path,
+            {'command': 'swap_plan','id': bridge_id,'plan': plan})
+        elapsed = time.time() - start_time
+        if not reply['ok']:
+            print '\nCould not swap plan: %s\n' % reply
+            return False
+        if elapsed > MAX_SWAP_SECONDS:
+            print '\nSwapping to %(plan)s took %(elapsed)fs\n' % {
+                'plan': plan['type'],
+                'elapsed': elapsed}
+            return False
+    sender.stop()
+    return True
+
+
+def check_bad_commands(control_path,bridge_id):
+    for command in (
+        {'command': 'swap_plan','id': bridge_id + 100,'plan': PLANS[0]},
+        {'command': 'swap_plan','id': bridge_id,
+         'plan': {'type': 'no_such_plan','additional_args': {}}},
+        {'command': 'remove'},
+        {'command': 'no_such_command'}):
+        reply = send_command(control_path,command)
+        if reply['ok'] or ('error' not in reply):
+            print '\nAccepted bad command %s\n' % command
+            return False
+
+    # a bad swap changes nothing.
+    bridges = send_command(control_path,{'command': 'list'})['bridges']
+    if (len(bridges) != 1) or (bridges[0]['connections'] != 1) or (
+        bridges[0]['plan'] != PLANS[-1]):
+        print '\nBridges changed by bad commands: %s\n' % bridges
+        return False
+    return True
+
+
+def check_remove(control_path,bridge_id,interposing_port,
+                 to_connect_to_port,client,server):
+    reply = send_command(control_path,{'command': 'remove','id': bridge_id})
+    if not reply['ok']:
+        print '\nCould not remove bridge: %s\n' % reply
+        return False
+
+    # the connection outlives its bridge.
+    client.sendall('after remove\n')
+    if not check_received(server,0,server.expected(0) + 'after remove\n'):
+        return False
+    if connects(interposing_port):
+        print '\nRemoved bridge accepted a client\n'
+        return False
+    client.close()
+
+    # the same port can be added back, and removed with its
+    # connections.
+    reply = send_command(
+        control_path,
+        {'command': 'add',
+         'bridge': bridge_description(
+                interposing_port,to_connect_to_port,PLANS[1])})
+    if not reply['ok']:
+        print '\nCould not add bridge back: %s\n' % reply
+        return False
+    time.sleep(.5)
+    client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    client.connect(('127.0.0.1',interposing_port))
+    client.sendall('hello\n')
+    if not check_received(server,1,'hello\n'):
+        return False
+    send_command(
+        control_path,
+        {'command': 'remove','id': reply['id'],'close_connections': True})
+    client.settimeout(WAIT_SECONDS)
+    try:
+        closed = client.recv(1) == ''
+    except socket.error:
+        # reset
+        closed = True
+    except socket.timeout:
+        closed = False
+    client.close()
+    if not closed:
+        print '\nRemoving with close_connections left connection up\n'
+        return False
+    return True
+
+
+def check_received(server,connection_index,expected):
+    deadline = time.time() + WAIT_SECONDS
+    while time.time() < deadline:
+        if server.received(connection_index) == expected:
+            return True
+        time.sleep(.05)
+    received = server.received(connection_index)
+    print ('\nExpected %(expected)i bytes, received %(received)i; ' +
+           'differ from byte %(index)i\n') % {
+        'expected': len(expected),
+        'received': len(received),
+        'index': next(
+            (i for i in range(0,min(len(expected),len(received)))
+             if expected[i] != received[i]),
+            min(len(expected),len(received)))}
+    return False
+
+
+def connects(port):
+    sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    try:
+        sock.connect(('127.0.0.1',port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class Sender(threading.Thread):
+    '''
+    Sends numbered lines, each in several writes, until stopped.
+    '''
+    def __init__(self,sock):
+        self.sock = sock
+        self.sent = ''
+        self.stopped = threading.Event()
+        self.done = threading.Event()
+        super(Sender,self).__init__()
+        self.setDaemon(True)
+
+    def run(self):
+        i = 0
+        while not self.stopped.is_set():
+            line = 'message %i\n' % i
+            for piece in (line[:4],line[4:]):
+                self.sock.sendall(piece)
+                self.sent += piece
+                time.sleep(SECONDS_BETWEEN_MESSAGES / 2)
+            i += 1
+        self.done.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.done.wait()
+
+
+class CollectingServer(threading.Thread):
+    def __init__(self,port):
+        self.port = port
+        self.lock = threading.Lock()
+        # what each accepted connection has sent so far, in order of
+        # accepting.
+        self.connection_data = []
+        super(CollectingServer,self).__init__()
+        self.setDaemon(True)
+
+    def received(self,connection_index):
+        with self.lock:
+            if connection_index >= len(self.connection_data):
+                return ''
+            return ''.join(self.connection_data[connection_index])
+
+    def expected(self,connection_index):
+        return self.received(connection_index)
+
+    def run(self):
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        listening_socket.bind(('127.0.0.1',self.port))
+        listening_socket.listen(128)
+        while True:
+            sock, addr = listening_socket.accept()
+            with self.lock:
+                data = []
+                self.connection_data.append(data)
+            t = threading.Thread(target=self.collect,args=(sock,data))
+            t.setDaemon(True)
+            t.start()
+
+    def collect(self,sock,data):
+        while True:
+            try:
+                received = sock.recv(1024)
+            except socket.error:
+                break
+            if not received:
+                break
+            with self.lock:
+                data.append(received)
+        sock.close()
+
+
+if __name__ == '__main__':
+    run_and_print()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.plan import CorruptPlan, CorruptionMode, plan_from_args
+
+TEST_NAME = 'CORRUPT PLAN TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+CHUNK_SIZE = 64 * 1024
+NUM_CHUNKS = 16
+ERROR_RATE = .001
+SEED = 1234
+# plans at very low error rates should forward this many bytes per
+# second at least.
+MIN_LOW_RATE_BYTES_PER_SECOND = 500 * 1024 * 1024
+
+def run():
+    '''
+    Sends the same data through corrupt plans in each mode and checks
+    that about the expected number of bytes is corrupted, in the way
+    the mode says, that the same seed corrupts the same bytes, and
+    that a plan at a very low error rate forwards almost for free.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    chunks = [
+        chr(ord('a') + i % 26) * CHUNK_SIZE for i in range(0,NUM_CHUNKS)]
+    expected_data = ''.join(chunks)
+    expected_errors = ERROR_RATE * len(expected_data)
+
+    # bit flips
+    received = send_through(CorruptPlan(ERROR_RATE,seed=SEED),chunks)
+    if len(received) != len(expected_data):
+        print '\nBit flips changed length of data\n'
+        return False
+    num_errors = 0
+    for original, corrupted in zip(expected_data,received):
+        if original != corrupted:
+            num_errors += 1
+            if bin(ord(original) ^ ord(corrupted)).count('1') != 1:
+                print '\nBit flip changed more than one bit\n'
+                return False
+    if abs(num_errors - expected_errors) > .2 * expected_errors:
+        print ('\nExpected about %(expected)i errors, got %(got)i\n' %
+               { 'expected': expected_errors,
+                 'got': num_errors})
+        return False
+
+    # same seed, same corruption
+    if send_through(CorruptPlan(ERROR_RATE,seed=SEED),chunks) != received:
+        print '\nSame seed corrupted different bytes\n'
+        return False
+
+    # overwrites
+    plan = CorruptPlan(ERROR_RATE,CorruptionMode.OVERWRITE,SEED)
+    received = send_through(plan,chunks)
+    num_errors = sum(
+        1 for original, corrupted in zip(expected_data,received)
+        if original != corrupted)
+    if ((len(received) != len(expected_data)) or
+        (num_errors != plan.corrupted_bytes)):
+        print '\nOverwrites did not all change bytes\n'
+        return False
+
+    # truncation.  every chunk is long enough to expect an error.
+    plan = CorruptPlan(ERROR_RATE,CorruptionMode.TRUNCATE,SEED)
+    received = send_through(plan,chunks)
+    if (len(received) >= len(expected_data)) or (
+        plan.truncated_chunks < NUM_CHUNKS / 2):
+        print '\nTruncation did not drop data\n'
+        return False
+
+    # no errors should be nearly free
+    plan = CorruptPlan(1e-9,seed=SEED)
+    sink = _SinkSocket()
+    start_time = time.time()
+    for i in range(0,100):
+        for chunk in chunks:
+            plan.recv(chunk,sink)
+    bytes_per_second = 100 * len(expected_data) / (time.time() - start_time)
+    if bytes_per_second < MIN_LOW_RATE_BYTES_PER_SECOND:
+        print '\nOnly forwarded %f bytes per second\n' % bytes_per_second
+        return False
+
+    # rates too small for log(1 - rate) to tell apart from 0.
+    for error_rate in (1e-17,5e-324):
+        try:
+            plan = plan_from_args(
+                'corrupt',{'error_rate_per_byte': error_rate})
+            received = send_through(plan,chunks)
+        except (ZeroDivisionError,OverflowError) as inst:
+            print '\nError rate %r raised %r\n' % (error_rate,inst)
+            return False
+        if received != expected_data:
+            print '\nError rate %r corrupted data\n' % error_rate
+            return False
+
+    # after one error at such a rate, there are no more.
+    for mode in (CorruptionMode.BIT_FLIP,CorruptionMode.OVERWRITE):
+        plan = CorruptPlan(5e-324,mode,SEED)
+        plan.bytes_until_error = 0
+        try:
+            received = send_through(plan,chunks)
+        except TypeError as inst:
+            print '\nError after a forced one raised %r\n' % inst
+            return False
+        num_errors = sum(
+            1 for original, corrupted in zip(expected_data,received)
+            if original != corrupted)
+        if ((len(received) != len(expected_data)) or (num_errors != 1) or
+            (plan.bytes_until_error is not None)):
+            print '\nForced error was followed by %i more\n' % (
+                num_errors - 1)
+            return False
+
+    return True
+
+
+def send_through(plan,chunks):
+    collecting_socket = _CollectingSocket()
+    for chunk in chunks:
+        plan.recv(chunk,collecting_socket)
+    return ''.join(collecting_socket.sent)
+
+
+class _CollectingSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self,data):
+        self.sent.append(data)
+
+
+class _SinkSocket(object):
+    def sendall(self,data):
+        pass
+
+
+if __name__ == '__main__':
+    run_and_print()
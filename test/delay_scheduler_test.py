@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.plan import ConstantDelayPlan, RandomDelayPlan
+
+TEST_NAME = 'DELAY SCHEDULER TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+    
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+NUM_PLANS = 100
+DELAY_SECONDS = .5
+# loose, since one thread sends every chunk of every plan at once.
+MAX_MEAN_DEVIATION = .25
+           
+def run():
+    '''
+    Creates many delay plans, each sending to its own socket, and
+    hands each of them data.  All plans should share a single sending
+    thread, and each socket should get its data, in order, no sooner
+    than the delay, and close to when it was due.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    threads_before = threading.active_count()
+
+    plans = []
+    socket_pairs = []
+    for i in range(0,NUM_PLANS):
+        if i % 3 == 0:
+            plans.append(ConstantDelayPlan(DELAY_SECONDS))
+        elif i % 3 == 1:
+            plans.append(
+                RandomDelayPlan(DELAY_SECONDS,DELAY_SECONDS + .1))
+        else:
+            plans.append(
+                RandomDelayPlan(
+                    DELAY_SECONDS,DELAY_SECONDS + .1,pipelined=True))
+        socket_pairs.append(socket.socketpair())
+
+    start_time = time.time()
+    expected_data = []
+    for i in range(0,NUM_PLANS):
+        expected_data_on_other_side = ''
+        for j in range(0,50):
+            to_send = str(i) + ':' + str(j) + ','
+            expected_data_on_other_side += to_send
+            plans[i].recv(to_send,socket_pairs[i][0])
+        expected_data.append(expected_data_on_other_side)
+
+    threads_during = threading.active_count()
+    if threads_during - threads_before > 1:
+        print ('\nExpected at most one new thread, got %i\n' %
+               (threads_during - threads_before))
+        return False
+
+    for i in range(0,NUM_PLANS):
+        read_data = ''
+        receiving_socket = socket_pairs[i][1]
+        receiving_socket.settimeout(5)
+        while len(read_data) < len(expected_data[i]):
+            read_data += receiving_socket.recv(1024)
+
+        if i == 0 and (time.time() - start_time) < DELAY_SECONDS:
+            print '\nReceived data before delay elapsed\n'
+            return False
+
+        if read_data != expected_data[i]:
+            print ('\nExpected: %(expected)s, \nReceived: %(received)s\n' %
+                   { 'expected': expected_data[i],
+                     'received': read_data})
+            return False
+
+    # every chunk should have been sent close to its target time.
+    for plan in plans:
+        if plan.deviation_stats.count != 50:
+            print '\nExpected deviation recorded for every chunk\n'
+            return False
+        if abs(plan.deviation_stats.mean_seconds()) > MAX_MEAN_DEVIATION:
+            print ('\nMean deviation too large: %f\n' %
+                   plan.deviation_stats.mean_seconds())
+            return False
+    
+    return True
+
+
+if __name__ == '__main__':
+    run_and_print()
+    
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import argparse
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.distribution import NormalDistribution, ParetoDistribution
+from interceptor.distribution import EmpiricalDistribution
+from interceptor.distribution import load_empirical_distribution
+from interceptor.plan import plan_from_args, PlanType
+
+TEST_NAME = 'DISTRIBUTION TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+NUM_SAMPLES = 100000
+NUM_SOURCE_SAMPLES = 200000
+# sampling must not slow down with the size of the source data.
+MAX_SAMPLE_SECONDS = 1.
+DELAY_SECONDS = .05
+
+def run():
+    '''
+    Checks the moments and quantiles of samples from normal, pareto,
+    and empirical distributions, the latter loaded from sample,
+    histogram, and CDF files.  Checks that sampling an empirical
+    distribution built from many samples is as fast as one built from
+    a few, that seeded plans repeat their delays, that plans load from
+    args and reject bad ones, and that a plan delays chunks by its
+    samples.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        return (
+            check_normal() and
+            check_pareto() and
+            check_empirical(directory) and
+            check_sampling_time() and
+            check_plans(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_normal():
+    samples = draw(NormalDistribution(.1,.02),NUM_SAMPLES)
+    mean = sum(samples) / len(samples)
+    stddev = math.sqrt(
+        sum((sample - mean) ** 2 for sample in samples) / len(samples))
+    if (abs(mean - .1) > .001) or (abs(stddev - .02) > .001):
+        print '\nNormal had mean %(mean)f and stddev %(stddev)f\n' % {
+            'mean': mean,
+            'stddev': stddev}
+        return False
+    if min(draw(NormalDistribution(0,.1),1000)) < 0:
+        print '\nNormal delay was negative\n'
+        return False
+    return True
+
+
+def check_pareto():
+    samples = sorted(draw(ParetoDistribution(.01,2.),NUM_SAMPLES))
+    median = samples[len(samples) / 2]
+    expected_median = .01 * math.sqrt(2)
+    if (samples[0] < .01) or (abs(median - expected_median) > .0005):
+        print '\nPareto had minimum %(min)f and median %(median)f\n' % {
+            'min': samples[0],
+            'median': median}
+        return False
+    capped = draw(ParetoDistribution(.01,.5,max_seconds=.1),NUM_SAMPLES)
+    if max(capped) > .1:
+        print '\nPareto exceeded max_seconds\n'
+        return False
+    return True
+
+
+def check_empirical(directory):
+    rand = random.Random(3)
+    source = [rand.expovariate(1 / 20.) for i in range(0,10000)]
+    samples_path = write_lines(
+        directory,'samples',['# rtt in ms'] + [str(ms) for ms in source])
+    distribution = load_empirical_distribution(samples_path,'samples',.001)
+    if not quantiles_match(
+        sorted(draw(distribution,NUM_SAMPLES)),
+        sorted(ms * .001 for ms in source)):
+        return False
+    if load_empirical_distribution(samples_path,'samples',.001) is not (
+        distribution):
+        print '\nUnchanged file was loaded twice\n'
+        return False
+
+    # a quarter of samples in 10-20ms, the rest in 50-60ms.
+    histogram_path = write_lines(
+        directory,'histogram',['10 20 1','50 60 3'])
+    samples = draw(
+        load_empirical_distribution(histogram_path,'histogram',.001),
+        NUM_SAMPLES)
+    low = [sample for sample in samples if .01 <= sample <= .02]
+    high = [sample for sample in samples if .05 <= sample <= .06]
+    if (len(low) + len(high) != len(samples)) or (
+        abs(len(low) / float(len(samples)) - .25) > .01):
+        print ('\nHistogram samples: %(low)i low, %(high)i high, ' +
+               '%(total)i total\n') % {
+            'low': len(low),
+            'high': len(high),
+            'total': len(samples)}
+        return False
+
+    # half at exactly 10ms, the rest spread to 30ms.
+    cdf_path = write_lines(directory,'cdf',['.01 .5','.03 1'])
+    samples = sorted(
+        draw(load_empirical_distribution(cdf_path,'cdf'),NUM_SAMPLES))
+    at_minimum = len([sample for sample in samples if sample == .01])
+    if (samples[0] < .01) or (samples[-1] > .03) or (
+        abs(at_minimum / float(len(samples)) - .5) > .01):
+        print '\nCDF samples out of shape\n'
+        return False
+    return True
+
+
+def quantiles_match(samples,expected):
+    for quantile in (.1,.5,.9,.99):
+        got = samples[int(quantile * len(samples))]
+        wanted = expected[int(quantile * len(expected))]
+        if abs(got - wanted) > .05 * wanted:
+            print ('\nQuantile %(quantile)f was %(got)f, not %(wanted)f\n' %
+                   { 'quantile': quantile,
+                     'got': got,
+                     'wanted': wanted})
+            return False
+    return True
+
+
+def check_sampling_time():
+    rand = random.Random(5)
+    large = EmpiricalDistribution.from_samples(
+        [rand.random() for i in range(0,NUM_SOURCE_SAMPLES)])
+    small = EmpiricalDistribution.from_samples([.1,.2,.3])
+    for distribution in (small,large):
+        start_time = time.time()
+        draw(distribution,NUM_SAMPLES)
+        elapsed = time.time() - start_time
+        if elapsed > MAX_SAMPLE_SECONDS:
+            print '\n%(num)i samples took %(elapsed)fs\n' % {
+                'num': NUM_SAMPLES,
+                'elapsed': elapsed}
+            return False
+    return True
+
+
+def check_plans(directory):
+    samples_path = write_lines(directory,'plan_samples',['1','2','3'])
+    for additional_args in (
+        {'distribution': 'uniform','lower_delay_seconds': 0,
+         'upper_delay_seconds': .1},
+        {'distribution': 'normal','mean_seconds': .1,'stddev_seconds': .01},
+        {'distribution': 'pareto','scale_seconds': .01,'shape': 1.5,
+         'max_delay_seconds': 1},
+        {'distribution': 'empirical','path': samples_path,
+         'unit_seconds': .001}):
+        additional_args['seed'] = 9
+        first = plan_from_args(PlanType.DISTRIBUTION_DELAY_PLAN,additional_args)
+        second = plan_from_args(
+            PlanType.DISTRIBUTION_DELAY_PLAN,additional_args)
+        if [first.sample_delay() for i in range(0,10)] != (
+            [second.sample_delay() for i in range(0,10)]):
+            print '\nSeeded plans differed: %s\n' % additional_args
+            return False
+
+    for bad_args in (
+        {},
+        {'distribution': 'lognormal'},
+        {'distribution': 'normal','mean_seconds': .1},
+        {'distribution': 'pareto','scale_seconds': 0,'shape': 1},
+        {'distribution': 'empirical',
+         'path': os.path.join(directory,'missing')},
+        {'distribution': 'empirical','path': samples_path,
+         'file_format': 'histogram'}):
+        try:
+            plan_from_args(PlanType.DISTRIBUTION_DELAY_PLAN,bad_args)
+        except argparse.ArgumentTypeError:
+            continue
+        print '\nLoaded plan with bad args %s\n' % bad_args
+        return False
+
+    plan = plan_from_args(
+        PlanType.DISTRIBUTION_DELAY_PLAN,
+        {'distribution': 'pareto','scale_seconds': DELAY_SECONDS,
+         'shape': 3,'max_delay_seconds': 2 * DELAY_SECONDS})
+    sink = _CollectingSocket()
+    start_time = time.time()
+    plan.recv('x',sink)
+    if not sink.all_sent.wait(5):
+        print '\nPlan never forwarded\n'
+        return False
+    elapsed = sink.sent_time - start_time
+    if elapsed < DELAY_SECONDS:
+        print '\nPlan forwarded after only %fs\n' % elapsed
+        return False
+    return True
+
+
+def draw(distribution,num_samples):
+    rand = random.Random(1)
+    return [distribution.sample(rand) for i in range(0,num_samples)]
+
+
+def write_lines(directory,name,lines):
+    path = os.path.join(directory,name)
+    with open(path,'w') as lines_file:
+        lines_file.write('\n'.join(lines) + '\n')
+    return path
+
+
+class _CollectingSocket(object):
+    def __init__(self):
+        self.all_sent = threading.Event()
+        self.sent_time = None
+
+    def sendall(self,data):
+        self.sent_time = time.time()
+        self.all_sent.set()
+
+
+if __name__ == '__main__':
+    run_and_print()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import threading
+import time
+import random
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import Bridge
+from interceptor.engine import EventLoopEngine
+from interceptor.util import HostPortPair
+from interceptor.plan import PassThroughPlan, ConstantDelayPlan
+
+TEST_NAME = 'EVENT LOOP TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+    
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+           
+BASE_PORT = random.randint(2222,55555)
+NUM_BRIDGES = 10
+
+def run():
+    '''
+    Starts several bridges that all share one event loop engine,
+    alternating pass through and delay plans, and sends data through
+    each of them.  Every bridge should deliver its data, and adding
+    bridges should not add forwarding threads.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    engine = EventLoopEngine()
+    listeners = []
+    bridges = []
+    for i in range(0,NUM_BRIDGES):
+        interposition_host_port_pair = HostPortPair(
+            '127.0.0.1',BASE_PORT + 2*i)
+        to_connect_to_host_port_pair = HostPortPair(
+            '127.0.0.1',BASE_PORT + 2*i + 1)
+        listener_connection = ListenerConnection(
+            to_connect_to_host_port_pair)
+        listener_connection.start()
+        listeners.append(listener_connection)
+
+        if i % 2 == 0:
+            plans = (PassThroughPlan(),PassThroughPlan())
+        else:
+            plans = (ConstantDelayPlan(.2),ConstantDelayPlan(.2))
+        bridge = Bridge(
+            interposition_host_port_pair,plans[0],
+            to_connect_to_host_port_pair,plans[1],
+            engine)
+        bridges.append(bridge)
+    time.sleep(1)
+
+    for bridge in bridges:
+        bridge.non_blocking_connection_setup()
+    time.sleep(1)
+    
+    expected_data = []
+    # keep sockets open until the end of the test
+    sending_sockets = []
+    for i in range(0,NUM_BRIDGES):
+        sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sending_socket.connect(
+            bridges[i].to_listen_on_host_port_pair.host_port_tuple())
+        sending_sockets.append(sending_socket)
+        
+        expected_data_on_other_side = ''
+        for j in range(0,200):
+            to_send = str(i) + ':' + str(j)
+            expected_data_on_other_side += to_send
+            sending_socket.sendall(to_send)
+        expected_data.append(expected_data_on_other_side)
+
+    time.sleep(2)
+
+    # check that other side got the expected data
+    for i in range(0,NUM_BRIDGES):
+        if expected_data[i] != listeners[i].read_data:
+            print ('\nExpected: %(expected)s, \nReceived: %(received)s\n' %
+                   { 'expected': expected_data[i],
+                     'received': listeners[i].read_data})
+            return False
+    
+    return True
+
+
+class ListenerConnection(threading.Thread):
+    def __init__(self,host_port_pair_to_listen_to):
+        self.host_port_pair_to_listen_to = host_port_pair_to_listen_to
+        # all data read from the connection thus far.
+        self.read_data = ''
+        
+        super(ListenerConnection,self).__init__()
+        self.setDaemon(True)
+        
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(self.host_port_pair_to_listen_to.host_port_tuple())
+        s.listen(1)
+        to_listen_on_socket, addr = s.accept()
+
+        while True:
+            data = to_listen_on_socket.recv(1024)
+            if len(data) == 0:
+                break
+            self.read_data += data
+            
+
+if __name__ == '__main__':
+    run_and_print()
+    
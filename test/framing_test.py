@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import os
+import random
+import struct
+import sys
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.framing import LengthPrefixDecoder, DelimiterDecoder
+from interceptor.framing import FixedSizeDecoder, FramingError
+from interceptor.plan import plan_from_args, PlanType, FramedPlan
+from interceptor.plan import MessageSelectPlan, DropPlan, ConstantDelayPlan
+
+TEST_NAME = 'FRAMING TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+NUM_MESSAGES = 200
+LARGE_FRAME_BYTES = 8 * 1024 * 1024
+READ_BYTES = 1024
+MAX_LARGE_FRAME_SECONDS = 2.
+HEARTBEAT = 'HB'
+DELAY_SECONDS = .1
+
+def run():
+    '''
+    Feeds streams of length prefixed, delimited, and fixed size frames
+    to decoders in reads of random sizes and checks that the decoders
+    return exactly the frames.  Checks that a large frame fed in small
+    reads decodes in linear time, that malformed streams raise, and
+    that framed plans drop the fifth message and delay only
+    heartbeats.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    rand = random.Random(11)
+    payloads = [
+        ''.join(chr(rand.randrange(256)) for j in range(rand.randrange(50)))
+        for i in range(0,NUM_MESSAGES)]
+
+    length_prefixed = [struct.pack('>I',len(p)) + p for p in payloads]
+    if not check_decoder(LengthPrefixDecoder(),length_prefixed,rand):
+        return False
+    including_header = [struct.pack('<H',len(p) + 2) + p for p in payloads]
+    if not check_decoder(
+        LengthPrefixDecoder(2,False,True),including_header,rand):
+        return False
+    delimited = [p.replace('\r\n','') + '\r\n' for p in payloads]
+    if not check_decoder(DelimiterDecoder('\r\n'),delimited,rand):
+        return False
+    fixed = [(p + 'x' * 50)[:50] for p in payloads]
+    if not check_decoder(FixedSizeDecoder(50),fixed,rand):
+        return False
+
+    return (
+        check_large_frame() and
+        check_errors() and
+        check_drop_fifth(length_prefixed) and
+        check_delay_heartbeats())
+
+
+def check_decoder(decoder,frames,rand):
+    stream = ''.join(frames)
+    decoded = []
+    offset = 0
+    while offset < len(stream):
+        read_bytes = rand.randrange(1,100)
+        decoded.extend(decoder.feed(stream[offset:offset + read_bytes]))
+        offset += read_bytes
+    if (decoded != frames) or (decoder.pending_bytes() != 0):
+        print ('\n%(decoder)s decoded %(decoded)i frames, ' +
+               'expected %(expected)i\n') % {
+            'decoder': decoder.__class__.__name__,
+            'decoded': len(decoded),
+            'expected': len(frames)}
+        return False
+    return True
+
+
+def check_large_frame():
+    for decoder, frame in (
+        (LengthPrefixDecoder(),
+         struct.pack('>I',LARGE_FRAME_BYTES) + 'a' * LARGE_FRAME_BYTES),
+        (DelimiterDecoder(),'a' * LARGE_FRAME_BYTES + '\n')):
+        start_time = time.time()
+        decoded = []
+        for offset in range(0,len(frame),READ_BYTES):
+            decoded.extend(decoder.feed(frame[offset:offset + READ_BYTES]))
+        elapsed = time.time() - start_time
+        if decoded != [frame]:
+            print '\nLarge frame was not decoded\n'
+            return False
+        if elapsed > MAX_LARGE_FRAME_SECONDS:
+            print ('\n%(decoder)s took %(elapsed)fs for large frame\n' %
+                   { 'decoder': decoder.__class__.__name__,
+                     'elapsed': elapsed})
+            return False
+    return True
+
+
+def check_errors():
+    for decoder, data in (
+        (LengthPrefixDecoder(max_frame_bytes=100),struct.pack('>I',1000)),
+        (LengthPrefixDecoder(length_includes_header=True),
+         struct.pack('>I',2)),
+        (DelimiterDecoder(max_frame_bytes=100),'a' * 200)):
+        try:
+            decoder.feed(data)
+        except FramingError:
+            continue
+        print ('\n%s accepted a malformed stream\n' %
+               decoder.__class__.__name__)
+        return False
+    return True
+
+
+def check_drop_fifth(length_prefixed):
+    plan = plan_from_args(
+        PlanType.FRAMED_PLAN,
+        {'framing': 'length_prefix',
+         'message_plan': {
+                'type': PlanType.MESSAGE_SELECT_PLAN,
+                'additional_args': {
+                    'message_indices': [4],
+                    'selected_plan': {
+                        'type': PlanType.DROP_PLAN,'additional_args': {}}}}})
+    sink = _CollectingSocket()
+    stream = ''.join(length_prefixed)
+    for offset in range(0,len(stream),READ_BYTES):
+        plan.recv(stream[offset:offset + READ_BYTES],sink)
+    expected = ''.join(length_prefixed[:4] + length_prefixed[5:])
+    if ''.join(sink.sent) != expected:
+        print '\nFramed plan did not drop just the fifth message\n'
+        return False
+    snapshot = plan.metrics_snapshot()
+    if snapshot['message_plan']['selected_messages'] != 1:
+        print '\nFramed plan selected %s\n' % snapshot
+        return False
+    return True
+
+
+def check_delay_heartbeats():
+    plan = FramedPlan(
+        DelimiterDecoder(),
+        MessageSelectPlan(
+            ConstantDelayPlan(DELAY_SECONDS),match_bytes=HEARTBEAT))
+    sink = _CollectingSocket(HEARTBEAT + '\n')
+    plan.recv('request 1\n' + HEARTBEAT + '\nrequest 2\nrequ',sink)
+    plan.recv('est 3\n',sink)
+    if sink.sent != ['request 1\n','request 2\n','request 3\n']:
+        print '\nOther messages were not forwarded right away: %s\n' % sink.sent
+        return False
+    if not sink.heartbeat_sent.wait(5):
+        print '\nHeartbeat was never forwarded\n'
+        return False
+    return True
+
+
+class _CollectingSocket(object):
+    def __init__(self,heartbeat=None):
+        self.sent = []
+        self.heartbeat = heartbeat
+        self.heartbeat_sent = threading.Event()
+
+    def sendall(self,data):
+        if data == self.heartbeat:
+            self.heartbeat_sent.set()
+        else:
+            self.sent.append(data)
+
+
+if __name__ == '__main__':
+    run_and_print()
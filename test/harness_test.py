@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import ConnectionListener
+from interceptor.engine import EngineType, engine_from_type
+from interceptor.harness import BridgeEvent, InterceptorBridge
+from interceptor.plan import ConstantDelayPlan
+from interceptor.util import HostPortPair
+
+TEST_NAME = 'HARNESS TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+DELAY_SECONDS = .05
+NUM_CONCURRENT_BRIDGES = 20
+# each bridge delays by DELAY_SECONDS a few times; running them all
+# at once should take little longer than running one.
+MAX_CONCURRENT_SECONDS = 3.
+WAIT_SECONDS = 5
+
+def run():
+    '''
+    Uses bridges on ports the kernel picks, without sleeping: connects
+    as soon as each is started, waits for the data it delays to drain
+    to the server, and for connections to close and fail.  Checks that
+    waiting for events that do not come times out, that a bridge that
+    cannot listen raises, and that many bridges can be used at once
+    from separate threads, and that closing a bridge brings its
+    connections down on the engine's thread.  Runs with both engines.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    server = CollectingServer()
+    server.start()
+    for engine_type in (EngineType.THREADED,EngineType.EVENT_LOOP):
+        engine = engine_from_type(engine_type)
+        # the server tells messages apart by their contents.
+        if not (check_events(server,engine,engine_type) and
+                check_listen_error(server,engine) and
+                check_concurrent(server,engine,engine_type) and
+                check_close(server,engine,engine_type)):
+            print '\nFailed with %s engine\n' % engine_type
+            return False
+    return True
+
+
+def check_events(server,engine,prefix):
+    with InterceptorBridge(
+        server.host_port_pair,lambda: ConstantDelayPlan(DELAY_SECONDS),
+        engine=engine) as bridge:
+        if bridge.host_port_pair().port == 0:
+            print '\nBridge did not report the port it picked\n'
+            return False
+        if not send_and_check(server,bridge,prefix + ' first client'):
+            return False
+
+        # the client closing brings the connection down, but is not a
+        # failure.
+        if not bridge.wait_for(BridgeEvent.CLOSED,timeout=WAIT_SECONDS):
+            print '\nBridge never saw the client close\n'
+            return False
+        if bridge.wait_for(BridgeEvent.FAILED,timeout=.1):
+            print '\nClosing a connection counted as failing\n'
+            return False
+
+        # the bridge takes the next client.  One that resets its
+        # connection fails it.
+        client = connect(bridge)
+        if not bridge.wait_for(BridgeEvent.CONNECTED,2,WAIT_SECONDS):
+            print '\nBridge did not take a second client\n'
+            return False
+        client.setsockopt(
+            socket.SOL_SOCKET,socket.SO_LINGER,struct.pack('ii',1,0))
+        client.close()
+        if not bridge.wait_for(BridgeEvent.FAILED,timeout=WAIT_SECONDS):
+            print '\nReset connection did not fail\n'
+            return False
+        if (bridge.event_count(BridgeEvent.CLOSED) != 2) or (
+            len(bridge.errors) != 1):
+            print '\nFailed connection was not also closed\n'
+            return False
+    return True
+
+
+def check_listen_error(server,engine):
+    with InterceptorBridge(server.host_port_pair,engine=engine) as bridge:
+        try:
+            with InterceptorBridge(
+                server.host_port_pair,
+                to_listen_on_host_port_pair=bridge.host_port_pair(),
+                engine=engine):
+                pass
+        except socket.error:
+            return True
+    print '\nTwo bridges listened on one port\n'
+    return False
+
+
+def check_concurrent(server,engine,prefix):
+    results = []
+    def use_bridge(i):
+        with InterceptorBridge(
+            server.host_port_pair,
+            lambda: ConstantDelayPlan(DELAY_SECONDS),
+            lambda: ConstantDelayPlan(DELAY_SECONDS),
+            multi_connection=True,engine=engine) as bridge:
+            results.append(
+                send_and_check(server,bridge,'%s client %i' % (prefix,i)) and
+                send_and_check(server,bridge,'%s again %i' % (prefix,i)))
+
+    start_time = time.time()
+    threads = []
+    for i in range(0,NUM_CONCURRENT_BRIDGES):
+        t = threading.Thread(target=use_bridge,args=(i,))
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join(WAIT_SECONDS)
+    elapsed = time.time() - start_time
+
+    if results != [True] * NUM_CONCURRENT_BRIDGES:
+        print '\nConcurrent bridges failed: %s\n' % results
+        return False
+    if elapsed > MAX_CONCURRENT_SECONDS:
+        print '\n%(num)i concurrent bridges took %(elapsed)fs\n' % {
+            'num': NUM_CONCURRENT_BRIDGES,
+            'elapsed': elapsed}
+        return False
+    return True
+
+
+def check_close(server,engine,engine_type):
+    closing_threads = []
+    class ThreadListener(ConnectionListener):
+        def connection_closed(self,connection,error):
+            closing_threads.append(threading.current_thread())
+
+    bridge = InterceptorBridge(server.host_port_pair,engine=engine)
+    bridge.bridge.add_connection_listener(ThreadListener())
+    bridge.start()
+    client = connect(bridge)
+    if not bridge.wait_for(BridgeEvent.CONNECTED,timeout=WAIT_SECONDS):
+        print '\nBridge never connected client to close\n'
+        return False
+    bridge.close()
+    if not bridge.wait_for(BridgeEvent.CLOSED,timeout=WAIT_SECONDS):
+        print '\nClosing bridge did not close connection\n'
+        return False
+    client.close()
+
+    if engine_type == EngineType.EVENT_LOOP:
+        expected_thread = engine.loop.thread
+    else:
+        expected_thread = threading.current_thread()
+    if closing_threads != [expected_thread]:
+        print '\nConnection closed on %s\n' % closing_threads
+        return False
+    return True
+
+
+def send_and_check(server,bridge,message):
+    '''
+    Connects a client through bridge, sends message, and closes the
+    client once the bridge has drained.
+
+    @returns {bool} --- True if the server received message, no
+    sooner than the bridge delays.
+    '''
+    num_connected = bridge.event_count(BridgeEvent.CONNECTED)
+    start_time = time.time()
+    client = connect(bridge)
+    client.sendall(message)
+    if not bridge.wait_for(
+        BridgeEvent.CONNECTED,num_connected + 1,WAIT_SECONDS):
+        print '\nBridge never connected %s\n' % message
+        return False
+    if not bridge.wait_for(BridgeEvent.DRAINED,timeout=WAIT_SECONDS):
+        print '\nBridge never drained %s\n' % message
+        return False
+    client.close()
+
+    received_time = server.wait_for_message(message)
+    if received_time is None:
+        print '\nServer never received %s\n' % message
+        return False
+    if received_time - start_time < DELAY_SECONDS:
+        print '\nServer received %s without a delay\n' % message
+        return False
+    return True
+
+
+def connect(bridge):
+    client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    client.connect(bridge.host_port_pair().host_port_tuple())
+    return client
+
+
+class CollectingServer(threading.Thread):
+    '''
+    Accepts any number of connections on a port the kernel picks,
+    and notes when each full message arrives.  Messages are whatever
+    a connection sends before closing.
+    '''
+    def __init__(self):
+        self.listening_socket = socket.socket(
+            socket.AF_INET,socket.SOCK_STREAM)
+        self.listening_socket.bind(('127.0.0.1',0))
+        self.listening_socket.listen(128)
+        self.host_port_pair = HostPortPair(
+            *self.listening_socket.getsockname())
+
+        self.condition = threading.Condition()
+        # message -> time received
+        self.messages = {}
+        super(CollectingServer,self).__init__()
+        self.setDaemon(True)
+
+    def wait_for_message(self,message):
+        '''
+        @returns {float or None} --- When message was received, or
+        None if it was not within WAIT_SECONDS.
+        '''
+        deadline = time.time() + WAIT_SECONDS
+        with self.condition:
+            while message not in self.messages:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.messages[message]
+
+    def run(self):
+        while True:
+            sock, addr = self.listening_socket.accept()
+            t = threading.Thread(target=self.collect,args=(sock,))
+            t.setDaemon(True)
+            t.start()
+
+    def collect(self,sock):
+        message = ''
+        received_time = None
+        while True:
+            try:
+                received = sock.recv(1024)
+            except socket.error:
+                break
+            if not received:
+                break
+            message += received
+            received_time = time.time()
+        sock.close()
+        if message:
+            with self.condition:
+                self.messages[message] = received_time
+                self.condition.notify_all()
+
+
+if __name__ == '__main__':
+    run_and_print()
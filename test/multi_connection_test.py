@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import threading
+import time
+import random
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import MultiConnectionBridge
+from interceptor.util import HostPortPair
+from interceptor.plan import PassThroughPlan, RandomFailPlan
+
+TEST_NAME = 'MULTI CONNECTION TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+    
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+           
+INTERPOSITION_LISTENER_PORT = random.randint(2222,55555)
+TO_CONNECT_TO_PORT = INTERPOSITION_LISTENER_PORT + 1
+
+NUM_CONNECTIONS = 20
+
+def run():
+    '''
+    Test starts listening on a port.  Then, it starts a multi
+    connection bridge and opens many connections to it at once, each
+    sending different data.  One extra connection always fails.  All
+    other connections should deliver their data to the other side,
+    regardless of the failing one.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    interposition_host_port_pair = HostPortPair(
+        '127.0.0.1',INTERPOSITION_LISTENER_PORT)
+    to_connect_to_host_port_pair = HostPortPair(
+        '127.0.0.1',TO_CONNECT_TO_PORT)
+
+    # start a thread listening on connection
+    listener_connection = ListenerConnection(to_connect_to_host_port_pair)
+    listener_connection.start()
+    time.sleep(1)
+
+    # the first connection gets plans that fail instantly, all
+    # others pass data through.
+    plans_made = [0]
+    def plan_factory():
+        plans_made[0] += 1
+        if plans_made[0] <= 2:
+            return RandomFailPlan(1)
+        return PassThroughPlan()
+    
+    # now, create a bridge
+    bridge = MultiConnectionBridge(
+        interposition_host_port_pair,plan_factory,
+        to_connect_to_host_port_pair,plan_factory)
+    bridge.non_blocking_connection_setup()
+
+    time.sleep(1)
+
+    failing_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    failing_socket.connect(interposition_host_port_pair.host_port_tuple())
+    time.sleep(.5)
+    
+    # now, open all connections before sending on any of them.
+    sending_sockets = []
+    for i in range(0,NUM_CONNECTIONS):
+        sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sending_socket.connect(interposition_host_port_pair.host_port_tuple())
+        sending_sockets.append(sending_socket)
+
+    try:
+        failing_socket.sendall('fail')
+    except:
+        pass
+        
+    expected_data = set()
+    for i in range(0,NUM_CONNECTIONS):
+        to_send = 'connection' + str(i) + ':' + ('x' * 100)
+        expected_data.add(to_send)
+        sending_sockets[i].sendall(to_send)
+
+    time.sleep(1)
+
+    # check that other side got the expected data
+    # failing plans still forward the data that makes them fail.
+    received_data = set(listener_connection.read_data.values())
+    received_data.discard('')
+    received_data.discard('fail')
+    if expected_data != received_data:
+        print ('\nExpected: %(expected)s, \nReceived: %(received)s\n' %
+               { 'expected': sorted(expected_data),
+                 'received': sorted(received_data)})
+        return False
+    
+    return True
+
+
+class ListenerConnection(threading.Thread):
+    def __init__(self,host_port_pair_to_listen_to):
+        self.host_port_pair_to_listen_to = host_port_pair_to_listen_to
+        # all data read from each connection thus far, keyed by the
+        # order in which connection was accepted.
+        self.read_data = {}
+        
+        super(ListenerConnection,self).__init__()
+        self.setDaemon(True)
+        
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(self.host_port_pair_to_listen_to.host_port_tuple())
+        s.listen(NUM_CONNECTIONS)
+        index = 0
+        while True:
+            to_listen_on_socket, addr = s.accept()
+            self.read_data[index] = ''
+            t = threading.Thread(
+                target=self.read_connection,
+                args=(index,to_listen_on_socket))
+            t.setDaemon(True)
+            t.start()
+            index += 1
+
+    def read_connection(self,index,to_listen_on_socket):
+        while True:
+            try:
+                data = to_listen_on_socket.recv(1024)
+            except:
+                break
+            if len(data) == 0:
+                break
+            self.read_data[index] += data
+            
+
+if __name__ == '__main__':
+    run_and_print()
+    
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.engine import EngineType, engine_from_type
+from interceptor.harness import BridgeEvent, InterceptorBridge
+from interceptor.plan import plan_from_args, PlanType, PipelinePlan
+from interceptor.plan import ConstantDelayPlan, CorruptPlan, PassThroughPlan
+from interceptor.plan import Plan, RandomFailPlan
+from interceptor.util import HostPortPair
+
+TEST_NAME = 'PIPELINE PLAN TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+DELAY_SECONDS = .1
+ERROR_RATE = .01
+SEED = 7
+NUM_CHUNKS = 50
+CHUNK_SIZE = 1000
+MAX_QUEUED_BYTES = 10 * CHUNK_SIZE
+SERIALIZED_SECONDS = .5
+WAIT_SECONDS = 5
+
+def run():
+    '''
+    Checks that a pipeline of stages does what its stages would do one
+    after the other: a corrupting stage behind a delaying stage
+    corrupts the same bytes as on its own, after the delay.  Checks
+    that failures from stages that forward right away and from stages
+    behind delays bring the connection down, even when nothing more
+    is received, and that a full stage stops the pipeline accepting
+    data.  Checks that stages never run on two threads at once, and
+    that pipelines load from args.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    return (
+        check_delay_then_corrupt() and
+        check_failures() and
+        check_quiet_failure() and
+        check_serialized() and
+        check_accepting_data() and
+        check_from_args())
+
+
+def check_delay_then_corrupt():
+    chunks = [
+        chr(ord('a') + i % 26) * CHUNK_SIZE for i in range(0,NUM_CHUNKS)]
+
+    alone_socket = _CollectingSocket()
+    CorruptPlan(ERROR_RATE,seed=SEED).recv_many(chunks,alone_socket)
+    expected = ''.join(alone_socket.sent)
+    if expected == ''.join(chunks):
+        print '\nCorrupt plan on its own corrupted nothing\n'
+        return False
+
+    pipeline = PipelinePlan(
+        [ConstantDelayPlan(DELAY_SECONDS),CorruptPlan(ERROR_RATE,seed=SEED),
+         PassThroughPlan()])
+    pipeline_socket = _CollectingSocket(len(expected))
+    start_time = time.time()
+    for chunk in chunks:
+        if pipeline.recv(chunk,pipeline_socket) is not None:
+            print '\nPipeline without failures failed\n'
+            return False
+    if pipeline_socket.sent:
+        print '\nPipeline forwarded before its delay\n'
+        return False
+    if not pipeline_socket.all_sent.wait(5):
+        print '\nPipeline did not forward everything\n'
+        return False
+    elapsed = time.time() - start_time
+    if elapsed < DELAY_SECONDS:
+        print '\nPipeline forwarded after %f seconds\n' % elapsed
+        return False
+    if ''.join(pipeline_socket.sent) != expected:
+        print '\nPipeline corrupted different bytes than its stage\n'
+        return False
+    return True
+
+
+def check_failures():
+    # forwards, then fails right away
+    sink = _CollectingSocket()
+    pipeline = PipelinePlan([RandomFailPlan(1.),PassThroughPlan()])
+    if pipeline.recv('x',sink) != 0:
+        print '\nPipeline did not report failure of its stage\n'
+        return False
+    if sink.sent != ['x']:
+        print '\nPipeline did not forward what failing stage sent\n'
+        return False
+
+    # fails after a delay: reported to the socket right away, and by
+    # the next recv
+    sink = _CollectingSocket(1)
+    pipeline = PipelinePlan(
+        [ConstantDelayPlan(DELAY_SECONDS),RandomFailPlan(1.)])
+    if pipeline.recv('x',sink) is not None:
+        print '\nDelayed failure reported too early\n'
+        return False
+    if not sink.all_sent.wait(5):
+        print '\nDelayed stage never forwarded\n'
+        return False
+    if (not sink.closed.wait(5)) or (sink.close_seconds != [0]):
+        print '\nDelayed failure was not reported to the socket\n'
+        return False
+    if pipeline.recv('y',sink) != 0:
+        print '\nDelayed failure was not reported\n'
+        return False
+    time.sleep(2 * DELAY_SECONDS)
+    if sink.sent != ['x']:
+        print '\nPipeline forwarded after failing\n'
+        return False
+    return True
+
+
+def check_quiet_failure():
+    '''
+    A client that sends a request and waits for the response sends
+    nothing more, so only the failure itself can bring it down.
+    '''
+    server = _ReadingServer()
+    server.start()
+    for engine_type in (EngineType.THREADED,EngineType.EVENT_LOOP):
+        with InterceptorBridge(
+            server.host_port_pair,
+            lambda: PipelinePlan(
+                [ConstantDelayPlan(DELAY_SECONDS),RandomFailPlan(1.)]),
+            engine=engine_from_type(engine_type)) as bridge:
+            client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            client.connect(bridge.host_port_pair().host_port_tuple())
+            client.sendall('request')
+            closed = bridge.wait_for(BridgeEvent.CLOSED,timeout=WAIT_SECONDS)
+            client.close()
+            if not closed:
+                print '\nQuiet connection never failed with %s engine\n' % (
+                    engine_type)
+                return False
+    return True
+
+
+def check_serialized():
+    '''
+    Like a rate limit with tokens to spare for some chunks but not
+    others, the first stage forwards both from recv and from another
+    thread, so the stage behind it is fed from both.
+    '''
+    stage = _ExclusiveStage()
+    pipeline = PipelinePlan([_TwiceStage(),stage])
+    sink = _CollectingSocket()
+    start_time = time.time()
+    while time.time() - start_time < SERIALIZED_SECONDS:
+        pipeline.recv('s',sink)
+        # lets the other threads keep up.
+        time.sleep(.001)
+    time.sleep(2 * DELAY_SECONDS)
+    if stage.max_concurrent != 1:
+        print '\nStage ran on %i threads at once\n' % stage.max_concurrent
+        return False
+    return True
+
+
+def check_accepting_data():
+    resumed = threading.Event()
+    pipeline = PipelinePlan(
+        [PassThroughPlan(),
+         ConstantDelayPlan(DELAY_SECONDS,max_queued_bytes=MAX_QUEUED_BYTES)])
+    pipeline.set_resume_callback(resumed.set)
+    sink = _CollectingSocket(MAX_QUEUED_BYTES)
+    pipeline.recv_many(
+        ['z' * CHUNK_SIZE] * (MAX_QUEUED_BYTES / CHUNK_SIZE),sink)
+    if pipeline.accepting_data():
+        print '\nPipeline with a full stage accepted data\n'
+        return False
+    if (not resumed.wait(5)) or (not pipeline.accepting_data()):
+        print '\nPipeline did not resume once its stage drained\n'
+        return False
+    return True
+
+
+def check_from_args():
+    pipeline = plan_from_args(
+        PlanType.PIPELINE_PLAN,
+        {'stages': [
+                {'type': PlanType.CONSTANT_DELAY_PLAN,
+                 'additional_args': {'delay_seconds': .01}},
+                {'type': PlanType.RATE_LIMIT_PLAN,
+                 'additional_args': {'bytes_per_second': 1000000}},
+                {'type': PlanType.RANDOM_FAIL_PLAN,
+                 'additional_args': {'failure_probability': .01}}]})
+    if [stage.__class__.__name__ for stage in pipeline.stages] != [
+        'ConstantDelayPlan','RateLimitPlan','RandomFailPlan']:
+        print '\nPipeline loaded the wrong stages\n'
+        return False
+    snapshot = pipeline.metrics_snapshot()
+    if len(snapshot['stages']) != 3:
+        print '\nPipeline snapshot is missing stages\n'
+        return False
+
+    for bad_stages in ([],[{'additional_args': {}}],['drop']):
+        try:
+            plan_from_args(PlanType.PIPELINE_PLAN,{'stages': bad_stages})
+        except argparse.ArgumentTypeError:
+            pass
+        else:
+            print '\nLoaded pipeline with bad stages %s\n' % bad_stages
+            return False
+    return True
+
+
+class _TwiceStage(Plan):
+    '''
+    Forwards each chunk right away, and again from a thread of its
+    own.
+    '''
+    def recv(self,received_data,socket_to_send_data_to):
+        t = threading.Thread(
+            target=socket_to_send_data_to.sendall,args=(received_data,))
+        t.setDaemon(True)
+        t.start()
+        socket_to_send_data_to.sendall(received_data)
+        return None
+
+
+class _ExclusiveStage(Plan):
+    '''
+    Forwards, noting the most threads ever in recv at once.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    def recv(self,received_data,socket_to_send_data_to):
+        with self.lock:
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent,self.concurrent)
+        # long enough for another thread to arrive.
+        time.sleep(.001)
+        socket_to_send_data_to.sendall(received_data)
+        with self.lock:
+            self.concurrent -= 1
+        return None
+
+
+class _ReadingServer(threading.Thread):
+    '''
+    Accepts connections on a port the kernel picks, and reads from
+    them without ever responding.
+    '''
+    def __init__(self):
+        self.listening_socket = socket.socket(
+            socket.AF_INET,socket.SOCK_STREAM)
+        self.listening_socket.bind(('127.0.0.1',0))
+        self.listening_socket.listen(128)
+        self.host_port_pair = HostPortPair(
+            *self.listening_socket.getsockname())
+        super(_ReadingServer,self).__init__()
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            sock, addr = self.listening_socket.accept()
+            t = threading.Thread(target=self.read,args=(sock,))
+            t.setDaemon(True)
+            t.start()
+
+    def read(self,sock):
+        try:
+            while sock.recv(1024):
+                pass
+        except socket.error:
+            pass
+        sock.close()
+
+
+class _CollectingSocket(object):
+    def __init__(self,expected_bytes=None):
+        self.sent = []
+        self.num_bytes = 0
+        self.expected_bytes = expected_bytes
+        self.all_sent = threading.Event()
+        self.close_seconds = []
+        self.closed = threading.Event()
+
+    def close_after(self,seconds):
+        self.close_seconds.append(seconds)
+        self.closed.set()
+
+    def sendall(self,data):
+        self.sent.append(data)
+        self.num_bytes += len(data)
+        if (self.expected_bytes is not None) and (
+            self.num_bytes >= self.expected_bytes):
+            self.all_sent.set()
+
+
+if __name__ == '__main__':
+    run_and_print()
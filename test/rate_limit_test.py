@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.plan import RateLimitPlan
+
+TEST_NAME = 'RATE LIMIT TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+    
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+BYTES_PER_SECOND = 100 * 1024
+BURST_BYTES = 10 * 1024
+AMOUNT_OF_DATA_TO_SEND = 250 * 1024
+           
+def run():
+    '''
+    Hands a rate limit plan much more data than its burst size, in
+    large and small chunks.  The data should arrive in order, at
+    about the configured rate, without the plan burning CPU while it
+    waits.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    plan = RateLimitPlan(BYTES_PER_SECOND,BURST_BYTES)
+    sending_socket, receiving_socket = socket.socketpair()
+
+    expected_data = ''
+    start_time = time.time()
+    start_cpu = sum(os.times()[0:2])
+    i = 0
+    while len(expected_data) < AMOUNT_OF_DATA_TO_SEND:
+        # alternate between chunks bigger and smaller than the burst.
+        if i % 2 == 0:
+            to_send = chr(ord('a') + i % 26) * (3 * BURST_BYTES)
+        else:
+            to_send = str(i)
+        expected_data += to_send
+        plan.recv(to_send,sending_socket)
+        i += 1
+
+    read_data = ''
+    receiving_socket.settimeout(10)
+    while len(read_data) < len(expected_data):
+        read_data += receiving_socket.recv(65536)
+    elapsed = time.time() - start_time
+    cpu_used = sum(os.times()[0:2]) - start_cpu
+
+    if read_data != expected_data:
+        print '\nData received does not match data sent\n'
+        return False
+
+    expected_elapsed = (
+        float(len(expected_data) - BURST_BYTES) / BYTES_PER_SECOND)
+    if abs(elapsed - expected_elapsed) > .25 * expected_elapsed:
+        print ('\nExpected to take %(expected)f seconds, took %(took)f\n' %
+               { 'expected': expected_elapsed,
+                 'took': elapsed})
+        return False
+
+    if cpu_used > .25 * elapsed:
+        print ('\nUsed %(cpu)f seconds of cpu in %(took)f seconds\n' %
+               { 'cpu': cpu_used,
+                 'took': elapsed})
+        return False
+    
+    return True
+
+
+if __name__ == '__main__':
+    run_and_print()
+    
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import threading
+import time
+import random
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import Bridge
+from interceptor.engine import ThreadedEngine, EventLoopEngine
+from interceptor.util import HostPortPair
+from interceptor.plan import PassThroughPlan, RandomFailPlan
+
+TEST_NAME = 'RECONNECT CYCLE TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+BASE_PORT = random.randint(2222,55555)
+NUM_WARMUP_CYCLES = 100
+NUM_CYCLES = 2000
+# threads and fds that may come and go for reasons other than leaks.
+ALLOWED_GROWTH = 4
+MIN_CYCLES_PER_SECOND = 200
+
+def run():
+    '''
+    With each engine, repeatedly connects to a bridge whose plan
+    brings the connection down as soon as it forwards anything.
+    After thousands of cycles, the process should have about as many
+    threads and open fds as it had after the first few, and cycles
+    should be fast.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    engines = (ThreadedEngine(),EventLoopEngine())
+    for i in range(0,len(engines)):
+        if not run_engine(engines[i],BASE_PORT + 2*i):
+            return False
+    return True
+
+
+def run_engine(engine,base_port):
+    interposition_host_port_pair = HostPortPair('127.0.0.1',base_port)
+    to_connect_to_host_port_pair = HostPortPair('127.0.0.1',base_port + 1)
+    listener = ClosingListener(to_connect_to_host_port_pair)
+    listener.start()
+
+    bridge = Bridge(
+        interposition_host_port_pair,RandomFailPlan(1),
+        to_connect_to_host_port_pair,PassThroughPlan(),
+        engine)
+    bridge.non_blocking_connection_setup()
+    time.sleep(.5)
+
+    if not run_cycles(interposition_host_port_pair,NUM_WARMUP_CYCLES):
+        return False
+    num_threads = threading.active_count()
+    num_fds = num_open_fds()
+
+    start_time = time.time()
+    if not run_cycles(interposition_host_port_pair,NUM_CYCLES):
+        return False
+    cycles_per_second = NUM_CYCLES / (time.time() - start_time)
+
+    if threading.active_count() > num_threads + ALLOWED_GROWTH:
+        print ('\nThreads grew from %(before)i to %(after)i\n' %
+               { 'before': num_threads,
+                 'after': threading.active_count()})
+        return False
+    if num_open_fds() > num_fds + ALLOWED_GROWTH:
+        print ('\nOpen fds grew from %(before)i to %(after)i\n' %
+               { 'before': num_fds,
+                 'after': num_open_fds()})
+        return False
+    if cycles_per_second < MIN_CYCLES_PER_SECOND:
+        print '\nOnly %f cycles per second\n' % cycles_per_second
+        return False
+    return True
+
+
+def run_cycles(interposition_host_port_pair,num_cycles):
+    '''
+    Connect, send a byte, and wait for the bridge to bring the
+    connection down, num_cycles times.
+    '''
+    for i in range(0,num_cycles):
+        sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sending_socket.settimeout(5)
+        try:
+            sending_socket.connect(
+                interposition_host_port_pair.host_port_tuple())
+            sending_socket.sendall('x')
+            while len(sending_socket.recv(1024)) != 0:
+                pass
+        except socket.timeout:
+            print '\nTimed out waiting for connection to go down\n'
+            return False
+        except socket.error:
+            # reset by bridge
+            pass
+        finally:
+            sending_socket.close()
+    return True
+
+
+def num_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+class ClosingListener(threading.Thread):
+    '''
+    Accepts connections and closes them right away, from one thread.
+    '''
+    def __init__(self,host_port_pair_to_listen_to):
+        self.host_port_pair_to_listen_to = host_port_pair_to_listen_to
+        super(ClosingListener,self).__init__()
+        self.setDaemon(True)
+
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(self.host_port_pair_to_listen_to.host_port_tuple())
+        s.listen(128)
+        while True:
+            connection_socket, addr = s.accept()
+            connection_socket.close()
+
+
+if __name__ == '__main__':
+    run_and_print()
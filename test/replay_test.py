@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.decisions import DecisionRecorder, load_decisions
+from interceptor.plan import RandomDelayPlan, RandomFailPlan, ReplayPlan
+
+TEST_NAME = 'REPLAY TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+SEED = 42
+NUM_CHUNKS = 1000
+NUM_DELAYED_CHUNKS = 100
+NUM_LARGE_RECORDING_CHUNKS = 1000000
+MAX_LOAD_SECONDS = 2.
+
+def run():
+    '''
+    Records the decisions of seeded fail and delay plans, then checks
+    that plans with the same seed make the same decisions, that
+    replay plans make the recorded decisions, and that a million
+    chunk recording loads quickly.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        return (
+            check_fail_plan(directory) and
+            check_delay_plan(directory) and
+            check_large_recording(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_fail_plan(directory):
+    path = os.path.join(directory,'fail')
+    recorder = DecisionRecorder(path)
+    recorded_plan = RandomFailPlan(.1,SEED,recorder)
+    unrecorded_plan = RandomFailPlan(.1,SEED)
+    sink = _SinkSocket()
+    recorded_results = []
+    for i in range(0,NUM_CHUNKS):
+        recorded_results.append(recorded_plan.recv('x',sink))
+        if unrecorded_plan.recv('x',sink) != recorded_results[-1]:
+            print '\nFail plans with same seed made different decisions\n'
+            return False
+    recorder.close()
+
+    if recorded_results.count(0) == 0:
+        print '\nFail plan never failed\n'
+        return False
+
+    replay_plan = ReplayPlan(load_decisions(path))
+    for i in range(0,NUM_CHUNKS):
+        if replay_plan.recv('x',sink) != recorded_results[i]:
+            print '\nReplay of chunk %i made a different decision\n' % i
+            return False
+    return True
+
+
+def check_delay_plan(directory):
+    path = os.path.join(directory,'delay')
+    recorder = DecisionRecorder(path)
+    recorded_plan = RandomDelayPlan(0,.01,True,seed=SEED,recorder=recorder)
+    unrecorded_plan = RandomDelayPlan(0,.01,True,seed=SEED)
+    for i in range(0,NUM_DELAYED_CHUNKS):
+        if recorded_plan.sample_delay() != unrecorded_plan.sample_delay():
+            print '\nDelay plans with same seed made different decisions\n'
+            return False
+    recorder.close()
+    decisions = load_decisions(path)
+
+    # the replay should ask to send each chunk its recorded delay
+    # after receiving it.
+    send_delays = []
+    all_sent = threading.Event()
+    def deviation_callback(delay_data_element,deviation_seconds):
+        send_delays.append(
+            delay_data_element.send_time_seconds -
+            delay_data_element.received_time_seconds)
+        if len(send_delays) == NUM_DELAYED_CHUNKS:
+            all_sent.set()
+
+    replay_plan = ReplayPlan(
+        decisions,deviation_callback=deviation_callback)
+    sink = _SinkSocket()
+    for i in range(0,NUM_DELAYED_CHUNKS):
+        replay_plan.recv('x',sink)
+        time.sleep(.01)
+    all_sent.wait(5)
+
+    if len(send_delays) != NUM_DELAYED_CHUNKS:
+        print '\nReplay did not send every chunk\n'
+        return False
+    for i in range(0,NUM_DELAYED_CHUNKS):
+        # a chunk goes out no earlier than the one before it.
+        if send_delays[i] < decisions.delays[i] - 1e-9:
+            print '\nReplay of chunk %i used a different delay\n' % i
+            return False
+    return True
+
+
+def check_large_recording(directory):
+    path = os.path.join(directory,'large')
+    recorder = DecisionRecorder(path)
+    for i in range(0,NUM_LARGE_RECORDING_CHUNKS):
+        recorder.record(i * 1e-6,i % 1000 == 0)
+    recorder.close()
+
+    start_time = time.time()
+    decisions = load_decisions(path)
+    load_seconds = time.time() - start_time
+    if load_seconds > MAX_LOAD_SECONDS:
+        print '\nLoading recording took %f seconds\n' % load_seconds
+        return False
+
+    index = NUM_LARGE_RECORDING_CHUNKS - 1000
+    if ((len(decisions) != NUM_LARGE_RECORDING_CHUNKS) or
+        (decisions.delays[index] != index * 1e-6) or
+        (not decisions.failed[index]) or
+        decisions.failed[index + 1]):
+        print '\nLoaded different decisions than were recorded\n'
+        return False
+    return True
+
+
+class _SinkSocket(object):
+    def sendall(self,data):
+        pass
+
+
+if __name__ == '__main__':
+    run_and_print()
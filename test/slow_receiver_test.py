@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import sys
+import threading
+import time
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import DEFAULT_RECV_BUFFER_SIZE, MAX_HELD_READS
+from interceptor.engine import EventLoopEngine, ThreadedEngine
+from interceptor.harness import InterceptorBridge
+from interceptor.plan import ConstantDelayPlan, PassThroughPlan
+from interceptor.util import HostPortPair
+
+TEST_NAME = 'SLOW RECEIVER TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+FLOOD_BYTES = 16 * 1024 * 1024
+# the flood has filled every buffer between its client and its sink
+# long before this.
+FLOOD_SECONDS = 1.
+MAX_ECHO_SECONDS = 3.
+DELAY_SECONDS = .01
+# the last read may overshoot the cap.
+MAX_HELD_BYTES = (MAX_HELD_READS + 1) * DEFAULT_RECV_BUFFER_SIZE
+
+def run():
+    '''
+    Floods one bridge towards a server that never reads, while a
+    second bridge on the same engine forwards to an echo server.
+    Checks that the second bridge still echoes promptly, and that the
+    flooded bridge stopped reading rather than holding the flood.
+    Does so copying, splicing, and delaying on the shared scheduler,
+    and checks that splicing echoes a read that fills the receive
+    buffer exactly.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    engine = EventLoopEngine()
+    return (check_isolated(engine,CopyingPlan,CopyingPlan,'copying') and
+            check_isolated(
+                engine,PassThroughPlan,PassThroughPlan,'splicing') and
+            check_isolated(
+                ThreadedEngine(),delay_plan,delay_plan,'delaying',
+                # plus what the plan had queued when the bridge stopped
+                # reading.
+                MAX_HELD_BYTES + 2 * DEFAULT_RECV_BUFFER_SIZE) and
+            check_full_read(engine))
+
+
+def delay_plan():
+    return ConstantDelayPlan(
+        DELAY_SECONDS,max_queued_bytes=DEFAULT_RECV_BUFFER_SIZE)
+
+
+def check_full_read(engine):
+    '''
+    A read that fills the buffer used to make the bridge splice
+    again, blocking the loop on a socket with nothing more to read.
+    '''
+    echo_server = Server(reads=True)
+    echo_server.start()
+    with InterceptorBridge(
+        echo_server.host_port_pair,multi_connection=True,
+        engine=engine) as bridge:
+        client = connect(bridge)
+        client.settimeout(MAX_ECHO_SECONDS)
+        client.sendall('x' * DEFAULT_RECV_BUFFER_SIZE)
+        echoed = ''
+        try:
+            while len(echoed) < DEFAULT_RECV_BUFFER_SIZE:
+                received = client.recv(DEFAULT_RECV_BUFFER_SIZE)
+                if not received:
+                    break
+                echoed += received
+        except socket.timeout:
+            pass
+        client.close()
+    if len(echoed) != DEFAULT_RECV_BUFFER_SIZE:
+        print '\nfull read: echoed %i bytes\n' % len(echoed)
+        return False
+    return True
+
+
+def check_isolated(engine,flood_plan_factory,echo_plan_factory,name,
+                   max_held_bytes=None):
+    '''
+    @param {int or None} max_held_bytes --- Most the flooded bridge
+    may hold.  If None, MAX_HELD_BYTES.
+    '''
+    if max_held_bytes is None:
+        max_held_bytes = MAX_HELD_BYTES
+    stalled_server = Server(reads=False)
+    echo_server = Server(reads=True)
+    for server in (stalled_server,echo_server):
+        server.start()
+
+    with InterceptorBridge(
+        stalled_server.host_port_pair,flood_plan_factory,
+        engine=engine) as flooded, InterceptorBridge(
+        echo_server.host_port_pair,echo_plan_factory,echo_plan_factory,
+        engine=engine) as echoing:
+        flood_client = connect(flooded)
+        flooder = threading.Thread(
+            target=flood,args=(flood_client,FLOOD_BYTES))
+        flooder.setDaemon(True)
+        flooder.start()
+        time.sleep(FLOOD_SECONDS)
+
+        client = connect(echoing)
+        client.settimeout(MAX_ECHO_SECONDS)
+        client.sendall('ping')
+        try:
+            echoed = client.recv(1024)
+        except socket.timeout:
+            echoed = None
+        client.close()
+        if echoed != 'ping':
+            print '\n%s: echo was held up by a slow receiver\n' % name
+            return False
+
+        held_bytes = sum(
+            connection.pairs[0].outlet.held_bytes
+            for connection in flooded.bridge.current_connections())
+        if held_bytes > max_held_bytes:
+            print '\n%(name)s: bridge held %(held)i bytes\n' % {
+                'name': name,
+                'held': held_bytes}
+            return False
+        # wakes the flooder.
+        flood_client.shutdown(socket.SHUT_RDWR)
+        flooder.join()
+        flood_client.close()
+    return True
+
+
+class CopyingPlan(PassThroughPlan):
+    '''
+    Forwards right away, but through python, so that it sends on the
+    loop.
+    '''
+    needs_payload = True
+
+
+def flood(sock,num_bytes):
+    chunk = 'x' * 65536
+    try:
+        for i in range(0,num_bytes / len(chunk)):
+            sock.sendall(chunk)
+    except socket.error:
+        # closed at the end of the test.
+        pass
+
+
+def connect(bridge):
+    client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    client.connect(bridge.host_port_pair().host_port_tuple())
+    return client
+
+
+class Server(threading.Thread):
+    '''
+    Accepts connections on a port the kernel picks, and either echoes
+    what they send or never reads from them.
+    '''
+    def __init__(self,reads):
+        self.reads = reads
+        self.listening_socket = socket.socket(
+            socket.AF_INET,socket.SOCK_STREAM)
+        self.listening_socket.bind(('127.0.0.1',0))
+        self.listening_socket.listen(128)
+        self.host_port_pair = HostPortPair(
+            *self.listening_socket.getsockname())
+        # keeps sockets that are never read from open.
+        self.connections = []
+        super(Server,self).__init__()
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            sock, addr = self.listening_socket.accept()
+            self.connections.append(sock)
+            if self.reads:
+                t = threading.Thread(target=self.echo,args=(sock,))
+                t.setDaemon(True)
+                t.start()
+
+    def echo(self,sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                sock.sendall(data)
+            except socket.error:
+                break
+        sock.close()
+
+
+if __name__ == '__main__':
+    run_and_print()
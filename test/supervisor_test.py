@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import sys
+import socket
+import threading
+import time
+import random
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.config import BridgeDescription
+from interceptor.engine import EngineType
+from interceptor.plan import PlanType
+from interceptor.supervisor import Supervisor
+from interceptor.util import HostPortPair
+
+TEST_NAME = 'SUPERVISOR TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+INTERPOSITION_LISTENER_PORT = random.randint(2222,55555)
+TO_CONNECT_TO_PORT = INTERPOSITION_LISTENER_PORT + 1
+
+NUM_WORKERS = 2
+NUM_CONNECTIONS = 20
+
+def run():
+    '''
+    Runs a multi connection bridge in two worker processes and opens
+    many connections to it.  Both workers should accept some of them,
+    all data should arrive, and the supervisor's combined metrics
+    should count every connection.  Then kills a worker, which the
+    supervisor should restart, and checks that the bridge still
+    forwards.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    interposition_host_port_pair = HostPortPair(
+        '127.0.0.1',INTERPOSITION_LISTENER_PORT)
+    to_connect_to_host_port_pair = HostPortPair(
+        '127.0.0.1',TO_CONNECT_TO_PORT)
+
+    listener = Listener(to_connect_to_host_port_pair)
+    listener.start()
+
+    supervisor = Supervisor(
+        [BridgeDescription(
+                interposition_host_port_pair,to_connect_to_host_port_pair,
+                PlanType.PASS_THROUGH_PLAN,{},multi_connection=True)],
+        NUM_WORKERS,EngineType.THREADED)
+    supervisor.start()
+    t = threading.Thread(target=supervisor.run_forever)
+    t.setDaemon(True)
+    t.start()
+    time.sleep(1)
+
+    if not send_through_bridge(
+        interposition_host_port_pair,listener,'first',NUM_CONNECTIONS):
+        return False
+
+    snapshot = supervisor.snapshot()
+    connections_accepted = snapshot['bridges'][0]['connections_accepted']
+    if connections_accepted != NUM_CONNECTIONS:
+        print ('\nSupervisor counted %(counted)i connections, ' +
+               'expected %(expected)i\n') % {
+            'counted': connections_accepted,
+            'expected': NUM_CONNECTIONS}
+        return False
+    for worker in supervisor.workers:
+        worker_snapshot = worker.snapshot()
+        if worker_snapshot['bridges'][0]['connections_accepted'] == 0:
+            print '\nWorker %i accepted no connections\n' % worker.worker_index
+            return False
+
+    # kill a worker; it should come back.
+    os.kill(snapshot['workers'][0]['pid'],signal.SIGKILL)
+    start_time = time.time()
+    while True:
+        description = supervisor.workers[0].description()
+        if (description['restarts'] == 1) and description['alive']:
+            break
+        if time.time() - start_time > 5:
+            print '\nWorker was not restarted\n'
+            return False
+        time.sleep(.1)
+    time.sleep(.5)
+
+    return send_through_bridge(
+        interposition_host_port_pair,listener,'second',NUM_CONNECTIONS)
+
+
+def send_through_bridge(interposition_host_port_pair,listener,prefix,
+                        num_connections):
+    '''
+    Open num_connections connections, send a different message on
+    each, and wait for all messages to arrive.
+    '''
+    sending_sockets = []
+    messages = []
+    for i in range(0,num_connections):
+        sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sending_socket.connect(
+            interposition_host_port_pair.host_port_tuple())
+        message = '%(prefix)s %(i)i;' % {'prefix': prefix, 'i': i}
+        sending_socket.sendall(message)
+        sending_sockets.append(sending_socket)
+        messages.append(message)
+
+    start_time = time.time()
+    while True:
+        read_data = listener.read_data()
+        missing = [
+            message for message in messages if message not in read_data]
+        if not missing:
+            break
+        if time.time() - start_time > 5:
+            print '\nNever received ' + ', '.join(missing) + '\n'
+            return False
+        time.sleep(.05)
+
+    for sending_socket in sending_sockets:
+        sending_socket.close()
+    return True
+
+
+class Listener(threading.Thread):
+    '''
+    Accepts any number of connections and records everything they
+    send.
+    '''
+    def __init__(self,host_port_pair_to_listen_to):
+        self.host_port_pair_to_listen_to = host_port_pair_to_listen_to
+        self.lock = threading.Lock()
+        self.read_chunks = []
+
+        super(Listener,self).__init__()
+        self.setDaemon(True)
+
+    def read_data(self):
+        with self.lock:
+            return ''.join(self.read_chunks)
+
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(self.host_port_pair_to_listen_to.host_port_tuple())
+        s.listen(128)
+        while True:
+            connection_socket, addr = s.accept()
+            t = threading.Thread(
+                target=self.read_connection,args=(connection_socket,))
+            t.setDaemon(True)
+            t.start()
+
+    def read_connection(self,connection_socket):
+        while True:
+            try:
+                data = connection_socket.recv(1024)
+            except socket.error:
+                break
+            if len(data) == 0:
+                break
+            with self.lock:
+                self.read_chunks.append(data)
+        connection_socket.close()
+
+
+if __name__ == '__main__':
+    run_and_print()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import threading
+import time
+import random
+FILE_DIR = os.path.dirname( os.path.abspath(__file__))
+sys.path.append(os.path.join(FILE_DIR,'..',))
+
+from interceptor.bridge import Bridge
+from interceptor.util import HostPortPair
+from interceptor.plan import PassThroughPlan, RandomFailPlan
+
+TEST_NAME = 'UPSTREAM POOL TEST'
+
+def run_and_print():
+    succeed_string = 'SUCCEEDED'
+    if not run():
+        succeed_string = 'FAILED'
+
+    print ('\n%(test_name)s: %(succeed)s\n' %
+           {'test_name': TEST_NAME,
+            'succeed': succeed_string})
+
+INTERPOSITION_LISTENER_PORT = random.randint(2222,55555)
+TO_CONNECT_TO_PORT = INTERPOSITION_LISTENER_PORT + 1
+
+UPSTREAM_POOL_SIZE = 2
+NUM_CYCLES = 50
+MAX_MEAN_RECOVERY_SECONDS = .02
+
+def run():
+    '''
+    Starts a bridge with an upstream pool before anything listens
+    upstream, so the pool has to back off and retry.  Then starts
+    listening upstream, and repeatedly connects a client whose first
+    message brings its connection down.  Each message should reach
+    the other side quickly, over a connection taken from the pool.
+
+    @returns {boolean} --- True if test succeeds, false if test fails.
+    '''
+    interposition_host_port_pair = HostPortPair(
+        '127.0.0.1',INTERPOSITION_LISTENER_PORT)
+    to_connect_to_host_port_pair = HostPortPair(
+        '127.0.0.1',TO_CONNECT_TO_PORT)
+
+    bridge = Bridge(
+        interposition_host_port_pair,RandomFailPlan(1),
+        to_connect_to_host_port_pair,PassThroughPlan(),
+        upstream_pool_size=UPSTREAM_POOL_SIZE)
+    bridge.non_blocking_connection_setup()
+    time.sleep(.5)
+
+    listener = Listener(to_connect_to_host_port_pair)
+    listener.start()
+    # backoff is capped at half a second.
+    time.sleep(1)
+
+    total_recovery_seconds = 0.
+    for i in range(0,NUM_CYCLES):
+        message = 'message %i;' % i
+        start_time = time.time()
+        sending_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sending_socket.connect(
+            interposition_host_port_pair.host_port_tuple())
+        sending_socket.sendall(message)
+        while message not in listener.read_data():
+            if time.time() - start_time > 5:
+                print '\nTimed out waiting for ' + message + '\n'
+                return False
+            time.sleep(.0001)
+        total_recovery_seconds += time.time() - start_time
+        sending_socket.close()
+
+    mean_recovery_seconds = total_recovery_seconds / NUM_CYCLES
+    if mean_recovery_seconds > MAX_MEAN_RECOVERY_SECONDS:
+        print ('\nMean time to forward a message was %f seconds\n' %
+               mean_recovery_seconds)
+        return False
+
+    pool_snapshot = bridge.upstream_pool.snapshot()
+    if pool_snapshot['hits'] < NUM_CYCLES / 2:
+        print ('\nOnly %(hits)i of %(cycles)i connections came from pool\n' %
+               { 'hits': pool_snapshot['hits'],
+                 'cycles': NUM_CYCLES})
+        return False
+    return True
+
+
+class Listener(threading.Thread):
+    '''
+    Accepts any number of connections and records everything they
+    send.
+    '''
+    def __init__(self,host_port_pair_to_listen_to):
+        self.host_port_pair_to_listen_to = host_port_pair_to_listen_to
+        self.lock = threading.Lock()
+        self.read_chunks = []
+
+        super(Listener,self).__init__()
+        self.setDaemon(True)
+
+    def read_data(self):
+        with self.lock:
+            return ''.join(self.read_chunks)
+
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(self.host_port_pair_to_listen_to.host_port_tuple())
+        s.listen(16)
+        while True:
+            connection_socket, addr = s.accept()
+            t = threading.Thread(
+                target=self.read_connection,args=(connection_socket,))
+            t.setDaemon(True)
+            t.start()
+
+    def read_connection(self,connection_socket):
+        while True:
+            try:
+                data = connection_socket.recv(1024)
+            except socket.error:
+                break
+            if len(data) == 0:
+                break
+            with self.lock:
+                self.read_chunks.append(data)
+        connection_socket.close()
+
+
+if __name__ == '__main__':
+    run_and_print()